@@ -0,0 +1,520 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import failure, log
+from twisted.web import resource, server, static
+
+from buildbot import config
+from buildbot.process.properties import Secret
+from buildbot.util import bytes2unicode, unicode2bytes
+from buildbot.util import service
+
+from polyjit.buildbot import tokenauth
+
+# Settings of the artifact store on the master. Workers find it via their
+# 'artifact_store_url' property (see slaves.py) and authenticate with the
+# buildbot secret TOKEN_SECRET. Access times are written to the index every
+# SAVE_INTERVAL seconds.
+PORT = 8012
+DIRECTORY = "/local/hdd/buildbot/artifacts"
+MAX_SIZE = 500 * 1024 ** 3
+TOKEN_SECRET = "artifact_store_token"
+SAVE_INTERVAL = 60
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+_CHUNK_SIZE = 1 << 20
+
+# Deltas are made with 'zstd --patch-from', which finds the matching parts
+# of the two versions with a rolling hash over a window that spans both
+# files. Its window is limited to 2 GiB, larger artifacts are always sent
+# in full.
+ZSTD = "zstd"
+DELTA_MAX_SIZE = 2 * 1024 ** 3 - 1
+
+
+class ArtifactStorage(object):
+    """
+    Content-addressed artifact store with LRU eviction under a size cap.
+
+    Artifacts are stored once per sha256 digest. The index keeps the size,
+    the builder and revision that produced an artifact and the time of its
+    last access, plus named references (usually the path an artifact was
+    uploaded to) that point to the latest digest for that name. Artifacts
+    that are still referenced are not evicted. Cached deltas count towards
+    the size cap and are evicted like artifacts; they are not in the index,
+    the modification times of their files are their access times after a
+    restart. Access times are only updated in memory; flush() writes them to
+    the index. All methods may be called from threads, but those that write
+    to disk should not be called from the reactor thread.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.objects = {}
+        self.refs = {}
+        self.deltas = {}
+        self.dirty = False
+        self.load()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest)
+
+    def delta_path(self, base, digest):
+        return os.path.join(self.directory, 'deltas', digest[:2], '{0}-{1}'.format(base, digest))
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.objects = index.get('objects', {})
+            self.refs = index.get('refs', {})
+
+        # Forget objects whose files are gone, e.g. after a crash.
+        for digest in list(self.objects):
+            if not os.path.exists(self.path(digest)):
+                del self.objects[digest]
+        self.refs = dict((name, digest) for name, digest in self.refs.items()
+                         if digest in self.objects)
+
+        delta_dir = os.path.join(self.directory, 'deltas')
+        for subdir in (os.listdir(delta_dir) if os.path.isdir(delta_dir) else []):
+            for name in os.listdir(os.path.join(delta_dir, subdir)):
+                path = os.path.join(delta_dir, subdir, name)
+                key = tuple(name.split('-'))
+                if len(key) == 2 and all(digest in self.objects for digest in key):
+                    stat = os.stat(path)
+                    self.deltas[key] = {'size': stat.st_size, 'last_access': stat.st_mtime}
+                else:
+                    # Left over from a crash or from an evicted artifact.
+                    os.remove(path)
+
+    def save(self):
+        with self.lock:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.index-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'objects': self.objects, 'refs': self.refs}, f)
+            os.rename(tmp_path, self.index_path)
+            self.dirty = False
+
+    def flush(self):
+        """Save the index if access times changed since it was saved."""
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    @property
+    def size(self):
+        return (sum(meta['size'] for meta in self.objects.values()) +
+                sum(meta['size'] for meta in self.deltas.values()))
+
+    def contains(self, digest):
+        with self.lock:
+            return digest in self.objects
+
+    def lookup(self, name):
+        with self.lock:
+            return self.refs.get(name)
+
+    def metadata(self, digest):
+        with self.lock:
+            return dict(self.objects.get(digest, {}))
+
+    def touch(self, digest):
+        with self.lock:
+            if digest in self.objects:
+                self.objects[digest]['last_access'] = time.time()
+                self.dirty = True
+
+    def add(self, fileobj, digest, builder=None, revision=None, name=None):
+        """
+        Store the contents of `fileobj` as `digest`.
+
+        Raises ValueError if the contents do not match the digest.
+        """
+        objdir = os.path.dirname(self.path(digest))
+        os.makedirs(objdir, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=objdir, prefix='.tmp-')
+        try:
+            hasher = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: fileobj.read(_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if hasher.hexdigest() != digest:
+                raise ValueError("content does not match digest {0}".format(digest))
+
+            with self.lock:
+                os.rename(tmp_path, self.path(digest))
+                now = time.time()
+                self.objects[digest] = {
+                    'size': size,
+                    'builder': builder,
+                    'revision': revision,
+                    'created': now,
+                    'last_access': now,
+                }
+                if name:
+                    self.refs[name] = digest
+                self.evict()
+                self.save()
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def set_ref(self, name, digest):
+        with self.lock:
+            if digest not in self.objects:
+                return False
+            self.refs[name] = digest
+            self.objects[digest]['last_access'] = time.time()
+            self.save()
+            return True
+
+    def remove_ref(self, name):
+        """Remove the reference `name`, which makes its artifact evictable."""
+        with self.lock:
+            if self.refs.pop(name, None) is not None:
+                self.save()
+
+    def evict(self):
+        with self.lock:
+            referenced = set(self.refs.values())
+            size = self.size
+            candidates = sorted(
+                [(meta['last_access'], 1, digest) for digest, meta in self.objects.items()
+                 if digest not in referenced] +
+                [(meta['last_access'], 0, key) for key, meta in self.deltas.items()])
+            for _, is_object, entry in candidates:
+                if size <= self.max_size:
+                    break
+                if not is_object:
+                    if entry in self.deltas:
+                        size -= self.remove_delta(entry)
+                    continue
+                size -= self.objects.pop(entry)['size']
+                try:
+                    os.remove(self.path(entry))
+                except OSError:
+                    pass
+                size -= self.remove_deltas(entry)
+            if size > self.max_size:
+                log.msg("artifact store: {0} bytes of referenced artifacts exceed the "
+                        "quota of {1} bytes".format(size, self.max_size))
+
+    def remove_delta(self, key):
+        """Remove the cached delta `key` (base, digest) and return its size."""
+        with self.lock:
+            try:
+                os.remove(self.delta_path(*key))
+            except OSError:
+                pass
+            return self.deltas.pop(key)['size']
+
+    def remove_deltas(self, digest):
+        """Remove the cached deltas from and to `digest` and return their size."""
+        with self.lock:
+            return sum(self.remove_delta(key) for key in list(self.deltas) if digest in key)
+
+    def delta(self, base, digest):
+        """
+        Path of a delta that turns artifact `base` into artifact `digest`.
+
+        Returns None if there is no useful delta, because one of the
+        artifacts is missing or too large, zstd is not available or the delta
+        would not be smaller than the artifact itself.
+        """
+        if not (self.contains(base) and self.contains(digest)):
+            return None
+        size = self.metadata(digest)['size']
+        if max(size, self.metadata(base)['size']) > DELTA_MAX_SIZE:
+            return None
+
+        key = (base, digest)
+        path = self.delta_path(base, digest)
+        with self.lock:
+            cached = self.deltas.get(key)
+            if cached is not None:
+                cached['last_access'] = time.time()
+        if cached is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{0}.tmp-{1}'.format(path, threading.current_thread().ident)
+            try:
+                subprocess.check_call([ZSTD, '-q', '-f', '-T0', '--long=31',
+                                       '--patch-from=' + self.path(base),
+                                       self.path(digest), '-o', tmp_path])
+                os.rename(tmp_path, path)
+            except (OSError, subprocess.CalledProcessError) as e:
+                log.msg("artifact store: no delta from {0} to {1}: {2}".format(base, digest, e))
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                return None
+            with self.lock:
+                cached = self.deltas[key] = {'size': os.path.getsize(path),
+                                             'last_access': time.time()}
+                self.evict()
+                if key not in self.deltas:
+                    return None
+
+        if cached['size'] >= size:
+            return None
+        self.touch(digest)
+        return path
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'objects': len(self.objects),
+                'refs': len(self.refs),
+                'deltas': len(self.deltas),
+                'size': self.size,
+                'max_size': self.max_size,
+            }
+
+
+class ArtifactResource(resource.Resource):
+    """
+    HTTP interface of the artifact store for the workers.
+
+     - GET/HEAD '/objects/<digest>' downloads an artifact,
+     - PUT '/objects/<digest>' uploads one; the headers 'X-Artifact-Builder',
+       'X-Artifact-Revision' and 'X-Artifact-Ref' set its metadata,
+     - GET '/deltas/<base>/<digest>' downloads a delta (see
+       ArtifactStorage.delta) that turns artifact <base> into <digest>, or
+       returns 404 if there is none; concurrent requests for the same delta
+       wait for a single build of it,
+     - GET '/refs/<name>' returns the digest that <name> points to,
+     - PUT '/refs/<name>' points <name> to the digest in the request body,
+     - GET '/_stats' returns the statistics of the store as JSON.
+    Requests without the token (see polyjit.buildbot.tokenauth) are
+    rejected.
+    """
+
+    isLeaf = True
+
+    def __init__(self, storage, token):
+        resource.Resource.__init__(self)
+        self.storage = storage
+        self.token = token
+        self.pending_deltas = {}
+
+    def render(self, request):
+        if not tokenauth.authorized(request, self.token):
+            return tokenauth.deny(request, 'artifacts')
+        return resource.Resource.render(self, request)
+
+    def parse(self, request):
+        segments = [bytes2unicode(s) for s in request.postpath]
+        if not segments:
+            return None, None
+        return segments[0], '/'.join(segments[1:])
+
+    def header(self, request, name):
+        value = request.getHeader(name)
+        return bytes2unicode(value) if value is not None else None
+
+    def render_GET(self, request):
+        kind, name = self.parse(request)
+        if kind == '_stats':
+            request.setHeader(b'content-type', b'application/json')
+            return unicode2bytes(json.dumps(self.storage.getStats()))
+
+        if kind == 'refs':
+            digest = self.storage.lookup(name)
+            if digest is None:
+                request.setResponseCode(404)
+                return b''
+            request.setHeader(b'content-type', b'text/plain')
+            return unicode2bytes(digest)
+
+        if kind == 'deltas':
+            return self.render_delta(request, name)
+
+        if kind == 'objects' and _DIGEST_RE.match(name) and self.storage.contains(name):
+            self.storage.touch(name)
+            return static.File(self.storage.path(name),
+                               defaultType='application/octet-stream').render(request)
+
+        request.setResponseCode(404)
+        return b''
+
+    def render_delta(self, request, name):
+        digests = name.split('/')
+        if len(digests) != 2 or not all(_DIGEST_RE.match(d) for d in digests):
+            request.setResponseCode(400)
+            return b''
+
+        d = self.delta(digests[0], digests[1])
+
+        @d.addCallback
+        def send(path):
+            if path is None:
+                request.setResponseCode(404)
+                request.finish()
+                return
+            body = static.File(path, defaultType='application/octet-stream').render(request)
+            if body != server.NOT_DONE_YET:
+                request.write(body)
+                request.finish()
+
+        @d.addErrback
+        def failed(failure):
+            log.err(failure, "while making delta {0}".format(name))
+            request.setResponseCode(500)
+            request.finish()
+
+        return server.NOT_DONE_YET
+
+    def delta(self, base, digest):
+        """
+        Deferred path of the delta from `base` to `digest`, or None.
+
+        Making a delta takes a while, so it runs in a thread, and only once
+        for all requests that ask for it while it runs.
+        """
+        key = (base, digest)
+        waiter = defer.Deferred()
+        if key in self.pending_deltas:
+            self.pending_deltas[key].append(waiter)
+            return waiter
+        self.pending_deltas[key] = [waiter]
+
+        d = threads.deferToThread(self.storage.delta, base, digest)
+
+        @d.addBoth
+        def notify(result):
+            for w in self.pending_deltas.pop(key):
+                if isinstance(result, failure.Failure):
+                    w.errback(result)
+                else:
+                    w.callback(result)
+        return waiter
+
+    def render_HEAD(self, request):
+        kind, name = self.parse(request)
+        if kind != 'objects' or not self.storage.contains(name):
+            request.setResponseCode(404)
+        return b''
+
+    def render_PUT(self, request):
+        kind, name = self.parse(request)
+        if kind == 'refs' and name:
+            digest = bytes2unicode(request.content.read()).strip()
+            d = threads.deferToThread(self.storage.set_ref, name, digest)
+            d.addCallback(lambda found: 200 if found else 404)
+            return self.respond(request, d, "while setting reference {0}".format(name))
+
+        if kind != 'objects' or not _DIGEST_RE.match(name):
+            request.setResponseCode(400)
+            return b''
+
+        if self.storage.contains(name):
+            ref = self.header(request, 'X-Artifact-Ref')
+            if not ref:
+                return b''
+            d = threads.deferToThread(self.storage.set_ref, ref, name)
+            d.addCallback(lambda _: 200)
+            return self.respond(request, d, "while setting reference {0}".format(ref))
+
+        request.content.seek(0)
+        d = threads.deferToThread(self.storage.add, request.content, name,
+                                  builder=self.header(request, 'X-Artifact-Builder'),
+                                  revision=self.header(request, 'X-Artifact-Revision'),
+                                  name=self.header(request, 'X-Artifact-Ref'))
+        d.addCallback(lambda _: 201)
+        return self.respond(request, d, "while storing artifact {0}".format(name))
+
+    def respond(self, request, d, what):
+        """
+        Finish `request` with the response code that `d` fires with.
+
+        The storage writes its index on changes, so these run in a thread.
+        """
+        @d.addCallback
+        def done(code):
+            request.setResponseCode(code)
+            request.finish()
+
+        @d.addErrback
+        def failed(failure):
+            if failure.check(ValueError):
+                request.setResponseCode(422)
+            else:
+                log.err(failure, what)
+                request.setResponseCode(500)
+            request.finish()
+
+        return server.NOT_DONE_YET
+
+
+class ArtifactServer(service.BuildbotService):
+    """Serve the content-addressed artifact store from the buildbot master."""
+
+    name = 'artifact-store'
+    secrets = ['token']
+
+    def checkConfig(self, token=None, port=PORT, directory=DIRECTORY, max_size=MAX_SIZE,
+                    **kwargs):
+        if token is None:
+            config.error("the artifact store needs a token")
+        service.BuildbotService.checkConfig(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def reconfigService(self, token=None, port=PORT, directory=DIRECTORY, max_size=MAX_SIZE,
+                        **kwargs):
+        yield service.BuildbotService.reconfigService(self, **kwargs)
+        yield self.stopListening()
+
+        self.storage = yield threads.deferToThread(ArtifactStorage, directory, max_size)
+        site = server.Site(ArtifactResource(self.storage, token))
+        self.listening_port = reactor.listenTCP(port, site)
+        self.saver = task.LoopingCall(self.flush)
+        self.saver.start(SAVE_INTERVAL, now=False)
+        log.msg("artifact store listening on port {0}, serving {1}".format(port, directory))
+
+    def flush(self):
+        d = threads.deferToThread(self.storage.flush)
+        d.addErrback(log.err, "while saving the artifact store index")
+        return d
+
+    @defer.inlineCallbacks
+    def stopListening(self):
+        saver = getattr(self, 'saver', None)
+        if saver is not None:
+            self.saver = None
+            saver.stop()
+            yield self.flush()
+        listening_port = getattr(self, 'listening_port', None)
+        if listening_port is not None:
+            self.listening_port = None
+            yield listening_port.stopListening()
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield self.stopListening()
+        yield service.BuildbotService.stopService(self)
+
+
+def configure(c):
+    """Serve the store; the master needs a secrets provider with TOKEN_SECRET."""
+    c.setdefault('services', []).append(ArtifactServer(token=Secret(TOKEN_SECRET)))
@@ -1,4 +1,5 @@
-__all__ = ["vara_master_dev", "vara_master_opt", "vara_feature_dev", "vara_feature_opt", "vara_phasar_master_dev"]
+__all__ = ["vara_master_dev", "vara_master_opt", "vara_feature_dev", "vara_feature_opt", "vara_phasar_master_dev",
+           "git_mirrors"]
 __ALL__ = []
 
 
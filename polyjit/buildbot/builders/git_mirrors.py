@@ -0,0 +1,51 @@
+import sys
+
+from polyjit.buildbot.builders import register
+from polyjit.buildbot import slaves
+from polyjit.buildbot.utils import builder, s_nightly, s_force, update_git_mirrors
+from polyjit.buildbot.repos import codebases, clone_url
+from buildbot.plugins import util
+
+################################################################################
+# Keeps the shared git mirrors of every worker (see utils.update_git_mirrors)
+# up to date. There is one builder per worker, because each worker has its
+# own mirrors.
+################################################################################
+
+PROJECT_NAME = 'git-mirrors'
+# Hours of the day at which the mirrors are updated.
+UPDATE_HOURS = list(range(0, 24, 2))
+
+ACCEPTED_BUILDERS = slaves.get_hostlist(slaves.infosun,
+                                        predicate=lambda host: 'git_mirror_dir' in
+                                        host.get('properties', {}))
+
+
+def builder_name(host):
+    return '{0}-{1}'.format(PROJECT_NAME, host)
+
+
+# yapf: disable
+def configure(c):
+    f = util.BuildFactory()
+    f.addStep(update_git_mirrors(dict((repo, clone_url(repo)) for repo in codebases),
+                                 fetch=True))
+
+    for host in ACCEPTED_BUILDERS:
+        c['builders'].append(builder(builder_name(host), None, [host], tags=['git-mirrors'],
+                                     factory=f))
+
+def schedule(c):
+    builders = [builder_name(host) for host in ACCEPTED_BUILDERS]
+    if not builders:
+        return
+
+    c['schedulers'].extend([
+        s_nightly('update-' + PROJECT_NAME, {'': {}}, builders,
+                  hour=UPDATE_HOURS, minute=0),
+        s_force('force-update-' + PROJECT_NAME, [''], builders),
+    ])
+# yapf: enable
+
+
+register(sys.modules[__name__])
@@ -6,10 +6,23 @@ from twisted.internet import defer
 
 from polyjit.buildbot.builders import register
 from polyjit.buildbot import slaves
-from polyjit.buildbot.utils import (builder, define, git, ucmd, ucompile, cmd,
+from polyjit.buildbot.utils import (builder, define, git, ucmd, ucompile, cmd, cmddef,
                                     upload_file, ip, s_sbranch, s_abranch,
-                                    s_nightly, s_force, s_trigger)
-from polyjit.buildbot.repos import make_git_cb, make_force_cb, codebases
+                                    s_nightly, s_force, s_trigger,
+                                    usession_start, usession_stop, ccache_stats, ccache_launcher,
+                                    parallel_jobs, load_limit, LLVM_PARALLEL_LINK_JOBS, lit_opts,
+                                    download_script, uscript, extract_json, ucmddef,
+                                    extract_lit_selection, has_selected_tests,
+                                    lit_stamp, keep_lit_stamp, LIT_STAMP, LIT_CANDIDATE,
+                                    trigger, lit_shard_dir, lit_shard_scheduler_names,
+                                    lit_shard_schedulers, publish_lit_tree, unpack_lit_tree,
+                                    lit_command, lit_shard_opts, clean_lit_tree, LitShardCleanup,
+                                    upload_lit_results, LitShardResults, LIT_SHARD_RESULTS,
+                                    SourceFileWarningFilter, get_build_results,
+                                    git_mirror, update_git_mirrors, MultiGit,
+                                    cancel_superseded,
+                                    important_files, DOCUMENTATION_FILES, s_coalesce)
+from polyjit.buildbot.repos import make_git_cb, make_force_cb, codebases, clone_url, clone_options
 from buildbot.plugins import util, steps
 from buildbot.changes import filter
 from buildbot.process import buildstep, logobserver
@@ -73,17 +86,24 @@ P = util.Property
 
 ACCEPTED_BUILDERS = slaves.get_hostlist(slaves.infosun, predicate=lambda host: host["host"] in {'bayreuther01', 'bayreuther02'})
 
+# The regression tests can be split into shards, which run in parallel on
+# the ACCEPTED_BUILDERS, e.g. with LIT_SHARDS = len(ACCEPTED_BUILDERS). The
+# shards get the test tree through the artifact store, so they only run if
+# slaves.ARTIFACT_STORE_URL is set. Otherwise check-vara runs in the build
+# itself.
+LIT_SHARDS = 1
+SHARD_LIT_TESTS = LIT_SHARDS > 1 and bool(slaves.ARTIFACT_STORE_URL)
+LIT_PROJECT_NAME = PROJECT_NAME + '-lit'
+# Parts of the tree (relative to CHECKOUT_BASE_DIR) that the tests need.
+LIT_TREE_PATHS = [BUILD_SUBDIR[1:] + '/bin', BUILD_SUBDIR[1:] + '/lib',
+                  BUILD_SUBDIR[1:] + '/tools/VaRA', 'utils/lit', 'tools/VaRA/test']
+
 def trigger_branch_match(branch):
     pattern = re.compile(TRIGGER_BRANCH_REGEX)
     return pattern.match(branch)
 
 @util.renderer
-@defer.inlineCallbacks
 def get_vara_feature_dev_results(props):
-    all_logs = []
-    master = props.master
-    buildsteps = yield props.master.data.get(('builders', props.getProperty('buildername'),
-                                              'builds', props.getProperty('buildnumber'), 'steps'))
     pr_comment_steps = {
         r'^cmake$': {'full_report': True},
         r'^build VaRA$': {'full_report': True},
@@ -91,33 +111,8 @@ def get_vara_feature_dev_results(props):
         r'^run Clang-Tidy$': {'full_report': True},
         r'^run ClangFormat(?: \(version \S+\))?$': {'full_report': True},
     }
-    all_logs.append('### dev build result')
-    for step in buildsteps:
-        step_options = next((v for k, v in pr_comment_steps.items() if re.match(k, step['name'])), None)
-        if step_options is not None:
-            logs = yield master.data.get(("steps", step['stepid'], 'logs'))
-            if logs is not None:
-                log = logs[-1]
-                if util.Results[step['results']] == 'success':
-                    all_logs.append(':heavy_check_mark: Step : {0} Result : {1}'.format(
-                        step['name'], util.Results[step['results']]))
-                else:
-                    all_logs.append(':boom: Step : {0} Result : {1}'.format(
-                        step['name'], util.Results[step['results']]))
-                    if step_options['full_report']:
-                        all_logs.append('<details><summary>Click to show details</summary>\n')
-                        all_logs.append('```')
-                        log['stepname'] = step['name']
-                        log['content'] = yield master.data.get(("logs", log['logid'], 'contents'))
-                        step_logs = log['content']['content'].split('\n')
-                        for i, sl in enumerate(step_logs):
-                            if util.Results[step['results']] != 'warnings':
-                                sl = sl[1:]
-                            all_logs.append(sl)
-                        all_logs.append('```\n')
-                        all_logs.append('</details>\n')
-
-    defer.returnValue('\n'.join(all_logs))
+    return get_build_results(props, '### dev build result', pr_comment_steps,
+                             strip_warnings_prefix=False)
 
 class GenerateMakeCleanCommand(buildstep.ShellMixin, steps.BuildStep):
 
@@ -138,7 +133,6 @@ class GenerateMakeCleanCommand(buildstep.ShellMixin, steps.BuildStep):
             force_build_clean = options['force_build_clean']
 
         if force_build_clean:
-            self.build.addStepsAfterCurrentStep(get_uchroot_workaround_steps())
             self.build.addStepsAfterCurrentStep([
                 define('FORCE_BUILD_CLEAN', 'true'),
                 ucompile('ninja', 'clean', name='clean build dir',
@@ -171,40 +165,32 @@ class GenerateGitCloneCommand(buildstep.ShellMixin, steps.BuildStep):
 
         for repo in REPOS:
             buildsteps.append(define(str(repo).upper() +'_ROOT', ip(REPOS[repo]['checkout_dir'])))
+        # Clones borrow their objects from the shared mirrors of the worker.
+        buildsteps.append(update_git_mirrors(dict((repo, clone_url(repo)) for repo in REPOS),
+                                             fetch=False))
 
         if force_complete_rebuild:
             buildsteps.append(define('FORCE_COMPLETE_REBUILD', 'true'))
             buildsteps.append(steps.ShellCommand(name='Delete old build directory',
                                                  command=['rm', '-rf', 'build'],
                                                  workdir=ip(CHECKOUT_BASE_DIR)))
-
-            for repo in REPOS:
-                if 'repository_clone_url' in codebases[repo].keys():
-                    url = codebases[repo]['repository_clone_url']
-                else:
-                    url = codebases[repo]['repository']
-                branch = REPOS[repo]['default_branch']
-
-                buildsteps.append(steps.Git(repourl=url, branch=branch, codebase=repo,
-                                            name="checkout: {0}".format(url),
-                                            description="checkout: {0}@{1}".format(url, branch),
-                                            timeout=1200, progress=True, submodules=True,
-                                            workdir=P(str(repo).upper()+'_ROOT'),
-                                            mode='full', method='clobber'))
         else:
             self.build.addStepsAfterCurrentStep([define('FORCE_COMPLETE_REBUILD', 'false')])
-            for repo in REPOS:
-                if 'repository_clone_url' in codebases[repo].keys():
-                    url = codebases[repo]['repository_clone_url']
-                else:
-                    url = codebases[repo]['repository']
-                branch = REPOS[repo]['default_branch']
-
-                buildsteps.append(steps.Git(repourl=url, branch=branch, codebase=repo,
-                                            name="checkout: {0}".format(url),
-                                            description="checkout: {0}@{1}".format(url, branch),
-                                            timeout=1200, progress=True, submodules=True,
-                                            workdir=P(str(repo).upper()+'_ROOT')))
+
+        # All repositories are fetched concurrently in a single step.
+        checkouts = []
+        for repo in REPOS:
+            checkout = {
+                'codebase': repo,
+                'repourl': clone_url(repo),
+                'branch': REPOS[repo]['default_branch'],
+                'workdir': P(str(repo).upper()+'_ROOT'),
+                'reference': git_mirror(repo),
+            }
+            checkout.update(clone_options(repo))
+            checkouts.append(checkout)
+        buildsteps.append(MultiGit(checkouts, clobber=bool(force_complete_rebuild),
+                                   name='checkout', haltOnFailure=True))
 
         buildsteps.append(steps.ShellCommand(name='Create build directory',
                                              command=['mkdir', '-p', 'build'],
@@ -283,19 +269,19 @@ class GenerateBuildStepCommand(buildstep.ShellMixin, steps.BuildStep):
         result = command.results()
         if result == util.SUCCESS:
             vara_files = self.observer.getStdout().strip().splitlines()
-            match_lines = []
-            for line in vara_files:
-                match_lines.append('.*' + re.escape(line) + '.*warning[: ].*')
-            # join all alternatives together and create pattern object
-            pattern = re.compile('|'.join(match_lines))
+            pattern = SourceFileWarningFilter(vara_files)
 
             buildsteps = []
-            for step in get_uchroot_workaround_steps():
-                buildsteps.append(step)
-            buildsteps.append(ucompile('ninja', haltOnFailure=True, warnOnWarnings=True,
+            # Marks the start of the build for the regression test selection.
+            buildsteps.append(lit_stamp(ip(BUILD_DIR)))
+            buildsteps.append(ccache_stats(name='ccache statistics before build',
+                                           hideStepIf=True))
+            buildsteps.append(ucompile('ninja', '-j', parallel_jobs, '-l', load_limit,
+                                       haltOnFailure=True, warnOnWarnings=True,
                                        name='build VaRA',
                                        warningPattern=pattern,
-                                       workdir=UCHROOT_BUILD_DIR))
+                                       workdir=UCHROOT_BUILD_DIR, ccache=True))
+            buildsteps.append(ccache_stats(name='ccache statistics', alwaysRun=True))
 
             self.build.addStepsAfterCurrentStep(buildsteps)
 
@@ -320,14 +306,25 @@ class GenerateClangFormatStepCommand(buildstep.ShellMixin, steps.BuildStep):
             clang_format_version = self.observer.getStdout().strip().split(' ')[2]
             step_name = 'run ClangFormat (version ' + clang_format_version + ')'
 
+            # Only check the lines changed by the feature branch.
             buildsteps = []
-            for step in get_uchroot_workaround_steps():
-                buildsteps.append(step)
-            buildsteps.append(ucompile('bash', 'bb-clang-format.sh', '--all', '--line-numbers',
-                                       '--cf-binary', '/opt/clang-format-static/clang-format',
-                                       workdir='vara-llvm/tools/VaRA/utils/buildbot',
+            buildsteps.append(download_script('clang_format_diff.py'))
+            # Never report the summary of an earlier build.
+            buildsteps.append(cmd('rm', '-f', 'clang-format-violations.json',
+                                  workdir=ip('%(prop:builddir)s'),
+                                  hideStepIf=True))
+            buildsteps.append(ucompile('python3', uscript('clang_format_diff.py'),
+                                       '--repo', UCHROOT_SRC_ROOT + REPOS['vara']['checkout_subdir'],
+                                       '--base', 'origin/' + REPOS['vara']['default_branch'],
+                                       '--clang-format', '/opt/clang-format-static/clang-format',
+                                       '--json', '/mnt/clang-format-violations.json',
                                        name=step_name,
                                        haltOnFailure=False, warnOnWarnings=True))
+            # The violations themselves are in the log of the ClangFormat step.
+            buildsteps.append(cmddef(command=['cat', 'clang-format-violations.json'],
+                                     workdir=ip('%(prop:builddir)s'),
+                                     extract_fn=extract_json('clang_format_summary'),
+                                     hideStepIf=True, alwaysRun=True))
 
             self.build.addStepsAfterCurrentStep(buildsteps)
 
@@ -374,15 +371,6 @@ class GenerateMergecheckCommand(buildstep.ShellMixin, steps.BuildStep):
             defer.returnValue(result)
 
 
-def get_uchroot_workaround_steps():
-    workaround_steps = []
-    workaround_steps.append(ucompile('true', name='uchroot /proc bug workaround', hideStepIf=True,
-                                     haltOnFailure=False, flunkOnWarnings=False,
-                                     flunkOnFailure=False, warnOnWarnings=False,
-                                     warnOnFailure=False))
-    workaround_steps.append(cmd("sleep 1", hideStepIf=True))
-    return workaround_steps
-
 # yapf: disable
 def configure(c):
     f = util.BuildFactory()
@@ -400,14 +388,23 @@ def configure(c):
         command=['./tools/VaRA/utils/buildbot/bb-get-branches.sh'], workdir=ip(CHECKOUT_BASE_DIR),
         haltOnFailure=True, hideStepIf=True))
 
+    f.addStep(usession_start(ccache=True))
+
+    # ClangFormat (runs before the build, so format failures are reported early)
+    f.addStep(GenerateClangFormatStepCommand(name="Dummy_4",
+                                             command=['opt/clang-format-static/clang-format',
+                                                      '-version'],
+                                             workdir=ip('%(prop:uchroot_image_path)s'),
+                                             haltOnFailure=True, hideStepIf=True))
+
     # CMake
-    for step in get_uchroot_workaround_steps():
-        f.addStep(step)
     f.addStep(ucompile('../tools/VaRA/utils/vara/builds/' + BUILD_SCRIPT,
+                       BUILD_SUBDIR.rsplit('/', 1)[-1], LLVM_PARALLEL_LINK_JOBS,
                        env={'PATH': '/opt/cmake/bin:/usr/local/bin:/usr/bin:/bin'},
                        name='cmake',
                        description=BUILD_SCRIPT,
-                       workdir=UCHROOT_SRC_ROOT + '/build'))
+                       workdir=UCHROOT_SRC_ROOT + '/build', ccache=True))
+    f.addStep(ccache_launcher(UCHROOT_BUILD_DIR))
 
     f.addStep(GenerateMakeCleanCommand(name="Dummy_2", command=['true'],
                                        haltOnFailure=True, hideStepIf=True))
@@ -439,31 +436,88 @@ def configure(c):
                                        workdir=ip(BUILD_DIR),
                                        haltOnFailure=True, hideStepIf=True))
 
-    # Regression Test step
-    for step in get_uchroot_workaround_steps():
-        f.addStep(step)
-    f.addStep(ucompile('ninja', 'check-vara', name='run VaRA regression tests',
-                       workdir=UCHROOT_BUILD_DIR,
-                       haltOnFailure=False, warnOnWarnings=True))
-
-    # Clang-Tidy
-    for step in get_uchroot_workaround_steps():
-        f.addStep(step)
-    f.addStep(ucompile('python3', 'tidy-vara.py', '-p', UCHROOT_BUILD_DIR, '-j', '8', '--gcc',
-                       workdir='vara-llvm/tools/VaRA/test/', name='run Clang-Tidy',
+    # Regression Test step (only the tests affected by this build)
+    f.addStep(download_script('select_lit_tests.py'))
+    f.addStep(ucmddef('python3', uscript('select_lit_tests.py'),
+                      '--build-dir', UCHROOT_BUILD_DIR,
+                      '--repo', UCHROOT_SRC_ROOT + REPOS['vara']['checkout_subdir'],
+                      '--base', 'origin/' + REPOS['vara']['default_branch'],
+                      '--test-dir', UCHROOT_SRC_ROOT + REPOS['vara']['checkout_subdir'] + '/test',
+                      '--unittest-dir', 'tools/VaRA/unittests',
+                      '--stamp', UCHROOT_BUILD_DIR + '/' + LIT_STAMP,
+                      '--verified', UCHROOT_BUILD_DIR + '/' + LIT_CANDIDATE,
+                      extract_fn=extract_lit_selection,
+                      name='select VaRA regression tests', hideStepIf=True,
+                      haltOnFailure=False, flunkOnFailure=False))
+    if SHARD_LIT_TESTS:
+        f.addStep(lit_command('check-vara', workdir=UCHROOT_BUILD_DIR,
+                              doStepIf=has_selected_tests))
+        for step in publish_lit_tree(ip(CHECKOUT_BASE_DIR), LIT_TREE_PATHS,
+                                     doStepIf=has_selected_tests):
+            f.addStep(step)
+        f.addStep(trigger(schedulerNames=lit_shard_scheduler_names('trigger-' + LIT_PROJECT_NAME,
+                                                                   LIT_SHARDS),
+                          set_properties={'lit_shard_dir': lit_shard_dir,
+                                          'lit_command': P('lit_command'),
+                                          'lit_filter': P('lit_filter', default='')},
+                          waitForFinish=True,
+                          name='run VaRA regression test shards',
+                          doStepIf=has_selected_tests,
+                          haltOnFailure=False, flunkOnFailure=False, warnOnFailure=True))
+        f.addStep(LitShardResults(LIT_SHARDS, name='run VaRA regression tests',
+                                  doStepIf=has_selected_tests, alwaysRun=True))
+        f.addStep(LitShardCleanup())
+    else:
+        f.addStep(ucompile('ninja', '-j', parallel_jobs, '-l', load_limit, 'check-vara',
+                           name='run VaRA regression tests',
+                           env={'LIT_OPTS': lit_opts,
+                                'LIT_FILTER': P('lit_filter', default='')},
+                           workdir=UCHROOT_BUILD_DIR, ccache=True,
+                           doStepIf=has_selected_tests,
+                           haltOnFailure=False, warnOnWarnings=True))
+
+    f.addStep(keep_lit_stamp(ip(BUILD_DIR), 'run VaRA regression tests'))
+
+    # Clang-Tidy (only on translation units affected by the feature branch)
+    f.addStep(download_script('incremental_tidy.py'))
+    f.addStep(ucompile('python3', uscript('incremental_tidy.py'), '-p', UCHROOT_BUILD_DIR,
+                       '--repo', UCHROOT_SRC_ROOT + REPOS['vara']['checkout_subdir'],
+                       '--base', 'origin/' + REPOS['vara']['default_branch'],
+                       '--cache-dir', '/mnt/tidy-cache',
+                       '--tidy-script',
+                       UCHROOT_SRC_ROOT + REPOS['vara']['checkout_subdir'] + '/test/tidy-vara.py',
+                       '--tidy-arg=--gcc',
+                       '-j', parallel_jobs,
+                       name='run Clang-Tidy',
                        haltOnFailure=False, warnOnWarnings=True,
                        timeout=3600))
 
-    # ClangFormat
-    f.addStep(GenerateClangFormatStepCommand(name="Dummy_4",
-                                             command=['opt/clang-format-static/clang-format',
-                                                      '-version'],
-                                             workdir=ip('%(prop:uchroot_image_path)s'),
-                                             haltOnFailure=True, hideStepIf=True))
+    f.addStep(usession_stop())
 
     c['builders'].append(builder(PROJECT_NAME, None, ACCEPTED_BUILDERS, tags=['vara'],
                                  factory=f))
 
+    if SHARD_LIT_TESTS:
+        # Runs one shard of the regression tests of a build of PROJECT_NAME
+        t = util.BuildFactory()
+        for step in unpack_lit_tree(ip(CHECKOUT_BASE_DIR)):
+            t.addStep(step)
+        t.addStep(usession_start())
+        t.addStep(ucompile('sh', '-c', P('lit_command'),
+                           env={'LIT_OPTS': lit_shard_opts,
+                                'LIT_FILTER': P('lit_filter', default='')},
+                           name=ip('run VaRA regression tests '
+                                   '(shard %(prop:lit_shard)s of %(prop:lit_shards)s)'),
+                           workdir=UCHROOT_BUILD_DIR,
+                           haltOnFailure=False, warnOnWarnings=True))
+        t.addStep(usession_stop())
+        t.addStep(upload_lit_results(ip('%(prop:builddir)s/' + LIT_SHARD_RESULTS)))
+        for step in clean_lit_tree(ip(CHECKOUT_BASE_DIR)):
+            t.addStep(step)
+
+        c['builders'].append(builder(LIT_PROJECT_NAME, None, ACCEPTED_BUILDERS, tags=['vara'],
+                                     factory=t))
+
 def schedule(c):
     force_sched = s_force(
         name="force-build-" + PROJECT_NAME,
@@ -483,12 +537,20 @@ def schedule(c):
     )
 
     c['schedulers'].extend([
-        s_abranch(PROJECT_NAME + '-sched', CODEBASE, [PROJECT_NAME],
-                  change_filter=util.ChangeFilter(branch_fn=trigger_branch_match),
-                  treeStableTimer=5 * 60),
+        # Pushes of a feature to several repositories are built together.
+        s_coalesce(PROJECT_NAME + '-sched', CODEBASE, [PROJECT_NAME],
+                   change_filter=util.ChangeFilter(branch_fn=trigger_branch_match),
+                   fileIsImportant=important_files(exclude=DOCUMENTATION_FILES),
+                   minDelay=30, maxDelay=5 * 60),
         force_sched,
         s_trigger('trigger-' + PROJECT_NAME, CODEBASE, [PROJECT_NAME]),
     ])
+    # A new push to a pull request makes the builds of its older head useless.
+    c.setdefault('services', []).append(
+        cancel_superseded(PROJECT_NAME + '-cancel-superseded', [PROJECT_NAME]))
+    if SHARD_LIT_TESTS:
+        c['schedulers'].extend(lit_shard_schedulers('trigger-' + LIT_PROJECT_NAME, CODEBASE,
+                                                    [LIT_PROJECT_NAME], LIT_SHARDS))
 # yapf: enable
 
 
@@ -8,8 +8,14 @@ from polyjit.buildbot.builders import register
 from polyjit.buildbot import slaves
 from polyjit.buildbot.utils import (builder, define, git, ucmd, ucompile, cmd,
                                     upload_file, ip, s_sbranch, s_abranch,
-                                    s_nightly, s_force, s_trigger)
-from polyjit.buildbot.repos import make_git_cb, make_force_cb, codebases
+                                    s_nightly, s_force, s_trigger,
+                                    usession_start, usession_stop, ccache_stats, ccache_launcher,
+                                    parallel_jobs, load_limit, LLVM_PARALLEL_LINK_JOBS, lit_opts,
+                                    SourceFileWarningFilter,
+                                    git_mirror, update_git_mirrors, MultiGit,
+                                    important_files, DOCUMENTATION_FILES,
+                                    s_coalesce)
+from polyjit.buildbot.repos import make_git_cb, make_force_cb, codebases, clone_url, clone_options
 from buildbot.plugins import util, steps
 from buildbot.changes import filter
 from buildbot.process import buildstep, logobserver
@@ -96,7 +102,6 @@ class GenerateMakeCleanCommand(buildstep.ShellMixin, steps.BuildStep):
             force_build_clean = options['force_build_clean']
 
         if force_build_clean:
-            self.build.addStepsAfterCurrentStep(get_uchroot_workaround_steps())
             self.build.addStepsAfterCurrentStep([
                 define('FORCE_BUILD_CLEAN', 'true'),
                 ucompile('ninja', 'clean', name='clean build dir',
@@ -129,40 +134,32 @@ class GenerateGitCloneCommand(buildstep.ShellMixin, steps.BuildStep):
 
         for repo in REPOS:
             buildsteps.append(define(str(repo).upper() +'_ROOT', ip(REPOS[repo]['checkout_dir'])))
+        # Clones borrow their objects from the shared mirrors of the worker.
+        buildsteps.append(update_git_mirrors(dict((repo, clone_url(repo)) for repo in REPOS),
+                                             fetch=False))
 
         if force_complete_rebuild:
             buildsteps.append(define('FORCE_COMPLETE_REBUILD', 'true'))
             buildsteps.append(steps.ShellCommand(name='Delete old build directory',
                                                  command=['rm', '-rf', 'build'],
                                                  workdir=ip(CHECKOUT_BASE_DIR)))
-
-            for repo in REPOS:
-                if 'repository_clone_url' in codebases[repo].keys():
-                    url = codebases[repo]['repository_clone_url']
-                else:
-                    url = codebases[repo]['repository']
-                branch = REPOS[repo]['default_branch']
-
-                buildsteps.append(steps.Git(repourl=url, branch=branch, codebase=repo,
-                                            name="checkout: {0}".format(url),
-                                            description="checkout: {0}@{1}".format(url, branch),
-                                            timeout=1200, progress=True, submodules=True,
-                                            workdir=P(str(repo).upper()+'_ROOT'),
-                                            mode='full', method='clobber'))
         else:
             self.build.addStepsAfterCurrentStep([define('FORCE_COMPLETE_REBUILD', 'false')])
-            for repo in REPOS:
-                if 'repository_clone_url' in codebases[repo].keys():
-                    url = codebases[repo]['repository_clone_url']
-                else:
-                    url = codebases[repo]['repository']
-                branch = REPOS[repo]['default_branch']
-
-                buildsteps.append(steps.Git(repourl=url, branch=branch, codebase=repo,
-                                            name="checkout: {0}".format(url),
-                                            description="checkout: {0}@{1}".format(url, branch),
-                                            timeout=1200, progress=True, submodules=True,
-                                            workdir=P(str(repo).upper()+'_ROOT')))
+
+        # All repositories are fetched concurrently in a single step.
+        checkouts = []
+        for repo in REPOS:
+            checkout = {
+                'codebase': repo,
+                'repourl': clone_url(repo),
+                'branch': REPOS[repo]['default_branch'],
+                'workdir': P(str(repo).upper()+'_ROOT'),
+                'reference': git_mirror(repo),
+            }
+            checkout.update(clone_options(repo))
+            checkouts.append(checkout)
+        buildsteps.append(MultiGit(checkouts, clobber=bool(force_complete_rebuild),
+                                   name='checkout', haltOnFailure=True))
 
         buildsteps.append(steps.ShellCommand(name='Create build directory',
                                              command=['mkdir', '-p', 'build'],
@@ -189,19 +186,17 @@ class GenerateBuildStepCommand(buildstep.ShellMixin, steps.BuildStep):
         result = command.results()
         if result == util.SUCCESS:
             vara_files = self.observer.getStdout().strip().splitlines()
-            match_lines = []
-            for line in vara_files:
-                match_lines.append('.*' + re.escape(line) + '.*warning[: ].*')
-            # join all alternatives together and create pattern object
-            pattern = re.compile('|'.join(match_lines))
+            pattern = SourceFileWarningFilter(vara_files)
 
             buildsteps = []
-            for step in get_uchroot_workaround_steps():
-                buildsteps.append(step)
-            buildsteps.append(ucompile('ninja', haltOnFailure=True, warnOnWarnings=True,
+            buildsteps.append(ccache_stats(name='ccache statistics before build',
+                                           hideStepIf=True))
+            buildsteps.append(ucompile('ninja', '-j', parallel_jobs, '-l', load_limit,
+                                       haltOnFailure=True, warnOnWarnings=True,
                                        name='build VaRA',
                                        warningPattern=pattern,
-                                       workdir=UCHROOT_BUILD_DIR))
+                                       workdir=UCHROOT_BUILD_DIR, ccache=True))
+            buildsteps.append(ccache_stats(name='ccache statistics', alwaysRun=True))
 
             self.build.addStepsAfterCurrentStep(buildsteps)
 
@@ -227,8 +222,6 @@ class GenerateClangFormatStepCommand(buildstep.ShellMixin, steps.BuildStep):
             step_name = 'run ClangFormat (version ' + clang_format_version + ')'
 
             buildsteps = []
-            for step in get_uchroot_workaround_steps():
-                buildsteps.append(step)
             buildsteps.append(ucompile('bash', 'bb-clang-format.sh', '--all', '--line-numbers',
                                        '--cf-binary', '/opt/clang-format-static/clang-format',
                                        workdir='vara-llvm/tools/VaRA/utils/buildbot',
@@ -288,15 +281,6 @@ class GenerateMergecheckCommand(buildstep.ShellMixin, steps.BuildStep):
 
             defer.returnValue(result)
 
-def get_uchroot_workaround_steps():
-    workaround_steps = []
-    workaround_steps.append(ucompile('true', name='uchroot /proc bug workaround', hideStepIf=True,
-                                     haltOnFailure=False, flunkOnWarnings=False,
-                                     flunkOnFailure=False, warnOnWarnings=False,
-                                     warnOnFailure=False))
-    workaround_steps.append(cmd("sleep 1", hideStepIf=True))
-    return workaround_steps
-
 # yapf: disable
 def configure(c):
     f = util.BuildFactory()
@@ -309,17 +293,19 @@ def configure(c):
     f.addStep(define('UCHROOT_SRC_ROOT', UCHROOT_SRC_ROOT))
     f.addStep(define('UCHROOT_BUILD_DIR', UCHROOT_BUILD_DIR))
 
+    f.addStep(usession_start(ccache=True))
+
     # CMake
-    for step in get_uchroot_workaround_steps():
-        f.addStep(step)
     f.addStep(ucompile('../tools/VaRA/utils/vara/builds/' + BUILD_SCRIPT,
                        BUILD_SUBDIR, '-DCLANG_ANALYZER_ENABLE_Z3_SOLVER=OFF',
                        '-DLLVM_ENABLE_RTTI=ON', '-DLLVM_ENABLE_PIC=ON',
                        '-DLLVM_ENABLE_EH=ON',
+                       LLVM_PARALLEL_LINK_JOBS,
                        env={'PATH': '/opt/cmake/bin:/usr/local/bin:/usr/bin:/bin'},
                        name='cmake',
                        description=BUILD_SCRIPT,
-                       workdir=UCHROOT_SRC_ROOT + '/build'))
+                       workdir=UCHROOT_SRC_ROOT + '/build', ccache=True))
+    f.addStep(ccache_launcher(UCHROOT_BUILD_DIR))
 
     f.addStep(GenerateMakeCleanCommand(name="Dummy_2", command=['true'],
                                        haltOnFailure=True, hideStepIf=True))
@@ -352,16 +338,15 @@ def configure(c):
                                        haltOnFailure=True, hideStepIf=True))
 
     # Regression Test step
-    for step in get_uchroot_workaround_steps():
-        f.addStep(step)
-    f.addStep(ucompile('ninja', 'check-vara', name='run VaRA regression tests',
-                       workdir=UCHROOT_BUILD_DIR,
+    f.addStep(ucompile('ninja', '-j', parallel_jobs, '-l', load_limit, 'check-vara',
+                       name='run VaRA regression tests',
+                       env={'LIT_OPTS': lit_opts},
+                       workdir=UCHROOT_BUILD_DIR, ccache=True,
                        haltOnFailure=False, warnOnWarnings=True))
 
     ## Clang-Tidy
-    #for step in get_uchroot_workaround_steps():
-    #    f.addStep(step)
-    #f.addStep(ucompile('python3', 'tidy-vara.py', '-p', UCHROOT_BUILD_DIR, '-j', '8', '--gcc',
+    #f.addStep(ucompile('python3', 'tidy-vara.py', '-p', UCHROOT_BUILD_DIR, '-j', parallel_jobs,
+    #                   '--gcc',
     #                   workdir='vara-llvm/tools/VaRA/test/', name='run Clang-Tidy',
     #                   haltOnFailure=False, warnOnWarnings=True,
     #                   timeout=3600))
@@ -373,6 +358,8 @@ def configure(c):
     #                                         workdir=ip('%(prop:uchroot_image_path)s'),
     #                                         haltOnFailure=True, hideStepIf=True))
 
+    f.addStep(usession_stop())
+
     c['builders'].append(builder(PROJECT_NAME, None, ACCEPTED_BUILDERS, tags=['vara'],
                                  factory=f))
 
@@ -393,9 +380,15 @@ def schedule(c):
     )
 
     c['schedulers'].extend([
-        s_abranch(PROJECT_NAME + '-sched', CODEBASE, [PROJECT_NAME],
-                  change_filter=filter.ChangeFilter(branch_re=TRIGGER_BRANCHES),
-                  treeStableTimer=5 * 60),
+        # A merge pushes its branches to the repositories one after the
+        # other. Their changes share one timer, which each push extends, so
+        # pushes less than minDelay apart are built together; a later push
+        # gets a build of its own.
+        s_coalesce(PROJECT_NAME + '-sched', CODEBASE, [PROJECT_NAME],
+                   change_filter=filter.ChangeFilter(branch_re=TRIGGER_BRANCHES),
+                   fileIsImportant=important_files(exclude=DOCUMENTATION_FILES),
+                   coalesceBranches='^(?:{0})$'.format(TRIGGER_BRANCHES),
+                   minDelay=30, maxDelay=5 * 60),
         force_sched,
         s_trigger('trigger-' + PROJECT_NAME, CODEBASE, [PROJECT_NAME]),
         # TODO: Fix nightly scheduler (currently not working)
@@ -0,0 +1,292 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+from twisted.web import resource, server
+
+from buildbot import config
+from buildbot.process.properties import Secret
+from buildbot.util import bytes2unicode, unicode2bytes
+from buildbot.util import service
+
+from polyjit.buildbot import tokenauth
+
+# Settings of the shared compiler cache on the master. Workers find it via
+# their 'ccache_remote_storage' property (see slaves.py) and authenticate
+# with the buildbot secret TOKEN_SECRET.
+PORT = 8011
+DIRECTORY = "/local/hdd/buildbot/ccache-remote"
+MAX_SIZE = 200 * 1024 ** 3
+TOKEN_SECRET = "ccache_remote_token"
+
+_KEY_RE = re.compile(r'^[0-9a-zA-Z]+$')
+
+
+class CcacheStorage(object):
+    """
+    Directory of ccache results with LRU eviction under a size cap.
+
+    Entries are kept in access order in memory; the order is restored from
+    the modification times of the files on startup. Hits, misses and writes
+    are counted per builder. The methods that read or write files must be
+    called from threads; all methods may be.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.size = 0
+        self.entries = OrderedDict()
+        self.stats = {}
+        self.load()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not _KEY_RE.match(name):
+                    continue
+                st = os.stat(os.path.join(root, name))
+                found.append((st.st_mtime, name, st.st_size))
+
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.size += size
+        self.evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def count(self, builder, counter):
+        with self.lock:
+            builder_stats = self.stats.setdefault(builder,
+                                                  {'hits': 0, 'misses': 0, 'writes': 0})
+            builder_stats[counter] += 1
+
+    def touch(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key)
+        try:
+            os.utime(self.path(key), None)
+        except OSError:
+            pass
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key, builder):
+        if not self.contains(key):
+            self.count(builder, 'misses')
+            return None
+
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            with self.lock:
+                if key in self.entries:
+                    self.size -= self.entries.pop(key)
+            self.count(builder, 'misses')
+            return None
+
+        self.touch(key)
+        self.count(builder, 'hits')
+        return data
+
+    def put(self, key, data, builder):
+        path = self.path(key)
+        # Concurrent puts may create the same prefix directory.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        with self.lock:
+            os.rename(tmp_path, path)
+            if key in self.entries:
+                self.size -= self.entries.pop(key)
+            self.entries[key] = len(data)
+            self.size += len(data)
+        self.count(builder, 'writes')
+        self.evict()
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.size -= self.entries.pop(key)
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            return True
+
+    def evict(self):
+        with self.lock:
+            while self.size > self.max_size and self.entries:
+                key = next(iter(self.entries))
+                self.delete(key)
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'builders': dict((b, dict(c)) for b, c in self.stats.items()),
+            }
+
+
+class CcacheResource(resource.Resource):
+    """
+    HTTP remote storage backend for ccache.
+
+    ccache is pointed to http://ccache:<token>@<master>:<port>/<buildername>,
+    so requests look like '/<buildername>/<key>' (layout=flat) or
+    '/<buildername>/<key[:2]>/<key[2:]>' (layout=subdirs). The builder name
+    only selects the statistics bucket; all builders share the same objects.
+    GET '/_stats' returns the statistics as JSON. Requests without the token
+    (see polyjit.buildbot.tokenauth) are rejected. Files are read and written
+    in threads.
+    """
+
+    isLeaf = True
+
+    def __init__(self, storage, token):
+        resource.Resource.__init__(self)
+        self.storage = storage
+        self.token = token
+
+    def render(self, request):
+        if not tokenauth.authorized(request, self.token):
+            return tokenauth.deny(request, 'ccache')
+        return resource.Resource.render(self, request)
+
+    def parse(self, request):
+        segments = [bytes2unicode(s) for s in request.postpath if s]
+        if len(segments) < 2:
+            return None, None
+        key = ''.join(segments[1:])
+        if not _KEY_RE.match(key):
+            return None, None
+        return segments[0], key
+
+    def respond(self, request, d, name):
+        """Finish `request` when `d` fires with the response code and body."""
+        @d.addCallback
+        def send(response):
+            code, body = response
+            request.setResponseCode(code)
+            if body:
+                request.setHeader(b'content-type', b'application/octet-stream')
+                request.write(body)
+            request.finish()
+
+        @d.addErrback
+        def failed(failure):
+            log.err(failure, "while serving ccache entry {0}".format(name))
+            request.setResponseCode(500)
+            request.finish()
+
+        return server.NOT_DONE_YET
+
+    def render_GET(self, request):
+        if [bytes2unicode(s) for s in request.postpath] == ['_stats']:
+            request.setHeader(b'content-type', b'application/json')
+            return unicode2bytes(json.dumps(self.storage.getStats()))
+
+        builder, key = self.parse(request)
+        if key is None:
+            request.setResponseCode(400)
+            return b''
+
+        def get():
+            data = self.storage.get(key, builder)
+            if data is None:
+                return 404, None
+            return 200, data
+        return self.respond(request, threads.deferToThread(get), key)
+
+    def render_HEAD(self, request):
+        _, key = self.parse(request)
+        if key is None or not self.storage.contains(key):
+            request.setResponseCode(404)
+        return b''
+
+    def render_PUT(self, request):
+        builder, key = self.parse(request)
+        if key is None:
+            request.setResponseCode(400)
+            return b''
+
+        def put():
+            self.storage.put(key, request.content.read(), builder)
+            return 201, None
+        request.content.seek(0)
+        return self.respond(request, threads.deferToThread(put), key)
+
+    def render_DELETE(self, request):
+        _, key = self.parse(request)
+        if key is None:
+            request.setResponseCode(404)
+            return b''
+
+        def delete():
+            return (200 if self.storage.delete(key) else 404), None
+        return self.respond(request, threads.deferToThread(delete), key)
+
+
+class CcacheServer(service.BuildbotService):
+    """Serve the shared compiler cache from the buildbot master."""
+
+    name = 'ccache-server'
+    secrets = ['token']
+
+    def checkConfig(self, token=None, port=PORT, directory=DIRECTORY, max_size=MAX_SIZE,
+                    **kwargs):
+        if token is None:
+            config.error("the ccache server needs a token")
+        service.BuildbotService.checkConfig(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def reconfigService(self, token=None, port=PORT, directory=DIRECTORY, max_size=MAX_SIZE,
+                        **kwargs):
+        yield service.BuildbotService.reconfigService(self, **kwargs)
+        yield self.stopListening()
+
+        # Loading walks the whole cache directory.
+        self.storage = yield threads.deferToThread(CcacheStorage, directory, max_size)
+        site = server.Site(CcacheResource(self.storage, token))
+        self.listening_port = reactor.listenTCP(port, site)
+        log.msg("ccache server listening on port {0}, serving {1}".format(port, directory))
+
+    @defer.inlineCallbacks
+    def stopListening(self):
+        listening_port = getattr(self, 'listening_port', None)
+        if listening_port is not None:
+            self.listening_port = None
+            yield listening_port.stopListening()
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield self.stopListening()
+        yield service.BuildbotService.stopService(self)
+
+
+def configure(c):
+    """Serve the cache; the master needs a secrets provider with TOKEN_SECRET."""
+    c.setdefault('services', []).append(CcacheServer(token=Secret(TOKEN_SECRET)))
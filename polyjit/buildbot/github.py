@@ -7,6 +7,7 @@ import hmac
 import json
 import logging
 import re
+from collections import OrderedDict
 from hashlib import sha1
 
 from dateutil.parser import parse as dateparse
@@ -15,6 +16,7 @@ from twisted.internet import defer
 from twisted.python import log
 
 from buildbot.changes.github import PullRequestMixin
+from buildbot.process.properties import Properties
 from buildbot.util import bytes2unicode
 from buildbot.util import httpclientservice
 from buildbot.util import unicode2bytes
@@ -26,7 +28,20 @@ _HEADER_SIGNATURE = b'X-Hub-Signature'
 DEFAULT_SKIPS_PATTERN = (r'\[ *skip *ci *\]', r'\[ *ci *skip *\]')
 DEFAULT_GITHUB_API_URL = 'https://api.github.com'
 
+# GitHub lists at most 3000 files of a pull request, in pages of up to 100.
+PR_FILES_PER_PAGE = 100
+PR_FILES_MAX_PAGES = 30
+# Seconds to wait for a page, the webhook request waits for the files.
+PR_FILES_TIMEOUT = 10
+# The changed files of the most recent pull request heads are kept, keyed by
+# repository and head sha, so repeated events for a head are not fetched
+# again.
+PR_FILES_CACHE_SIZE = 256
+_pr_files_cache = OrderedDict()
+
+
 class CustomGitHubHandler(GitHubEventHandler):
+    @defer.inlineCallbacks
     def handle_pull_request(self, payload, event):
         changes = None
 
@@ -35,7 +50,7 @@ class CustomGitHubHandler(GitHubEventHandler):
         if payload['action'] not in ("opened", "reopened", "synchronize"):
             logging.info("PR %r %r, ignoring",
                          payload['number'], payload['action'])
-            return None
+            defer.returnValue(None)
         else:
             changes = []
 
@@ -49,14 +64,13 @@ class CustomGitHubHandler(GitHubEventHandler):
             properties = self.extractProperties(payload['pull_request'])
             properties.update({'event': event})
 
-            # FIXME: Buildbot only schedules a build, if there is at least one change.
-            # Unfortunately, there seems to be no easy way to get a list of all
-            # the changed files.
-            # If possible, we should get this list and include it here.
-            # Until this is implemented properly, we use a dummy change here so
-            # that buildbot starts a build.
-            # This means, of course, that _all_ pull requests are built, even if they contain
-            # no meaningful change.
+            # The changed files let the schedulers skip pull requests that
+            # change nothing their builders build (see fileIsImportant).
+            # If GitHub does not tell which files changed, the change has no
+            # files and every builder builds the pull request.
+            files = yield self._get_pr_files(repo_full_name, number, head_sha)
+            if files is None:
+                files = {'added': [], 'removed': [], 'modified': []}
 
             # Create a synthetic change
             change = {
@@ -70,9 +84,9 @@ class CustomGitHubHandler(GitHubEventHandler):
                 'comments': u'GitHub Pull Request #{0} ({1} commit{2})\n{3}\n{4}'.format(
                     number, commits, 's' if commits != 1 else '', title, comments),
                 'properties': properties,
-                'added': [],
-                'removed': [],
-                'modified': ['dummy'],
+                'added': files['added'],
+                'removed': files['removed'],
+                'modified': files['modified'],
             }
 
         repo = payload['repository']['name']
@@ -81,7 +95,78 @@ class CustomGitHubHandler(GitHubEventHandler):
         changes.append(self.process_pull_request_change(
             change, branch, repo, repo_url))
 
-        return changes, 'git'
+        defer.returnValue((changes, 'git'))
+
+    @defer.inlineCallbacks
+    def _get_pr_files(self, repo, number, head_sha):
+        """
+        Get the files a pull request changes from the pulls/files endpoint.
+
+        Returns the 'added', 'removed' and 'modified' file lists of a change,
+        or None if GitHub did not answer. Renamed files count as removed
+        under their old and as added under their new name.
+
+        :param repo: the repo full name, ``{owner}/{project}``.
+        :param number: the pull request number.
+        :param head_sha: the head commit of the pull request.
+        """
+        key = (repo, head_sha)
+        if key in _pr_files_cache:
+            files = _pr_files_cache.pop(key)
+            _pr_files_cache[key] = files
+            defer.returnValue(files)
+
+        headers = {'User-Agent': 'Buildbot'}
+        if self._token:
+            p = Properties()
+            p.master = self.master
+            p.setProperty('full_name', repo, 'change_hook')
+            token = yield p.render(self._token)
+            headers['Authorization'] = 'token ' + token
+
+        http = yield httpclientservice.HTTPSession(
+            self.master.httpservice, self.github_api_endpoint,
+            headers=headers, debug=self.debug, verify=self.verify)
+
+        files = {'added': [], 'removed': [], 'modified': []}
+        url = '/repos/{0}/pulls/{1}/files'.format(repo, number)
+        for page in range(1, PR_FILES_MAX_PAGES + 1):
+            try:
+                res = yield http.get(url, params={'per_page': PR_FILES_PER_PAGE, 'page': page},
+                                     timeout=PR_FILES_TIMEOUT)
+                error = None
+                if not 200 <= res.code < 300:
+                    error = 'response code {0}'.format(res.code)
+                else:
+                    data = yield res.json()
+                    if not isinstance(data, list):
+                        error = 'unexpected answer {0!r}'.format(data)
+            except Exception as e:
+                # Connection errors, timeouts and answers that are no JSON.
+                error = e
+            if error is not None:
+                log.msg('Failed fetching the files of PR #{0} of {1}: {2}'.format(
+                    number, repo, error))
+                defer.returnValue(None)
+
+            for f in data:
+                status = f.get('status')
+                if status in ('added', 'copied'):
+                    files['added'].append(f['filename'])
+                elif status == 'removed':
+                    files['removed'].append(f['filename'])
+                elif status == 'renamed':
+                    files['added'].append(f['filename'])
+                    files['removed'].append(f['previous_filename'])
+                else:
+                    files['modified'].append(f['filename'])
+            if len(data) < PR_FILES_PER_PAGE:
+                break
+
+        _pr_files_cache[key] = files
+        while len(_pr_files_cache) > PR_FILES_CACHE_SIZE:
+            _pr_files_cache.popitem(last=False)
+        defer.returnValue(files)
 
     def process_pull_request_change(self, change, branch, repo, repo_url):
         files = change['added'] + change['removed'] + change['modified']
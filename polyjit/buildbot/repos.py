@@ -6,12 +6,16 @@ codebases = {
         'repository': 'https://llvm.org/git/compiler-rt.git',
         'branches': ['master', 'release_90'],
         'branch': 'master',
+        'clone_strategy': 'shallow',
+        'clone_depth': 1,
         'revision': None
     },
     'clang-tools-extra': {
         'repository': 'https://git.llvm.org/git/clang-tools-extra.git/',
         'branches': ['master', 'release_90'],
         'branch': 'master',
+        'clone_strategy': 'shallow',
+        'clone_depth': 1,
         'revision': None
     },
     'phasar': {
@@ -30,16 +34,45 @@ codebases = {
         'repository': 'https://github.com/se-passau/vara-llvm',
         'repository_clone_url': 'git@github.com:se-passau/vara-llvm',
         'branches': ['vara-90-dev', 'f-AllowPhasarUsage'],
+        'clone_strategy': 'blobless',
         'revision': None
     },
     'vara-clang': {
         'repository': 'https://github.com/se-passau/vara-clang',
         'repository_clone_url': 'git@github.com:se-passau/vara-clang',
         'branches': ['vara-90-dev'],
+        'clone_strategy': 'blobless',
         'revision': None
     },
 }
 
+def clone_options(name):
+    """
+    Options of the Git step for a fresh clone of codebase `name`.
+
+    The 'clone_strategy' of a codebase is one of
+     - 'full': clone the whole history (default),
+     - 'shallow': clone only the last 'clone_depth' commits (default 1),
+     - 'blobless': clone all commits and trees, but fetch file contents
+       only when they are checked out.
+    """
+    strategy = codebases[name].get('clone_strategy', 'full')
+    if strategy == 'full':
+        return {}
+    if strategy == 'shallow':
+        return {'shallow': codebases[name].get('clone_depth', 1)}
+    if strategy == 'blobless':
+        return {'filters': ['blob:none']}
+    raise ValueError("unknown clone_strategy '{0}' of codebase {1}".format(strategy, name))
+
+
+def clone_url(name):
+    """The URL to clone codebase `name` from."""
+    if 'repository_clone_url' in codebases[name]:
+        return codebases[name]['repository_clone_url']
+    return codebases[name]['repository']
+
+
 def make_new_cb(bases):
     cb_list = []
     for b in bases:
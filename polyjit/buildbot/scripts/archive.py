@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Pack files into a compressed tar archive.
+
+The archive is compressed with multi-threaded zstd, or with pigz (parallel
+gzip, falling back to gzip if pigz is missing) for consumers that cannot
+read zstd. The archive is written to a temporary file next to it and moved
+into place when it is complete.
+
+Prints a JSON object with the size of the packed files, the size of the
+archive and the seconds it took.
+
+Runs on the worker; this file is sent to the Python interpreter's stdin by
+polyjit.buildbot.utils.ArchivePack.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+COMPRESSORS = {
+    'zstd': ['zstd', '-T0'],
+    'pigz': ['pigz'],
+}
+TOTALS_RE = re.compile(r'^Total bytes written: (\d+)')
+
+
+def compressor(compression, level):
+    program = list(COMPRESSORS[compression])
+    if program[0] == 'pigz' and not shutil.which('pigz'):
+        program = ['gzip']
+    if program[0] == 'zstd' and level > 19:
+        program.append('--ultra')
+    return ' '.join(program + ['-{0}'.format(level)])
+
+
+def pack(args):
+    archive = os.path.abspath(args.archive)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(archive), prefix='.archive-')
+    os.close(fd)
+
+    command = ['tar', '--totals', '-c', '-I', compressor(args.compression, args.level),
+               '-f', tmp_path]
+    command += ['--exclude=' + pattern for pattern in args.exclude]
+    command += args.paths
+
+    start = time.time()
+    try:
+        proc = subprocess.Popen(command, cwd=args.directory, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        _, stderr = proc.communicate()
+        size = 0
+        for line in stderr.splitlines():
+            match = TOTALS_RE.match(line)
+            if match:
+                size = int(match.group(1))
+            else:
+                sys.stderr.write(line + '\n')
+        if proc.returncode != 0:
+            raise SystemExit('tar failed with exit code {0}'.format(proc.returncode))
+        os.rename(tmp_path, archive)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return {
+        'archive': args.archive,
+        'compression': args.compression,
+        'size': size,
+        'compressed': os.path.getsize(archive),
+        'seconds': time.time() - start,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--compression', choices=sorted(COMPRESSORS), default='zstd')
+    parser.add_argument('--level', type=int, default=3)
+    parser.add_argument('-C', dest='directory', default='.',
+                        help='directory the paths are relative to')
+    parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN')
+    parser.add_argument('archive')
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    print(json.dumps(pack(args)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+"""
+Transfer a file between the worker and the artifact store on the master.
+
+'upload' stores a file under its sha256 digest and points a reference name
+to it; nothing is sent if the store already has that digest. 'download'
+fetches the artifact a reference (or a digest) points to; nothing is sent
+if the local file already has that digest. With --unpack, the downloaded
+archive is extracted into a clean directory, unless that directory was
+already extracted from the same digest. If the local file is an older
+version of the artifact, only a delta to the new version is downloaded (see
+polyjit.buildbot.artifacts.ArtifactStorage.delta), if the store can make
+one. The digest of a local file is cached next to it in '<file>.sha256'
+together with its size and mtime, so unchanged files are not hashed again.
+'unpack' streams an archive straight into a clean directory without storing
+the archive on the worker, and 'extract' extracts a local archive into a
+clean directory. With --cache, archives are extracted once per worker into
+a cache (see ExtractCache) and copied from there, with reflinks where the
+file system supports them.
+
+Requests to the store carry the token in the environment variable
+ARTIFACT_STORE_TOKEN, if it is set.
+
+Prints a JSON object with the digest, the size, the number of bytes that
+were transferred, the number of bytes a delta saved and the seconds the
+transfer took; for unpacked archives also the size of the extracted files.
+
+Runs on the worker; this file is copied to the worker by
+polyjit.buildbot.utils.download_script or sent to the Python interpreter's
+stdin by polyjit.buildbot.utils.ArtifactDownload.
+"""
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+CHUNK_SIZE = 1 << 20
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def request(url, method='GET', data=None, headers=None):
+    headers = dict(headers or {})
+    if os.environ.get('ARTIFACT_STORE_TOKEN'):
+        headers['Authorization'] = 'Bearer ' + os.environ['ARTIFACT_STORE_TOKEN']
+    req = urllib.request.Request(url, data=data, method=method, headers=headers)
+    return urllib.request.urlopen(req)
+
+
+def exists(url):
+    try:
+        request(url, method='HEAD').close()
+        return True
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return False
+        raise
+
+
+def ref_url(store, name):
+    return '{0}/refs/{1}'.format(store, urllib.parse.quote(name.lstrip('/')))
+
+
+def object_url(store, digest):
+    return '{0}/objects/{1}'.format(store, digest)
+
+
+def delta_url(store, base, digest):
+    return '{0}/deltas/{1}/{2}'.format(store, base, digest)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_digest(path):
+    """The digest of `path`, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    stamp = '{0} {1}'.format(st.st_size, st.st_mtime_ns)
+    try:
+        with open(path + '.sha256') as f:
+            digest, cached_stamp = f.read().split(' ', 1)
+        if cached_stamp.strip() == stamp:
+            return digest
+    except (IOError, ValueError):
+        pass
+
+    digest = file_sha256(path)
+    write_digest(path, digest)
+    return digest
+
+
+def write_digest(path, digest):
+    st = os.stat(path)
+    with open(path + '.sha256', 'w') as f:
+        f.write('{0} {1} {2}\n'.format(digest, st.st_size, st.st_mtime_ns))
+
+
+def upload(args):
+    digest = cached_digest(args.file)
+    if digest is None:
+        raise SystemExit('{0} does not exist'.format(args.file))
+    size = os.path.getsize(args.file)
+
+    start = time.time()
+    transferred = 0
+    if not exists(object_url(args.store, digest)):
+        headers = {
+            'Content-Length': str(size),
+            'Content-Type': 'application/octet-stream',
+            'X-Artifact-Ref': args.ref.lstrip('/'),
+        }
+        if args.builder:
+            headers['X-Artifact-Builder'] = args.builder
+        if args.revision:
+            headers['X-Artifact-Revision'] = args.revision
+        with open(args.file, 'rb') as f:
+            request(object_url(args.store, digest), 'PUT', f, headers).close()
+        transferred = size
+    request(ref_url(args.store, args.ref), 'PUT', digest.encode()).close()
+
+    return {'digest': digest, 'size': size, 'transferred': transferred,
+            'seconds': time.time() - start}
+
+
+def decompress_args(head):
+    """tar options to decompress an archive that starts with `head`."""
+    if head.startswith(ZSTD_MAGIC):
+        return ['-I', 'zstd -d']
+    if head.startswith(GZIP_MAGIC):
+        return ['-I', 'pigz -d' if shutil.which('pigz') else 'gzip -d']
+    if head.startswith(b'BZh'):
+        return ['-j']
+    return []
+
+
+def is_unpacked(directory, digest):
+    try:
+        with open(os.path.join(directory, '.artifact-digest')) as f:
+            return f.read().strip() == digest
+    except IOError:
+        return False
+
+
+def mark_unpacked(directory, digest):
+    with open(os.path.join(directory, '.artifact-digest'), 'w') as f:
+        f.write(digest + '\n')
+
+
+def tree_size(directory):
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class ExtractCache(object):
+    """
+    Extracted archives of one worker, shared by all of its builders.
+
+    Every archive is extracted once into '<cache>/<digest>' and copied into
+    build directories, as a reflink copy if the file system supports it,
+    which takes milliseconds instead of a full extraction, or as a plain
+    copy otherwise, which still saves the decompression. The copies never
+    share their files with the cache. '<cache>/<digest>.size' holds the size
+    of an entry; its mtime is the last use, by which the least recently used
+    entries are evicted when the cache exceeds its maximum size.
+
+    An entry is locked by '<cache>/<digest>.lock': shared while it is copied,
+    exclusive while it is extracted or evicted. Builders that use different
+    archives do not wait for each other, except for the eviction, which runs
+    under the lock of the whole cache and skips entries in use.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def entry(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def size_path(self, digest):
+        return self.entry(digest) + '.size'
+
+    def lock_path(self, digest):
+        return self.entry(digest) + '.lock'
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    @contextlib.contextmanager
+    def entry_locked(self, digest, operation):
+        """
+        Hold the lock of entry `digest`, see fcntl.flock for `operation`.
+
+        Eviction removes the lock file, so a lock that was acquired on a
+        removed file is retried on the current one.
+        """
+        path = self.lock_path(digest)
+        while True:
+            lock = open(path, 'a')
+            try:
+                fcntl.flock(lock, operation)
+                if os.fstat(lock.fileno()).st_ino == os.stat(path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                lock.close()
+                raise
+            lock.close()
+        try:
+            yield
+        finally:
+            lock.close()
+
+    def copy(self, digest, directory):
+        os.utime(self.size_path(digest))
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        copy_tree(self.entry(digest), directory)
+
+    def materialize(self, digest, directory, extract):
+        """
+        Copy the extracted archive `digest` to `directory`.
+
+        If it is not in the cache, `extract` is called with a directory to
+        extract the archive into. Returns True if the cache had the archive.
+        """
+        with self.entry_locked(digest, fcntl.LOCK_SH):
+            hit = os.path.isdir(self.entry(digest))
+            if hit:
+                self.copy(digest, directory)
+
+        if not hit:
+            with self.entry_locked(digest, fcntl.LOCK_EX):
+                # Another builder may have extracted it in the meantime.
+                hit = os.path.isdir(self.entry(digest))
+                if not hit:
+                    tmp_dir = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+                    os.chmod(tmp_dir, 0o755)
+                    try:
+                        extract(tmp_dir)
+                        with open(self.size_path(digest), 'w') as f:
+                            f.write('{0}\n'.format(tree_size(tmp_dir)))
+                        os.rename(tmp_dir, self.entry(digest))
+                    finally:
+                        shutil.rmtree(tmp_dir, ignore_errors=True)
+                self.copy(digest, directory)
+
+        with self.locked():
+            self.evict(digest)
+        return hit
+
+    def evict(self, keep):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.size') or name[:-len('.size')] == keep:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    size = int(f.read())
+                entries.append((os.path.getmtime(path), size, name[:-len('.size')]))
+            except (IOError, OSError, ValueError):
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        try:
+            with open(self.size_path(keep)) as f:
+                total += int(f.read())
+        except (IOError, ValueError):
+            pass
+        for _, size, digest in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                with self.entry_locked(digest, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    shutil.rmtree(self.entry(digest), ignore_errors=True)
+                    os.remove(self.size_path(digest))
+                    os.remove(self.lock_path(digest))
+            except BlockingIOError:
+                # Being copied, it is evicted by a later call.
+                continue
+            total -= size
+
+
+def copy_tree(source, target):
+    """
+    Copy `source` to the new directory `target`, with reflinks if possible.
+
+    Never hardlinks: builds write to the files of their build directory,
+    which would change the shared cache entry as well.
+    """
+    if subprocess.call(['cp', '-a', '--reflink=auto', source, target],
+                       stderr=subprocess.DEVNULL) == 0:
+        return
+    shutil.rmtree(target, ignore_errors=True)
+    shutil.copytree(source, target, symlinks=True)
+
+
+def parse_size(text):
+    """A size like '50G' in bytes."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def extract_cache(args):
+    if not args.cache:
+        return None
+    return ExtractCache(args.cache, parse_size(args.cache_size))
+
+
+def extract_file(archive, directory):
+    with open(archive, 'rb') as f:
+        head = f.read(len(ZSTD_MAGIC))
+    subprocess.check_call(['tar', '-x'] + decompress_args(head) +
+                          ['-f', os.path.abspath(archive), '-C', directory])
+
+
+def unpack(archive, directory, digest, cache=None):
+    """
+    Extract `archive` into a clean `directory` unless it is up to date.
+
+    Returns whether the directory changed and whether `cache` had the
+    extracted archive.
+    """
+    if is_unpacked(directory, digest):
+        return False, False
+
+    shutil.rmtree(directory, ignore_errors=True)
+    hit = False
+    if cache:
+        hit = cache.materialize(digest, directory,
+                                lambda tmp_dir: extract_file(archive, tmp_dir))
+    else:
+        os.makedirs(directory)
+        extract_file(archive, directory)
+    mark_unpacked(directory, digest)
+    return True, hit
+
+
+def resolve(args):
+    """The digest of the artifact to download."""
+    if args.digest:
+        return args.digest
+    with request(ref_url(args.store, args.ref)) as response:
+        return response.read().decode().strip()
+
+
+def download(args):
+    result = fetch(args)
+    if args.unpack:
+        result['unpacked'], result['cache_hit'] = unpack(
+            args.file, args.unpack, result['digest'], extract_cache(args))
+        result['unpacked_size'] = tree_size(args.unpack)
+    return result
+
+
+def extract(args):
+    digest = cached_digest(args.file)
+    if digest is None:
+        raise SystemExit('{0} does not exist'.format(args.file))
+    unpacked, hit = unpack(args.file, args.directory, digest, extract_cache(args))
+    return {'digest': digest, 'unpacked': unpacked, 'cache_hit': hit,
+            'unpacked_size': tree_size(args.directory)}
+
+
+def stream_extract(store, digest, directory):
+    """Extract the artifact `digest` into `directory` while it is downloaded."""
+    hasher = hashlib.sha256()
+    size = 0
+    with request(object_url(store, digest)) as response:
+        chunk = response.read(CHUNK_SIZE)
+        proc = subprocess.Popen(['tar', '-x'] + decompress_args(chunk) +
+                                ['-C', directory], stdin=subprocess.PIPE)
+        try:
+            while chunk:
+                hasher.update(chunk)
+                proc.stdin.write(chunk)
+                size += len(chunk)
+                chunk = response.read(CHUNK_SIZE)
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.stdin.close()
+        returncode = proc.wait()
+
+    if returncode != 0 or hasher.hexdigest() != digest:
+        raise SystemExit('unpacking {0} failed'.format(digest))
+    return size
+
+
+def stream_unpack(args):
+    """Extract the artifact into a clean directory while it is downloaded."""
+    digest = resolve(args)
+    if is_unpacked(args.directory, digest):
+        return {'digest': digest, 'size': 0, 'transferred': 0, 'saved': 0, 'seconds': 0,
+                'unpacked': False, 'cache_hit': False,
+                'unpacked_size': tree_size(args.directory)}
+
+    shutil.rmtree(args.directory, ignore_errors=True)
+    start = time.time()
+    sizes = []
+    cache = extract_cache(args)
+    try:
+        if cache:
+            hit = cache.materialize(
+                digest, args.directory,
+                lambda tmp_dir: sizes.append(stream_extract(args.store, digest, tmp_dir)))
+        else:
+            hit = False
+            os.makedirs(args.directory)
+            sizes.append(stream_extract(args.store, digest, args.directory))
+    except BaseException:
+        shutil.rmtree(args.directory, ignore_errors=True)
+        raise
+    mark_unpacked(args.directory, digest)
+
+    size = sum(sizes)
+    return {'digest': digest, 'size': size, 'transferred': size, 'saved': 0,
+            'seconds': time.time() - start, 'unpacked': True, 'cache_hit': hit,
+            'unpacked_size': tree_size(args.directory)}
+
+
+def fetch(args):
+    digest = resolve(args)
+
+    local_digest = cached_digest(args.file)
+    if local_digest == digest:
+        return {'digest': digest, 'size': os.path.getsize(args.file), 'transferred': 0,
+                'saved': 0, 'seconds': 0}
+
+    target_dir = os.path.dirname(os.path.abspath(args.file))
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+
+    if local_digest and args.delta and shutil.which('zstd'):
+        result = fetch_delta(args, local_digest, digest, target_dir)
+        if result:
+            return result
+
+    start = time.time()
+    fd, tmp_path = tempfile.mkstemp(dir=target_dir, prefix='.artifact-')
+    try:
+        hasher = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as f, request(object_url(args.store, digest)) as response:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                hasher.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        if hasher.hexdigest() != digest:
+            raise SystemExit('download of {0} is corrupt'.format(digest))
+        os.rename(tmp_path, args.file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    write_digest(args.file, digest)
+
+    return {'digest': digest, 'size': size, 'transferred': size, 'saved': 0,
+            'seconds': time.time() - start}
+
+
+def fetch_delta(args, base, digest, target_dir):
+    """Turn the local version `base` of the artifact into `digest` with a delta."""
+    start = time.time()
+    fd, delta_path = tempfile.mkstemp(dir=target_dir, prefix='.artifact-delta-')
+    tmp_path = delta_path + '.new'
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            try:
+                response = request(delta_url(args.store, base, digest))
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    return None
+                raise
+            with response:
+                shutil.copyfileobj(response, f, CHUNK_SIZE)
+
+        subprocess.check_call(['zstd', '-d', '-q', '-f', '--long=31',
+                               '--patch-from=' + args.file, delta_path, '-o', tmp_path])
+        if file_sha256(tmp_path) != digest:
+            return None
+        os.rename(tmp_path, args.file)
+        write_digest(args.file, digest)
+
+        size = os.path.getsize(args.file)
+        transferred = os.path.getsize(delta_path)
+        return {'digest': digest, 'size': size, 'transferred': transferred,
+                'saved': size - transferred, 'delta': base, 'seconds': time.time() - start}
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.stderr.write('delta transfer failed, downloading {0} in full: {1}\n'.format(
+            digest, e))
+        return None
+    finally:
+        for path in (delta_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--store', help='URL of the artifact store')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    cache_parser = argparse.ArgumentParser(add_help=False)
+    cache_parser.add_argument('--cache', metavar='DIR',
+                              help='cache of extracted archives on this worker')
+    cache_parser.add_argument('--cache-size', default='50G',
+                              help='maximum size of the cache, e.g. 50G')
+
+    upload_parser = subparsers.add_parser('upload')
+    upload_parser.add_argument('--ref', required=True)
+    upload_parser.add_argument('--builder')
+    upload_parser.add_argument('--revision')
+    upload_parser.add_argument('file')
+    upload_parser.set_defaults(func=upload)
+
+    download_parser = subparsers.add_parser('download', parents=[cache_parser])
+    source = download_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--ref')
+    source.add_argument('--digest')
+    download_parser.add_argument('--no-delta', dest='delta', action='store_false',
+                                 help='always download the whole artifact')
+    download_parser.add_argument('--unpack', metavar='DIR',
+                                 help='extract the downloaded archive into DIR')
+    download_parser.add_argument('file')
+    download_parser.set_defaults(func=download)
+
+    unpack_parser = subparsers.add_parser('unpack', parents=[cache_parser])
+    source = unpack_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--ref')
+    source.add_argument('--digest')
+    unpack_parser.add_argument('directory')
+    unpack_parser.set_defaults(func=stream_unpack)
+
+    extract_parser = subparsers.add_parser('extract', parents=[cache_parser])
+    extract_parser.add_argument('file')
+    extract_parser.add_argument('directory')
+    extract_parser.set_defaults(func=extract)
+
+    args = parser.parse_args()
+    if args.command != 'extract':
+        if not args.store:
+            parser.error('--store is required for {0}'.format(args.command))
+        args.store = args.store.rstrip('/')
+    print(json.dumps(args.func(args)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Check that the lines a branch changed are formatted with clang-format.
+
+Only the lines added or modified since the merge-base with the base branch
+are checked. Every violation is printed as a 'file:line: warning:' line
+followed by the suggested change. A summary, the number of checked files
+and the number of violations per file, is written as JSON to the file given
+with --json.
+"""
+import argparse
+import difflib
+import json
+import os
+import re
+import subprocess
+import sys
+
+EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx', '.h', '.hh', '.hpp', '.hxx')
+HUNK_RE = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+
+
+def git(repo, *args):
+    return subprocess.check_output(('git', '-C', repo) + args,
+                                   universal_newlines=True)
+
+
+def changed_lines(repo, base):
+    """Map every changed file to the line ranges the branch touched."""
+    merge_base = git(repo, 'merge-base', 'HEAD', base).strip()
+    diff = git(repo, 'diff', '-U0', '--no-color', '--diff-filter=d', merge_base, 'HEAD')
+
+    ranges = {}
+    current = None
+    for line in diff.splitlines():
+        if line.startswith('+++ '):
+            path = line[4:]
+            current = path[2:] if path.startswith('b/') else None
+            if current is not None and not current.endswith(EXTENSIONS):
+                current = None
+        elif current is not None:
+            match = HUNK_RE.match(line)
+            if match:
+                start = int(match.group(1))
+                count = int(match.group(2) or 1)
+                if count > 0:
+                    ranges.setdefault(current, []).append((start, start + count - 1))
+    return ranges
+
+
+def check_file(repo, path, ranges, clang_format):
+    with open(os.path.join(repo, path)) as f:
+        original = f.read().splitlines(True)
+
+    command = [clang_format, '-style=file', '-assume-filename=' + path]
+    command += ['-lines={0}:{1}'.format(start, end) for start, end in ranges]
+    proc = subprocess.Popen(command, cwd=repo, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    formatted, _ = proc.communicate(''.join(original))
+    if proc.returncode != 0:
+        raise RuntimeError('clang-format failed on ' + path)
+    formatted = formatted.splitlines(True)
+
+    violations = []
+    matcher = difflib.SequenceMatcher(None, original, formatted, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        violations.append({
+            'file': path,
+            'line': i1 + 1,
+            'lines': i2 - i1,
+            'original': ''.join(original[i1:i2]),
+            'formatted': ''.join(formatted[j1:j2]),
+        })
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repo', required=True)
+    parser.add_argument('--base', required=True,
+                        help='base branch, e.g. origin/vara-dev')
+    parser.add_argument('--clang-format', default='clang-format')
+    parser.add_argument('--json', help='write the summary to this file')
+    args = parser.parse_args()
+
+    ranges = changed_lines(args.repo, args.base)
+    violations = []
+    for path in sorted(ranges):
+        violations.extend(check_file(args.repo, path, ranges[path], args.clang_format))
+
+    for v in violations:
+        print('{0}:{1}: warning: code is not clang-formatted'.format(v['file'], v['line']))
+        sys.stdout.writelines('-' + line for line in v['original'].splitlines(True))
+        sys.stdout.writelines('+' + line for line in v['formatted'].splitlines(True))
+        print('')
+    print('{0} changed files checked, {1} violations'.format(len(ranges), len(violations)))
+
+    if args.json:
+        per_file = {}
+        for v in violations:
+            per_file[v['file']] = per_file.get(v['file'], 0) + 1
+        with open(args.json, 'w') as f:
+            json.dump({'checked_files': len(ranges),
+                       'violations': len(violations),
+                       'files': per_file}, f)
+    return 1 if violations else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
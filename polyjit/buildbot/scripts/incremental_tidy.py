@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Run clang-tidy only on the translation units affected by a branch.
+
+The affected translation units are the changed source files of the
+repository since its merge-base with the base branch, plus every
+translation unit that includes one of the changed headers according to
+ninja's dependency log.
+
+Every selected unit is checked by the repository's own tidy script
+(tidy-vara.py), which gets a compilation database that only holds this
+unit, so its clang-tidy options and file filters apply unchanged. The
+output is cached per translation unit, keyed by the contents of the unit
+and of every header it includes, the compile command, the clang-tidy
+version and configuration and the tidy script, so units that did not change
+reuse the output of the last run.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx')
+HEADER_EXTENSIONS = ('.h', '.hh', '.hpp', '.hxx', '.def', '.inc')
+
+
+def git(repo, *args):
+    return subprocess.check_output(('git', '-C', repo) + args,
+                                   universal_newlines=True).strip()
+
+
+def changed_files(repo, base):
+    merge_base = git(repo, 'merge-base', 'HEAD', base)
+    files = git(repo, 'diff', '--name-only', '--diff-filter=d', merge_base, 'HEAD')
+    return set(os.path.normpath(os.path.join(repo, f)) for f in files.splitlines() if f)
+
+
+def ninja_deps(build_dir):
+    """Map every compiled source file to the headers it includes."""
+    output = subprocess.check_output(['ninja', '-C', build_dir, '-t', 'deps'],
+                                     universal_newlines=True)
+    deps = {}
+    current = None
+    for line in output.splitlines():
+        if not line.strip():
+            current = None
+        elif not line.startswith(' '):
+            current = []
+        elif current is not None:
+            path = os.path.normpath(os.path.join(build_dir, line.strip()))
+            if not current:
+                # The first dependency of an object is its source file.
+                deps[path] = current
+            current.append(path)
+    return deps
+
+
+class FileDigests(object):
+    """Memoized contents digests, shared by all translation units."""
+
+    def __init__(self):
+        self.digests = {}
+
+    def __call__(self, path):
+        if path not in self.digests:
+            digest = hashlib.sha256()
+            try:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 16), b''):
+                        digest.update(chunk)
+            except IOError:
+                digest.update(b'<missing>')
+            self.digests[path] = digest.hexdigest()
+        return self.digests[path]
+
+
+def cache_key(entry, headers, config, file_digest):
+    """
+    Key of the tidy output of `entry`.
+
+    `headers` must hold every header the unit includes, system and LLVM
+    headers as well, as a changed declaration anywhere can change the
+    diagnostics of the unit.
+    """
+    digest = hashlib.sha256()
+    digest.update(config.encode())
+    digest.update(entry.get('command', ' '.join(entry.get('arguments', []))).encode())
+    for path in [entry['file']] + sorted(set(headers)):
+        digest.update(path.encode())
+        digest.update(file_digest(path).encode())
+    return digest.hexdigest()
+
+
+def tidy_command(args, database_dir):
+    return [sys.executable, args.tidy_script, '-p', database_dir, '-j', '1'] + args.tidy_args
+
+
+def run_tidy(args, entry, key):
+    cache_file = None
+    if key is not None:
+        cache_file = os.path.join(args.cache_dir, key[:2], key + '.json')
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                return json.load(f), True
+
+    database_dir = tempfile.mkdtemp(prefix='tidy-', dir=args.build_dir)
+    try:
+        with open(os.path.join(database_dir, 'compile_commands.json'), 'w') as f:
+            json.dump([entry], f)
+        proc = subprocess.Popen(tidy_command(args, database_dir),
+                                cwd=os.path.dirname(args.tidy_script),
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        output, _ = proc.communicate()
+    finally:
+        shutil.rmtree(database_dir, ignore_errors=True)
+    result = {'file': entry['file'], 'rc': proc.returncode, 'output': output}
+
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = cache_file + '.tmp.{0}'.format(os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(result, f)
+        os.rename(tmp_file, cache_file)
+    return result, False
+
+
+def tidy_config(args, repo):
+    """Everything besides the unit itself that changes the tidy output."""
+    config = subprocess.check_output([args.clang_tidy, '--version'],
+                                     universal_newlines=True)
+    config += ' '.join(args.tidy_args)
+    for path in (args.tidy_script, os.path.join(repo, '.clang-tidy')):
+        if os.path.exists(path):
+            with open(path) as f:
+                config += f.read()
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-p', dest='build_dir', required=True)
+    parser.add_argument('--repo', required=True)
+    parser.add_argument('--base', required=True,
+                        help='base branch, e.g. origin/vara-dev')
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('--tidy-script', required=True,
+                        help='the tidy script of the repository, e.g. test/tidy-vara.py')
+    parser.add_argument('--tidy-arg', dest='tidy_args', action='append', default=[],
+                        help='extra argument of the tidy script, e.g. --tidy-arg=--gcc')
+    parser.add_argument('--clang-tidy', default='clang-tidy',
+                        help='the clang-tidy the tidy script uses, for the cache key')
+    parser.add_argument('-j', dest='jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    repo = os.path.normpath(os.path.abspath(args.repo))
+    build_dir = os.path.normpath(os.path.abspath(args.build_dir))
+    args.build_dir = build_dir
+    args.tidy_script = os.path.abspath(args.tidy_script)
+
+    with open(os.path.join(build_dir, 'compile_commands.json')) as f:
+        entries = {}
+        for entry in json.load(f):
+            path = os.path.normpath(os.path.join(entry['directory'], entry['file']))
+            if path.startswith(repo + os.sep):
+                entry['file'] = path
+                entries[path] = entry
+
+    changed = changed_files(repo, args.base)
+    changed_headers = set(p for p in changed if p.endswith(HEADER_EXTENSIONS))
+    deps = ninja_deps(build_dir)
+
+    selected = set(p for p in changed if p.endswith(SOURCE_EXTENSIONS) and p in entries)
+    if changed_headers:
+        for source, headers in deps.items():
+            if source in entries and changed_headers.intersection(headers):
+                selected.add(source)
+
+    print('{0} changed files, {1} of {2} translation units selected'.format(
+        len(changed), len(selected), len(entries)))
+    sys.stdout.flush()
+
+    config = tidy_config(args, repo)
+    file_digest = FileDigests()
+
+    def tidy(source):
+        key = None
+        if source in deps:
+            # Units missing from the dependency log were never built, so we
+            # do not know their headers and cannot cache their output.
+            key = cache_key(entries[source], deps[source][1:], config, file_digest)
+        return run_tidy(args, entries[source], key)
+
+    failed = False
+    cached = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        for result, from_cache in pool.map(tidy, sorted(selected)):
+            cached += from_cache
+            failed = failed or result['rc'] != 0
+            if result['output'].strip():
+                sys.stdout.write(result['output'])
+                sys.stdout.flush()
+
+    print('{0} translation units checked, {1} from cache'.format(len(selected), cached))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
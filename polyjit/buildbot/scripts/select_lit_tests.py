@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Select the lit tests affected by a build.
+
+A test is affected if
+ - the test file itself changed since the merge-base with the base branch
+   or since the commit the last successful test run checked,
+ - one of the tools its RUN lines use was relinked by the build, i.e. the
+   ninja output in the binary directory is newer than the stamp file that
+   was written before the build, or
+ - it is a unit test whose test binary was relinked.
+
+Skipping the other tests is only sound if the binaries the build did not
+relink passed the tests before. The stamp therefore holds the merge-base and
+the commit of the last successful test run in this build directory (see
+--verified), and all tests are affected if it holds nothing or another
+merge-base. All tests are affected as well if a lit configuration file
+changed.
+
+Prints a JSON object with the lit filter regex for the affected tests and
+the number of selected, skipped and total tests.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+RUN_RE = re.compile(r'\bRUN:(.*)$')
+TOKEN_RE = re.compile(r'%?[A-Za-z_][\w.+-]*')
+LIT_CONFIG_RE = re.compile(r'(^|/)lit(\.site)?\.(cfg|local\.cfg)(\.py|\.in)*$')
+
+
+def git(repo, *args):
+    return subprocess.check_output(('git', '-C', repo) + args,
+                                   universal_newlines=True).strip()
+
+
+def changed_files(repo, since):
+    files = git(repo, 'diff', '--name-only', since, 'HEAD')
+    return set(os.path.normpath(os.path.join(repo, f)) for f in files.splitlines() if f)
+
+
+def read_stamp(path):
+    """The commits a stamp records, or None if it records none."""
+    try:
+        with open(path) as f:
+            stamp = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(stamp, dict) or not stamp.get('base') or not stamp.get('head'):
+        return None
+    return stamp
+
+
+def full_suite_reason(repo, stamp, merge_base):
+    """Why all tests are affected, or None if the stamp can be trusted."""
+    if stamp is None:
+        return 'no successful test run in this build directory'
+    if stamp['base'] != merge_base:
+        return 'the last successful test run had another merge-base'
+    try:
+        git(repo, 'cat-file', '-e', stamp['head'] + '^{commit}')
+    except subprocess.CalledProcessError:
+        return 'the commit of the last successful test run is unknown'
+    return None
+
+
+def unittest_pattern(target):
+    """
+    Lit filter for the tests of a unit test binary.
+
+    lit names googletest tests '<dir>/./<binary>/<suite>.<test>', with the
+    directory of the binary relative to the unit test directory.
+    """
+    parts = target.split('/')
+    pattern = ''.join(re.escape(d) + '/' for d in parts[:-1])
+    return r'(^|[\s/])' + pattern + r'(\./)?' + re.escape(parts[-1]) + '/'
+
+
+def ninja_outputs(build_dir):
+    """All files ninja builds, relative to the build directory."""
+    output = subprocess.check_output(['ninja', '-C', build_dir, '-t', 'targets', 'all'],
+                                     universal_newlines=True)
+    return set(line.rsplit(':', 1)[0] for line in output.splitlines() if ':' in line)
+
+
+def relinked_outputs(build_dir, outputs, directory, stamp):
+    stamp_mtime = os.path.getmtime(stamp)
+    relinked = set()
+    for target in outputs:
+        if not target.startswith(directory + '/'):
+            continue
+        path = os.path.join(build_dir, target)
+        if os.path.isfile(path) and os.path.getmtime(path) > stamp_mtime:
+            relinked.add(target)
+    return relinked
+
+
+def used_tools(path):
+    tools = set()
+    try:
+        with open(path, errors='replace') as f:
+            for line in f:
+                match = RUN_RE.search(line)
+                if match:
+                    tools.update(t.lstrip('%') for t in TOKEN_RE.findall(match.group(1)))
+    except IOError:
+        pass
+    return tools
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--build-dir', required=True)
+    parser.add_argument('--repo', required=True)
+    parser.add_argument('--base', required=True,
+                        help='base branch, e.g. origin/vara-dev')
+    parser.add_argument('--test-dir', required=True,
+                        help='lit test directory in the repository')
+    parser.add_argument('--unittest-dir',
+                        help='directory of the unit test binaries, relative to the build dir')
+    parser.add_argument('--stamp', required=True,
+                        help='file that was touched right before the build')
+    parser.add_argument('--verified',
+                        help='write the commits for the stamp of the next build to '
+                             'this file, to be kept if the tests of this build pass')
+    args = parser.parse_args()
+
+    repo = os.path.abspath(args.repo)
+    test_dir = os.path.normpath(os.path.abspath(args.test_dir))
+    merge_base = git(repo, 'merge-base', 'HEAD', args.base)
+    head = git(repo, 'rev-parse', 'HEAD')
+    stamp = read_stamp(args.stamp)
+    reason = full_suite_reason(repo, stamp, merge_base)
+    changed = changed_files(repo, merge_base)
+    if reason is None:
+        changed |= changed_files(repo, stamp['head'])
+    outputs = ninja_outputs(args.build_dir)
+    relinked = relinked_outputs(args.build_dir, outputs, 'bin', args.stamp)
+    relinked_tools = set(os.path.basename(t) for t in relinked)
+
+    tests = []
+    for root, dirs, files in os.walk(test_dir):
+        dirs[:] = [d for d in dirs if d not in ('Inputs', 'Output')]
+        for name in files:
+            path = os.path.join(root, name)
+            tools = used_tools(path)
+            if tools:
+                tests.append((path, tools))
+
+    if reason is None and any(LIT_CONFIG_RE.search(p) for p in changed):
+        reason = 'a lit configuration changed'
+    full = reason is not None
+    selected = []
+    for path, tools in tests:
+        if full or path in changed or tools & relinked_tools:
+            selected.append(os.path.relpath(path, test_dir))
+
+    patterns = [re.escape(p) + '$' for p in sorted(selected)]
+    unittests = 0
+    if args.unittest_dir:
+        for target in sorted(relinked_outputs(args.build_dir, outputs, args.unittest_dir,
+                                              args.stamp)):
+            patterns.append(unittest_pattern(os.path.relpath(target, args.unittest_dir)))
+            unittests += 1
+
+    if args.verified:
+        with open(args.verified, 'w') as f:
+            json.dump({'base': merge_base, 'head': head}, f)
+
+    print(json.dumps({
+        'full': full,
+        'reason': reason,
+        'filter': '' if full else '|'.join(patterns),
+        'selected': len(selected),
+        'skipped': len(tests) - len(selected),
+        'total': len(tests),
+        'unittests': unittests,
+    }))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,17 @@
 from buildbot.plugins import worker
 
+from polyjit.buildbot import artifacts, ccacheserver
+
+# URL of the shared compiler cache served by polyjit.buildbot.ccacheserver,
+# e.g. "http://<master host>:8011". Leave empty to use only local caches.
+# If set, the master serves the cache; it needs a secrets provider with the
+# secret ccacheserver.TOKEN_SECRET.
+CCACHE_REMOTE_STORAGE = ""
+# URL of the artifact store served by polyjit.buildbot.artifacts,
+# e.g. "http://<master host>:8012". If set, the master serves the store; it
+# needs a secrets provider with the secret artifacts.TOKEN_SECRET.
+ARTIFACT_STORE_URL = ""
+
 infosun = {
     "bayreuther01": {
         "host": "bayreuther01",
@@ -8,7 +20,14 @@ infosun = {
             "uchroot_image_path": "/local/hdd/buildbot/disco-image/",
             "uchroot_binary": "/local/hdd/buildbot/erlent/build/uchroot",
             "has_munged": True,
-            "can_build_llvm_debug": True
+            "can_build_llvm_debug": True,
+            "worker_cores": 16,
+            "worker_memory_gb": 64,
+            "worker_scratch_gb": 500,
+            "uchroot_session": False,
+            "ccache_dir": "/local/hdd/buildbot/ccache",
+            "git_mirror_dir": "/local/hdd/buildbot/git-mirrors",
+            "artifact_cache_dir": "/local/hdd/buildbot/artifact-cache"
         }
     },
     "bayreuther02": {
@@ -18,7 +37,14 @@ infosun = {
             "uchroot_image_path": "/local/hdd/buildbot/disco-image/",
             "uchroot_binary": "/local/hdd/buildbot/erlent/build/uchroot",
             "has_munged": True,
-            "can_build_llvm_debug": True
+            "can_build_llvm_debug": True,
+            "worker_cores": 16,
+            "worker_memory_gb": 64,
+            "worker_scratch_gb": 500,
+            "uchroot_session": False,
+            "ccache_dir": "/local/hdd/buildbot/ccache",
+            "git_mirror_dir": "/local/hdd/buildbot/git-mirrors",
+            "artifact_cache_dir": "/local/hdd/buildbot/artifact-cache"
         }
     }
 }
@@ -39,5 +65,14 @@ def configure(c):
         props = {}
         if "properties" in slave:
             props = slave["properties"]
+        if CCACHE_REMOTE_STORAGE:
+            props = dict(props, ccache_remote_storage=CCACHE_REMOTE_STORAGE)
+        if ARTIFACT_STORE_URL:
+            props = dict(props, artifact_store_url=ARTIFACT_STORE_URL)
         c['workers'].append(worker.Worker(slave["host"], slave[
             "password"], properties = props))
+
+    if CCACHE_REMOTE_STORAGE:
+        ccacheserver.configure(c)
+    if ARTIFACT_STORE_URL:
+        artifacts.configure(c)
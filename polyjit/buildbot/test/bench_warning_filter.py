@@ -0,0 +1,84 @@
+"""
+Benchmark SourceFileWarningFilter against the alternation regex it replaced.
+
+Replays a build log through both warning matchers and prints the time each
+takes and the warnings each finds:
+
+    python -m polyjit.buildbot.test.bench_warning_filter \\
+        --log build-vara.log --source-list buildbot-source-file-list.txt
+
+The log is the stdio of a 'build VaRA' step and the source list the
+buildbot-source-file-list.txt of the same build. Without them a synthetic
+log of an LLVM build is generated.
+"""
+from __future__ import print_function
+
+import argparse
+import re
+import time
+
+from polyjit.buildbot.utils import SourceFileWarningFilter
+
+
+def alternation_pattern(source_files):
+    """The warningPattern the builders used before SourceFileWarningFilter."""
+    return re.compile('|'.join('.*' + re.escape(path) + '.*warning[: ].*'
+                               for path in source_files))
+
+
+def synthetic_build(files=2000, lines=20000, warnings=200):
+    """
+    Source list and ninja output of an LLVM build with some warnings.
+
+    Half of the warnings are in system headers, which are not in the list.
+    """
+    source_files = ['../../tools/VaRA/lib/Module{0}/Source{1}.cpp'.format(i % 40, i)
+                    for i in range(files)]
+    log = []
+    for i in range(lines):
+        if i % (lines // warnings) == 0:
+            if i // (lines // warnings) % 2:
+                path = source_files[i % files]
+            else:
+                path = '/usr/include/c++/9/bits/stl_header{0}.h'.format(i)
+            log.append('{0}:{1}:7: warning: unused variable \'x\' [-Wunused-variable]'.format(
+                path, i % 500))
+        else:
+            log.append('[{0}/{1}] Building CXX object lib/Support/CMakeFiles/'
+                       'LLVMSupport.dir/File{0}.cpp.o'.format(i, lines))
+    return source_files, log
+
+
+def replay(pattern, log):
+    start = time.time()
+    found = sum(1 for line in log if pattern.match(line))
+    return found, time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--log', help='recorded build log to replay')
+    parser.add_argument('--source-list', help='buildbot-source-file-list.txt of the build')
+    args = parser.parse_args(argv)
+
+    if args.log and args.source_list:
+        with open(args.source_list) as f:
+            source_files = [line.strip() for line in f if line.strip()]
+        with open(args.log, errors='replace') as f:
+            log = f.read().splitlines()
+    else:
+        source_files, log = synthetic_build()
+
+    results = []
+    for name, pattern in (('alternation regex', alternation_pattern(source_files)),
+                          ('SourceFileWarningFilter', SourceFileWarningFilter(source_files))):
+        found, seconds = replay(pattern, log)
+        results.append((found, seconds))
+        print('{0:<24} {1:>6} warnings in {2:.3f}s'.format(name, found, seconds))
+    print('{0} lines, {1} source files, speedup {2:.0f}x'.format(
+        len(log), len(source_files), results[0][1] / max(results[1][1], 1e-9)))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import fcntl
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.trial import unittest
+from twisted.web import server
+
+from buildbot.process.properties import Properties
+
+from polyjit.buildbot import artifacts
+from polyjit.buildbot import slaves
+from polyjit.buildbot import utils
+from polyjit.buildbot.scripts import artifact
+
+SCRIPT = os.path.join(utils.SCRIPT_SOURCE_DIR, 'artifact.py')
+
+
+class ExtractCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cache = artifact.ExtractCache(os.path.join(self.tmp, 'cache'), 1024)
+        self.extracted = []
+
+    def extract(self, content, size=1):
+        def extract_into(directory):
+            self.extracted.append(content)
+            with open(os.path.join(directory, 'file'), 'w') as f:
+                f.write(content * size)
+        return extract_into
+
+    def read(self, *path):
+        with open(os.path.join(self.tmp, *path)) as f:
+            return f.read()
+
+    def test_archive_is_extracted_once(self):
+        self.assertFalse(self.cache.materialize('a', os.path.join(self.tmp, 'b1'),
+                                                self.extract('a')))
+        self.assertTrue(self.cache.materialize('a', os.path.join(self.tmp, 'b2', 'x'),
+                                               self.extract('a')))
+        self.assertEqual(self.extracted, ['a'])
+        self.assertEqual(self.read('b2', 'x', 'file'), 'a')
+
+    def test_writes_to_a_copy_do_not_reach_the_cache(self):
+        self.cache.materialize('a', os.path.join(self.tmp, 'b1'), self.extract('a'))
+        with open(os.path.join(self.tmp, 'b1', 'file'), 'a') as f:
+            f.write('changed')
+
+        self.cache.materialize('a', os.path.join(self.tmp, 'b2'), self.extract('a'))
+        self.assertEqual(self.read('cache', 'a', 'file'), 'a')
+        self.assertEqual(self.read('b2', 'file'), 'a')
+        self.assertNotEqual(os.stat(os.path.join(self.tmp, 'b1', 'file')).st_ino,
+                            os.stat(os.path.join(self.tmp, 'cache', 'a', 'file')).st_ino)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.materialize('a', os.path.join(self.tmp, 'b1'), self.extract('a', 400))
+        os.utime(self.cache.size_path('a'), (1, 1))
+        self.cache.materialize('b', os.path.join(self.tmp, 'b2'), self.extract('b', 400))
+        os.utime(self.cache.size_path('b'), (2, 2))
+        self.cache.materialize('c', os.path.join(self.tmp, 'b3'), self.extract('c', 400))
+
+        self.assertFalse(os.path.exists(self.cache.entry('a')))
+        self.assertTrue(os.path.exists(self.cache.entry('b')))
+        self.assertTrue(os.path.exists(self.cache.entry('c')))
+        self.assertEqual(self.read('b1', 'file'), 'a' * 400)
+
+    def test_other_entries_are_used_during_an_extraction(self):
+        self.cache.materialize('a', os.path.join(self.tmp, 'b1'), self.extract('a'))
+
+        def extract_b(directory):
+            # Would wait for the extraction if it held the lock of the cache.
+            self.assertTrue(self.cache.materialize('a', os.path.join(self.tmp, 'b2'),
+                                                   self.extract('a')))
+            self.extract('b')(directory)
+        self.assertFalse(self.cache.materialize('b', os.path.join(self.tmp, 'b3'), extract_b))
+        self.assertEqual(self.read('b2', 'file'), 'a')
+        self.assertEqual(self.read('b3', 'file'), 'b')
+
+    def test_entries_in_use_are_not_evicted(self):
+        self.cache.materialize('a', os.path.join(self.tmp, 'b1'), self.extract('a', 400))
+        os.utime(self.cache.size_path('a'), (1, 1))
+        self.cache.materialize('b', os.path.join(self.tmp, 'b2'), self.extract('b', 400))
+        os.utime(self.cache.size_path('b'), (2, 2))
+        with self.cache.entry_locked('a', fcntl.LOCK_SH):
+            self.cache.materialize('c', os.path.join(self.tmp, 'b3'), self.extract('c', 400))
+        self.assertTrue(os.path.exists(self.cache.entry('a')))
+        self.assertFalse(os.path.exists(self.cache.entry('b')))
+
+        self.cache.materialize('d', os.path.join(self.tmp, 'b4'), self.extract('d', 400))
+        self.assertFalse(os.path.exists(self.cache.entry('a')))
+        self.assertFalse(os.path.exists(self.cache.lock_path('a')))
+
+
+
+class RemoteCommand(object):
+    """Runs the command of a step in a thread, like a worker would."""
+
+    def __init__(self, command, stdin, workdir, token):
+        self.command = command
+        self.stdin = stdin
+        self.workdir = workdir
+        self.token = token
+        self.stdout = ''
+        self.rc = None
+
+    @defer.inlineCallbacks
+    def run(self):
+        env = dict(os.environ, ARTIFACT_STORE_TOKEN=self.token)
+        proc = yield threads.deferToThread(
+            subprocess.run, [sys.executable] + self.command[1:], input=self.stdin.encode(),
+            cwd=self.workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.stdout = proc.stdout.decode()
+        self.stderr = proc.stderr.decode()
+        self.rc = proc.returncode
+
+    def didFail(self):
+        return self.rc != 0
+
+    def results(self):
+        return utils.SUCCESS if self.rc == 0 else utils.FAILURE
+
+
+class Build(object):
+
+    def __init__(self, properties):
+        self.properties = properties
+
+    def getProperties(self):
+        return self.properties
+
+    def render(self, value):
+        return self.properties.render(value)
+
+
+class ArtifactServer(object):
+
+    def __init__(self, storage):
+        self.storage = storage
+
+
+class Master(object):
+
+    def __init__(self, storage):
+        self.namedServices = {'artifact-store': ArtifactServer(storage)}
+
+
+class ArtifactDownloadTest(unittest.TestCase):
+    """ArtifactDownload and scripts/artifact.py against a local artifact store."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.workdir = os.path.join(self.tmp, 'build')
+        os.mkdir(self.workdir)
+        self.patch(slaves, 'ARTIFACT_STORE_URL', 'http://127.0.0.1')
+
+        self.storage = artifacts.ArtifactStorage(os.path.join(self.tmp, 'store'), 1024 ** 3)
+        resource = artifacts.ArtifactResource(self.storage, 'secret')
+        self.port = reactor.listenTCP(0, server.Site(resource), interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.store = 'http://127.0.0.1:{0}'.format(self.port.getHost().port)
+        self.random = random.Random(7)
+
+    def archive(self, content):
+        tree = os.path.join(self.tmp, 'tree')
+        shutil.rmtree(tree, ignore_errors=True)
+        os.mkdir(tree)
+        with open(os.path.join(tree, 'test.py'), 'wb') as f:
+            f.write(content)
+        path = os.path.join(self.tmp, 'tree.tar')
+        with tarfile.open(path, 'w') as tar:
+            tar.add(tree, arcname='.')
+        return path
+
+    @defer.inlineCallbacks
+    def upload(self, content):
+        command = [sys.executable, SCRIPT, '--store', self.store, 'upload',
+                   '--ref', 'shards/tree.tar', '--builder', 'vara', self.archive(content)]
+        out = yield threads.deferToThread(
+            subprocess.check_output, command, env=dict(os.environ, ARTIFACT_STORE_TOKEN='secret'))
+        defer.returnValue(json.loads(out.decode()))
+
+    def step(self, ref, dest, unpack=None):
+        """The ArtifactDownload step, run by a worker in the work directory."""
+        step = utils.ArtifactDownload(ref, dest, 'tree', unpack=unpack)
+        step = step.get_step_factory().buildStep()
+        step.build = Build(Properties(artifact_store_url=self.store,
+                                      artifact_cache_dir=os.path.join(self.tmp, 'cache')))
+        step.master = Master(self.storage)
+        step.commands = []
+
+        def makeRemoteShellCommand(command, initialStdin, collectStdout):
+            step.commands.append(RemoteCommand(command, initialStdin, self.workdir, 'secret'))
+            return defer.succeed(step.commands[-1])
+        step.makeRemoteShellCommand = makeRemoteShellCommand
+        step.runCommand = lambda cmd: cmd.run()
+        return step
+
+    @defer.inlineCallbacks
+    def download(self, dest, unpack):
+        step = self.step('/shards/tree.tar', dest, unpack)
+        results = yield step.run()
+        self.assertEqual(results, utils.SUCCESS, step.commands[-1].stderr)
+        defer.returnValue((step, step.build.getProperties()))
+
+    def read(self, *path):
+        with open(os.path.join(self.workdir, *path), 'rb') as f:
+            return f.read()
+
+    @defer.inlineCallbacks
+    def test_download_and_unpack(self):
+        content = b'print(1)\n' * 1000
+        uploaded = yield self.upload(content)
+        self.assertEqual(uploaded['transferred'], uploaded['size'])
+
+        step, props = yield self.download('tree.tar', 'tree')
+        self.assertFalse(props.getProperty('have_newest_tree'))
+        self.assertEqual(props.getProperty('tree_digest'), uploaded['digest'])
+        self.assertEqual(step.statistics['bytes_transferred'], uploaded['size'])
+        self.assertEqual(self.read('tree', 'test.py'), content)
+
+        step, props = yield self.download('tree.tar', 'tree')
+        self.assertTrue(props.getProperty('have_newest_tree'))
+        self.assertEqual(step.descriptionDone, ['tree is up to date'])
+
+        # Streamed into a directory, extracted from the worker's cache.
+        step, props = yield self.download(None, 'stream')
+        self.assertEqual(self.read('stream', 'test.py'), content)
+        self.assertEqual(step.descriptionDone, ['tree from worker cache'])
+
+    @defer.inlineCallbacks
+    def test_new_version_is_sent_as_delta(self):
+        if shutil.which(artifacts.ZSTD) is None:
+            raise unittest.SkipTest("zstd is not installed")
+        content = bytes(self.random.getrandbits(8) for _ in range(256 * 1024))
+        yield self.upload(content)
+        yield self.download('tree.tar', 'tree')
+
+        uploaded = yield self.upload(content + b'changed')
+        step, props = yield self.download('tree.tar', 'tree')
+        self.assertEqual(props.getProperty('tree_digest'), uploaded['digest'])
+        self.assertLess(step.statistics['bytes_transferred'], uploaded['size'] // 10)
+        self.assertGreater(step.statistics['bytes_saved'], 0)
+        self.assertEqual(self.read('tree', 'test.py'), content + b'changed')
+
+    @defer.inlineCallbacks
+    def test_missing_reference_fails(self):
+        step = self.step('/shards/missing.tar', 'tree.tar')
+        results = yield step.run()
+        self.assertEqual(results, utils.FAILURE)
+        self.assertIn('404', step.commands[0].stderr)
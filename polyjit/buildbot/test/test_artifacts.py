@@ -0,0 +1,161 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.web import server
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from polyjit.buildbot import artifacts
+
+
+class Request(DummyRequest):
+
+    def getPassword(self):
+        return None
+
+
+class ArtifactStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.storage = artifacts.ArtifactStorage(self.tmp, 1024)
+        self.digest = hashlib.sha256(b'artifact').hexdigest()
+        self.storage.add(io.BytesIO(b'artifact'), self.digest, name='a/b')
+
+    def last_access_on_disk(self):
+        with open(self.storage.index_path) as f:
+            return json.load(f)['objects'][self.digest]['last_access']
+
+    def test_touch_is_saved_by_flush(self):
+        saved = self.last_access_on_disk()
+        self.storage.objects[self.digest]['last_access'] = saved - 10
+        self.storage.touch(self.digest)
+        self.assertEqual(self.last_access_on_disk(), saved)
+
+        self.storage.flush()
+        self.assertEqual(self.last_access_on_disk(),
+                         self.storage.objects[self.digest]['last_access'])
+        self.assertFalse(self.storage.dirty)
+
+
+class DeltaQuotaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.storage = artifacts.ArtifactStorage(self.tmp, 1024)
+        self.digests = []
+        for i, content in enumerate((b'a' * 300, b'b' * 300)):
+            self.digests.append(hashlib.sha256(content).hexdigest())
+            self.storage.add(io.BytesIO(content), self.digests[-1], name='ref{0}'.format(i))
+
+    def write_delta(self, size, mtime):
+        path = self.storage.delta_path(*self.digests)
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'd' * size)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_deltas_count_towards_the_quota(self):
+        self.write_delta(100, 1)
+        storage = artifacts.ArtifactStorage(self.tmp, 1024)
+        self.assertEqual(storage.size, 700)
+        self.assertEqual(storage.getStats()['deltas'], 1)
+
+    def test_deltas_are_evicted(self):
+        path = self.write_delta(400, 1)
+        storage = artifacts.ArtifactStorage(self.tmp, 1024)
+        storage.add(io.BytesIO(b'c' * 300), hashlib.sha256(b'c' * 300).hexdigest())
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(storage.size, 900)
+
+    def test_deltas_of_missing_artifacts_are_removed(self):
+        path = self.write_delta(100, 1)
+        os.remove(self.storage.path(self.digests[1]))
+        storage = artifacts.ArtifactStorage(self.tmp, 1024)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(storage.deltas, {})
+
+    def test_new_delta_is_counted(self):
+        if shutil.which(artifacts.ZSTD) is None:
+            raise unittest.SkipTest("zstd is not installed")
+        path = self.storage.delta(*self.digests)
+        self.assertEqual(self.storage.size, 600 + os.path.getsize(path))
+
+
+class ArtifactResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.storage = artifacts.ArtifactStorage(self.tmp, 1024)
+        self.resource = artifacts.ArtifactResource(self.storage, 'secret')
+
+    def request(self, method, path, token=None, body=b''):
+        request = Request(path.split('/'))
+        request.method = method
+        request.content = io.BytesIO(body)
+        if token is not None:
+            request.requestHeaders.addRawHeader(b'authorization', b'Bearer ' + token)
+        return request
+
+    def test_requests_without_token_are_rejected(self):
+        for token in (None, b'wrong'):
+            request = self.request(b'PUT', 'refs/a', token, b'0' * 64)
+            self.resource.render(request)
+            self.assertEqual(request.responseCode, 401)
+
+    def test_requests_with_token_are_served(self):
+        request = self.request(b'GET', '_stats', b'secret')
+        body = self.resource.render(request)
+        self.assertEqual(json.loads(body.decode())['objects'], 0)
+
+    @defer.inlineCallbacks
+    def put(self, path, body, headers=()):
+        request = self.request(b'PUT', path, b'secret', body)
+        for name, value in headers:
+            request.requestHeaders.addRawHeader(name, value)
+        result = self.resource.render(request)
+        if result == server.NOT_DONE_YET:
+            yield request.notifyFinish()
+        defer.returnValue(request.responseCode or 200)
+
+    @defer.inlineCallbacks
+    def test_uploads_and_references(self):
+        digest = hashlib.sha256(b'artifact').hexdigest()
+        self.assertEqual((yield self.put('objects/' + digest, b'artifact')), 201)
+        self.assertEqual((yield self.put('objects/' + digest, b'artifact',
+                                         [(b'x-artifact-ref', b'shards/tree')])), 200)
+        self.assertEqual(self.storage.lookup('shards/tree'), digest)
+        self.assertEqual((yield self.put('refs/other', digest.encode())), 200)
+        self.assertEqual((yield self.put('refs/missing', b'0' * 64)), 404)
+        self.assertEqual((yield self.put('objects/' + '0' * 64, b'artifact')), 422)
+        with open(self.storage.index_path) as f:
+            self.assertEqual(json.load(f)['refs'], {'shards/tree': digest, 'other': digest})
+
+    def test_concurrent_delta_requests_share_one_build(self):
+        builds = []
+
+        def deferToThread(fn, *args):
+            builds.append(defer.Deferred())
+            return builds[-1]
+        self.patch(artifacts.threads, 'deferToThread', deferToThread)
+
+        results = []
+        for _ in range(3):
+            self.resource.delta('a' * 64, 'b' * 64).addCallback(results.append)
+        self.resource.delta('c' * 64, 'b' * 64).addCallback(results.append)
+        self.assertEqual(len(builds), 2)
+
+        builds[0].callback('/deltas/ab')
+        self.assertEqual(results, ['/deltas/ab'] * 3)
+        self.resource.delta('a' * 64, 'b' * 64)
+        self.assertEqual(len(builds), 3)
+
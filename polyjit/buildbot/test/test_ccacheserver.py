@@ -0,0 +1,146 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyRequest
+
+from polyjit.buildbot import ccacheserver
+from polyjit.buildbot import tokenauth
+
+
+class Request(DummyRequest):
+
+    password = None
+
+    def getPassword(self):
+        return self.password
+
+
+class CcacheStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.storage = ccacheserver.CcacheStorage(os.path.join(self.tmp, 'cache'), 30)
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.storage.get('ab12', 'vara'))
+        self.storage.put('ab12', b'object', 'vara')
+        self.assertEqual(self.storage.get('ab12', 'vara-opt'), b'object')
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp, 'cache', 'ab', 'ab12')))
+        self.assertEqual(self.storage.getStats()['builders'], {
+            'vara': {'hits': 0, 'misses': 1, 'writes': 1},
+            'vara-opt': {'hits': 1, 'misses': 0, 'writes': 0},
+        })
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for key in ('aa1', 'aa2', 'aa3'):
+            self.storage.put(key, b'0123456789', 'vara')
+        self.storage.get('aa1', 'vara')
+        self.storage.put('aa4', b'0123456789', 'vara')
+        self.assertEqual(list(self.storage.entries), ['aa3', 'aa1', 'aa4'])
+        self.assertEqual(self.storage.size, 30)
+        self.assertIsNone(self.storage.get('aa2', 'vara'))
+
+    def test_order_is_restored_on_startup(self):
+        for age, key in enumerate(('aa3', 'aa1', 'aa2')):
+            self.storage.put(key, b'0123456789', 'vara')
+            mtime = time.time() - 100 + age
+            os.utime(self.storage.path(key), (mtime, mtime))
+        storage = ccacheserver.CcacheStorage(os.path.join(self.tmp, 'cache'), 20)
+        self.assertEqual(list(storage.entries), ['aa1', 'aa2'])
+        self.assertFalse(os.path.exists(self.storage.path('aa3')))
+
+    def test_existing_prefix_directory(self):
+        os.makedirs(os.path.dirname(self.storage.path('ab34')))
+        self.storage.put('ab34', b'object', 'vara')
+        self.assertEqual(self.storage.get('ab34', 'vara'), b'object')
+
+
+class CcacheResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.storage = ccacheserver.CcacheStorage(self.tmp, 1024)
+        self.resource = ccacheserver.CcacheResource(self.storage, 'secret')
+
+    @defer.inlineCallbacks
+    def request(self, method, path, body=b'', token=b'secret', password=None):
+        request = Request([s.encode() for s in path.split('/')])
+        request.method = method
+        request.content = io.BytesIO(body)
+        request.password = password
+        if token is not None:
+            request.requestHeaders.addRawHeader(b'authorization', b'Bearer ' + token)
+        result = self.resource.render(request)
+        if result == server.NOT_DONE_YET:
+            yield request.notifyFinish()
+        else:
+            request.write(result)
+        defer.returnValue((request.responseCode or 200, b''.join(request.written)))
+
+    @defer.inlineCallbacks
+    def test_put_and_get(self):
+        code, _ = yield self.request(b'PUT', 'vara/ab/cdef', b'object')
+        self.assertEqual(code, 201)
+        self.assertEqual((yield self.request(b'GET', 'vara-opt/abcdef')), (200, b'object'))
+        self.assertEqual((yield self.request(b'HEAD', 'vara/ab/cdef'))[0], 200)
+
+        code, body = yield self.request(b'GET', '_stats')
+        stats = json.loads(body.decode())
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['builders']['vara-opt']['hits'], 1)
+
+    @defer.inlineCallbacks
+    def test_missing_entries(self):
+        self.assertEqual((yield self.request(b'GET', 'vara/ab/cdef')), (404, b''))
+        self.assertEqual((yield self.request(b'HEAD', 'vara/ab/cdef'))[0], 404)
+        self.assertEqual((yield self.request(b'DELETE', 'vara/ab/cdef'))[0], 404)
+        self.assertEqual((yield self.request(b'GET', 'vara/../passwd'))[0], 400)
+
+    @defer.inlineCallbacks
+    def test_requests_without_token_are_rejected(self):
+        for token in (None, b'wrong'):
+            code, _ = yield self.request(b'PUT', 'vara/abcdef', b'object', token=token)
+            self.assertEqual(code, 401)
+        self.assertEqual(self.storage.entries, {})
+
+    @defer.inlineCallbacks
+    def test_token_as_basic_auth_password(self):
+        code, _ = yield self.request(b'GET', 'vara/abcdef', token=None, password=b'secret')
+        self.assertEqual(code, 404)
+
+
+class TokenAuthTest(unittest.TestCase):
+
+    def request(self, authorization=None, password=None):
+        request = Request([])
+        request.password = password
+        if authorization is not None:
+            request.requestHeaders.addRawHeader(b'authorization', authorization)
+        return request
+
+    def test_supplied_token(self):
+        self.assertEqual(tokenauth.supplied_token(self.request(b'Bearer abc ')), b'abc')
+        self.assertEqual(tokenauth.supplied_token(self.request(b'bearer abc')), b'abc')
+        self.assertEqual(tokenauth.supplied_token(self.request(password=b'abc')), b'abc')
+        self.assertIsNone(tokenauth.supplied_token(self.request()))
+
+    def test_authorized(self):
+        self.assertTrue(tokenauth.authorized(self.request(b'Bearer abc'), 'abc'))
+        self.assertFalse(tokenauth.authorized(self.request(b'Bearer abd'), 'abc'))
+        self.assertFalse(tokenauth.authorized(self.request(), 'abc'))
+
+    def test_deny(self):
+        request = self.request()
+        self.assertEqual(tokenauth.deny(request, 'ccache'), b'')
+        self.assertEqual(request.responseCode, 401)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'www-authenticate'),
+                         [b'Basic realm="ccache"'])
@@ -0,0 +1,97 @@
+import json
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.trial import unittest
+from twisted.web import resource
+from twisted.web import server
+
+from buildbot.util import httpclientservice
+from buildbot.util import service
+
+from polyjit.buildbot import github
+
+
+class PullRequestFiles(resource.Resource):
+    """Stand-in for the pulls/files endpoint of the GitHub API."""
+
+    isLeaf = True
+
+    def __init__(self, files):
+        resource.Resource.__init__(self)
+        self.files = files
+        self.requests = []
+        self.body = None
+
+    def render_GET(self, request):
+        self.requests.append(request.uri)
+        if self.body is not None:
+            return self.body
+        per_page = int(request.args[b'per_page'][0])
+        page = int(request.args[b'page'][0])
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(self.files[(page - 1) * per_page:page * per_page]).encode()
+
+
+class Master(service.MasterService):
+    reactor = reactor
+
+
+class GetPullRequestFilesTest(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.patch(github, '_pr_files_cache', github.OrderedDict())
+        self.patch(github, 'PR_FILES_PER_PAGE', 2)
+        files = [
+            {'filename': 'a.cpp', 'status': 'modified'},
+            {'filename': 'b.cpp', 'status': 'added'},
+            {'filename': 'c.cpp', 'status': 'removed'},
+            {'filename': 'new.h', 'status': 'renamed', 'previous_filename': 'old.h'},
+            {'filename': 'd.cpp', 'status': 'copied'},
+        ]
+        self.api = PullRequestFiles(files)
+        self.port = reactor.listenTCP(0, server.Site(self.api), interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+
+        master = Master()
+        master.httpservice = httpclientservice.HTTPClientService('')
+        yield master.httpservice.setServiceParent(master)
+        yield master.startService()
+        self.addCleanup(master.stopService)
+
+        self.handler = github.CustomGitHubHandler(
+            None, False, master=master,
+            github_api_endpoint='http://127.0.0.1:{0}'.format(self.port.getHost().port))
+
+    @defer.inlineCallbacks
+    def test_pages_and_renames(self):
+        files = yield self.handler._get_pr_files('org/repo', 7, 'abc')
+        self.assertEqual(files, {'added': ['b.cpp', 'new.h', 'd.cpp'],
+                                 'removed': ['c.cpp', 'old.h'],
+                                 'modified': ['a.cpp']})
+        self.assertEqual(len(self.api.requests), 3)
+        self.assertIn(b'/repos/org/repo/pulls/7/files', self.api.requests[0])
+
+    @defer.inlineCallbacks
+    def test_head_is_fetched_once(self):
+        first = yield self.handler._get_pr_files('org/repo', 7, 'abc')
+        second = yield self.handler._get_pr_files('org/repo', 7, 'abc')
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.api.requests), 3)
+
+        yield self.handler._get_pr_files('org/repo', 7, 'def')
+        self.assertEqual(len(self.api.requests), 6)
+
+    @defer.inlineCallbacks
+    def test_invalid_json(self):
+        self.api.body = b'<html>'
+        files = yield self.handler._get_pr_files('org/repo', 7, 'abc')
+        self.assertIsNone(files)
+        self.assertNotIn(('org/repo', 'abc'), github._pr_files_cache)
+
+    @defer.inlineCallbacks
+    def test_connection_error(self):
+        yield self.port.stopListening()
+        files = yield self.handler._get_pr_files('org/repo', 7, 'abc')
+        self.assertIsNone(files)
@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+from twisted.trial import unittest
+
+from polyjit.buildbot.scripts import incremental_tidy
+
+FAKE_TIDY = """
+import json, os, sys
+database = sys.argv[sys.argv.index('-p') + 1]
+with open(os.path.join(database, 'compile_commands.json')) as f:
+    entries = json.load(f)
+for entry in entries:
+    print('{0}: warning: checked with {1}'.format(entry['file'], ' '.join(sys.argv[3:])))
+"""
+
+
+class IncrementalTidyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_cache_key_covers_headers_outside_the_repository(self):
+        source = self.write('a.cpp', '#include <llvm/ADT/StringRef.h>\n')
+        header = self.write('StringRef.h', 'class StringRef;\n')
+        entry = {'file': source, 'command': 'clang++ -c a.cpp'}
+
+        before = incremental_tidy.cache_key(entry, [header], 'config',
+                                            incremental_tidy.FileDigests())
+        self.write('StringRef.h', 'class StringRef {};\n')
+        after = incremental_tidy.cache_key(entry, [header], 'config',
+                                           incremental_tidy.FileDigests())
+        self.assertNotEqual(before, after)
+
+    def test_cache_key_covers_command_and_config(self):
+        source = self.write('a.cpp', 'int a;\n')
+        entry = {'file': source, 'command': 'clang++ -c a.cpp'}
+        digests = incremental_tidy.FileDigests()
+        key = incremental_tidy.cache_key(entry, [], 'config', digests)
+
+        self.assertNotEqual(key, incremental_tidy.cache_key(entry, [], 'other', digests))
+        self.assertNotEqual(key, incremental_tidy.cache_key(
+            {'file': source, 'command': 'clang++ -O2 -c a.cpp'}, [], 'config', digests))
+
+    def test_run_tidy_uses_tidy_script_and_caches_output(self):
+        source = self.write('a.cpp', 'int a;\n')
+        args = argparse.Namespace(build_dir=self.tmp,
+                                  cache_dir=os.path.join(self.tmp, 'cache'),
+                                  tidy_script=self.write('tidy-vara.py', FAKE_TIDY),
+                                  tidy_args=['--gcc'])
+        entry = {'file': source, 'directory': self.tmp, 'command': 'clang++ -c a.cpp'}
+
+        result, cached = incremental_tidy.run_tidy(args, entry, 'ab' * 32)
+        self.assertFalse(cached)
+        self.assertEqual(result['rc'], 0)
+        self.assertIn('a.cpp: warning: checked with -j 1 --gcc', result['output'])
+
+        os.remove(args.tidy_script)
+        self.assertEqual(incremental_tidy.run_tidy(args, entry, 'ab' * 32), (result, True))
+
+    def test_run_tidy_without_key_is_not_cached(self):
+        source = self.write('a.cpp', 'int a;\n')
+        args = argparse.Namespace(build_dir=self.tmp,
+                                  cache_dir=os.path.join(self.tmp, 'cache'),
+                                  tidy_script=self.write('tidy-vara.py', FAKE_TIDY),
+                                  tidy_args=[])
+        entry = {'file': source, 'directory': self.tmp, 'command': 'clang++ -c a.cpp'}
+
+        incremental_tidy.run_tidy(args, entry, None)
+        self.assertFalse(os.path.exists(args.cache_dir))
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['a.cpp', 'tidy-vara.py'])
+
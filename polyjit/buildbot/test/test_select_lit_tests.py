@@ -0,0 +1,76 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+from twisted.trial import unittest
+
+from polyjit.buildbot.scripts import select_lit_tests
+
+
+class UnittestPatternTest(unittest.TestCase):
+
+    def assertSelects(self, target, name):
+        self.assertTrue(re.search(select_lit_tests.unittest_pattern(target), name),
+                        '{0} does not select {1}'.format(target, name))
+
+    def assertNotSelects(self, target, name):
+        self.assertFalse(re.search(select_lit_tests.unittest_pattern(target), name),
+                         '{0} selects {1}'.format(target, name))
+
+    def test_googletest_names(self):
+        self.assertSelects('Utils/VaRAUtilsTests',
+                           'VaRA-Unit :: Utils/./VaRAUtilsTests/UtilsTest.Split')
+        self.assertSelects('Utils/VaRAUtilsTests',
+                           'Utils/./VaRAUtilsTests/UtilsTest.Split')
+        self.assertSelects('VaRATests', 'VaRA-Unit :: ./VaRATests/Suite.Test')
+        self.assertSelects('VaRATests', 'VaRA-Unit :: VaRATests/Suite.Test')
+
+    def test_other_binaries(self):
+        self.assertNotSelects('Utils/VaRAUtilsTests',
+                              'VaRA-Unit :: Utils/./VaRAUtilsTests2/UtilsTest.Split')
+        self.assertNotSelects('Utils/VaRAUtilsTests',
+                              'VaRA-Unit :: MoreUtils/./VaRAUtilsTests/UtilsTest.Split')
+        self.assertNotSelects('VaRATests', 'VaRA-Unit :: ./MyVaRATests/Suite.Test')
+
+
+class StampTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.repo = os.path.join(self.tmp, 'repo')
+        os.mkdir(self.repo)
+        self.git('init', '-q')
+        self.git('-c', 'user.name=t', '-c', 'user.email=t@t',
+                 'commit', '-q', '--allow-empty', '-m', 'base')
+        self.base = select_lit_tests.git(self.repo, 'rev-parse', 'HEAD')
+        self.stamp = os.path.join(self.tmp, 'stamp')
+
+    def git(self, *args):
+        subprocess.check_call(('git', '-C', self.repo) + args)
+
+    def write_stamp(self, content):
+        with open(self.stamp, 'w') as f:
+            f.write(content)
+        return select_lit_tests.read_stamp(self.stamp)
+
+    def test_empty_stamp_runs_full_suite(self):
+        stamp = self.write_stamp('')
+        self.assertIsNone(stamp)
+        self.assertIsNotNone(select_lit_tests.full_suite_reason(self.repo, stamp, self.base))
+
+    def test_stamp_of_other_base_runs_full_suite(self):
+        stamp = self.write_stamp(json.dumps({'base': '0' * 40, 'head': self.base}))
+        self.assertIsNotNone(select_lit_tests.full_suite_reason(self.repo, stamp, self.base))
+
+    def test_stamp_of_unknown_commit_runs_full_suite(self):
+        stamp = self.write_stamp(json.dumps({'base': self.base, 'head': '1' * 40}))
+        self.assertIsNotNone(select_lit_tests.full_suite_reason(self.repo, stamp, self.base))
+
+    def test_stamp_of_same_base_is_trusted(self):
+        stamp = self.write_stamp(json.dumps({'base': self.base, 'head': self.base}))
+        self.assertIsNone(select_lit_tests.full_suite_reason(self.repo, stamp, self.base))
+
@@ -0,0 +1,132 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.trial import unittest
+
+from polyjit.buildbot import utils
+
+# Stands in for uchroot: runs the command on the host, with the build
+# directory (its first argument) where the container mounts it, at /mnt.
+FAKE_UCHROOT = """
+import os, sys
+root = sys.argv[1]
+args = [root + arg[4:] if arg.startswith('/mnt/') else arg for arg in sys.argv[2:]]
+os.execvp(args[0], args)
+"""
+
+
+def alive(pid):
+    """Whether a process runs, zombies do not count."""
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, IndexError):
+        return False
+
+
+def wait_until(condition, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.1)
+    return False
+
+
+class UchrootSessionTest(unittest.TestCase):
+
+    heartbeat_timeout = 1
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.dir = os.path.join(self.tmp, utils.UCHROOT_SESSION_DIR)
+        self.uchroot = os.path.join(self.tmp, 'uchroot.py')
+        with open(self.uchroot, 'w') as f:
+            f.write(FAKE_UCHROOT)
+
+    def start(self):
+        subprocess.check_call(
+            ['sh', '-c', utils.UCHROOT_SESSION_START, 'usession', self.dir,
+             utils.UCHROOT_SESSION_SERVER, str(self.heartbeat_timeout),
+             sys.executable, self.uchroot, self.tmp])
+        self.addCleanup(self.stop)
+        with open(os.path.join(self.dir, 'session.pid')) as f:
+            return int(f.read())
+
+    def stop(self):
+        subprocess.check_call(['sh', '-c', utils.UCHROOT_SESSION_STOP, 'usession', self.dir])
+
+    def client(self, *command, **kwargs):
+        return subprocess.Popen(
+            ['sh', '-c', utils.UCHROOT_SESSION_CLIENT, 'usession', self.dir,
+             kwargs.get('cwd', self.tmp), ''] + list(command),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def run_client(self, *command, **kwargs):
+        client = self.client(*command, **kwargs)
+        out, _ = client.communicate(timeout=30)
+        return client.returncode, out.decode()
+
+    def test_commands_run_in_the_session(self):
+        self.start()
+        os.mkdir(os.path.join(self.tmp, 'build'))
+        rc, out = self.run_client('sh', '-c', 'pwd; echo "it\'s $1"; exit 3', 'sh', 'done',
+                                  cwd=os.path.join(self.tmp, 'build'))
+        self.assertEqual(rc, 3)
+        self.assertEqual(out.splitlines(), [os.path.join(self.tmp, 'build'), "it's done"])
+
+        rc, out = self.run_client('true')
+        self.assertEqual((rc, out), (0, ''))
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['ready', 'requests', 'session.log', 'session.pid'])
+
+    def test_without_session(self):
+        rc, out = self.run_client('true')
+        self.assertEqual(rc, 255)
+        self.assertIn('no running uchroot session', out)
+
+    def abandon(self, how):
+        self.start()
+        pid_file = os.path.join(self.tmp, 'command.pid')
+        client = self.client('sh', '-c', 'echo $$ > "$1"; exec sleep 60', 'sh', pid_file)
+        self.assertTrue(wait_until(lambda: os.path.exists(pid_file)))
+        with open(pid_file) as f:
+            pid = int(f.read())
+        os.kill(client.pid, how)
+        client.wait()
+        self.assertTrue(wait_until(lambda: not alive(pid)))
+
+        # The session takes the next command.
+        self.assertEqual(self.run_client('echo', 'next'), (0, 'next\n'))
+
+    def test_killed_client_times_out(self):
+        self.abandon(signal.SIGKILL)
+
+    def test_interrupted_client_cancels(self):
+        self.abandon(signal.SIGTERM)
+
+    def test_stop_ends_the_session(self):
+        session = self.start()
+        pid_file = os.path.join(self.tmp, 'command.pid')
+        client = self.client('sh', '-c', 'echo $$ > "$1"; exec sleep 60', 'sh', pid_file)
+        self.assertTrue(wait_until(lambda: os.path.exists(pid_file)))
+        with open(pid_file) as f:
+            pid = int(f.read())
+
+        self.stop()
+        self.assertFalse(alive(session))
+        self.assertFalse(alive(pid))
+        self.assertFalse(os.path.exists(self.dir))
+        # Killed with its command, or told that the session is gone.
+        self.assertIn(client.wait(timeout=30), (128 + signal.SIGKILL, 255))
+
+    def test_stop_step_always_runs(self):
+        step = utils.usession_stop()
+        self.assertTrue(step.alwaysRun)
+        self.assertFalse(step.flunkOnFailure)
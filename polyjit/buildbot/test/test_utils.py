@@ -0,0 +1,522 @@
+import inspect
+
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.trial import unittest
+
+from buildbot import config
+from buildbot.schedulers import basic
+from buildbot.process.properties import Properties
+from buildbot.process.results import FAILURE
+from buildbot.process.results import SUCCESS
+
+from polyjit.buildbot import slaves
+from polyjit.buildbot import utils
+from polyjit.buildbot.test import bench_warning_filter
+
+
+class Change(object):
+
+    def __init__(self, *files):
+        self.files = list(files)
+
+
+class ImportantFilesTest(unittest.TestCase):
+
+    def test_documentation_is_not_important(self):
+        is_important = utils.important_files(exclude=utils.DOCUMENTATION_FILES)
+        self.assertFalse(is_important(Change('README.md', 'docs/vara/index.rst')))
+        self.assertFalse(is_important(Change('.github/workflows/build.yml')))
+        self.assertTrue(is_important(Change('README.md', 'lib/Foo.cpp')))
+
+    def test_changes_without_files_are_important(self):
+        is_important = utils.important_files(exclude=utils.DOCUMENTATION_FILES)
+        self.assertTrue(is_important(Change()))
+
+    def test_include(self):
+        is_important = utils.important_files(include=['lib/*', 'include/*'],
+                                             exclude=['*.md'])
+        self.assertTrue(is_important(Change('include/vara/Foo.h')))
+        self.assertFalse(is_important(Change('tools/foo.cpp', 'lib/README.md')))
+
+
+class SourceFileWarningFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = utils.SourceFileWarningFilter([
+            '../../tools/VaRA/lib/Feature/Feature.cpp',
+            '../../tools/VaRA/include/vara/Feature/Feature.h',
+            '../../tools/clang/lib/Sema/SemaDecl.cpp',
+            '',
+        ])
+
+    def test_source_files(self):
+        for line in [
+                '../../tools/VaRA/lib/Feature/Feature.cpp:12:3: warning: unused variable',
+                '../../tools/VaRA/include/vara/Feature/Feature.h:7: warning: extra ";"',
+                '/home/ci/vara-llvm/tools/clang/lib/Sema/SemaDecl.cpp:1:1: warning: x [-Wfoo]',
+                '\x1b[1m../../tools/VaRA/lib/Feature/Feature.cpp:12:3: \x1b[0;1;35mwarning: '
+                'unused\x1b[0m']:
+            self.assertTrue(self.filter.match(line), line)
+
+    def test_system_headers(self):
+        self.assertIsNone(self.filter.match(
+            '/usr/include/c++/9/bits/stl_vector.h:12:3: warning: deprecated'))
+        self.assertIsNone(self.filter.match(
+            '/usr/lib/gcc/x86_64-linux-gnu/9/include/xmmintrin.h:1:1: warning: unused'))
+
+    def test_third_party_paths(self):
+        self.assertIsNone(self.filter.match(
+            '../../tools/phasar/lib/Feature/Feature2.cpp:12:3: warning: unused variable'))
+        self.assertIsNone(self.filter.match(
+            '../../external/googletest/src/gtest.cc:3:1: warning: unused variable'))
+
+    def test_lines_that_are_no_warnings(self):
+        for line in [
+                '[12/3456] Building CXX object tools/VaRA/lib/Feature/Feature.cpp.o',
+                '../../tools/VaRA/lib/Feature/Feature.cpp:12:3: error: use of undeclared x',
+                '../../tools/VaRA/lib/Feature/Feature.cpp:12:3: note: see warning above',
+                '']:
+            self.assertIsNone(self.filter.match(line), line)
+
+    def test_agrees_with_the_alternation_regex(self):
+        source_files, log = bench_warning_filter.synthetic_build(
+            files=100, lines=1000, warnings=50)
+        regex = bench_warning_filter.replay(
+            bench_warning_filter.alternation_pattern(source_files), log)
+        indexed = bench_warning_filter.replay(utils.SourceFileWarningFilter(source_files), log)
+        self.assertEqual(regex[0], 25)
+        self.assertEqual(indexed[0], regex[0])
+
+
+class WorkerForBuilder(object):
+
+    def __init__(self, busy):
+        self.busy = busy
+
+    def isBusy(self):
+        return self.busy
+
+
+class Build(object):
+    """A build on a worker with `running` builds, itself included."""
+
+    def __init__(self, running):
+        self.workerforbuilder = self
+        self.worker = self
+        self.workerforbuilders = dict(
+            (i, WorkerForBuilder(i < running)) for i in range(running + 2))
+
+
+class UploadDirTest(unittest.TestCase):
+
+    def test_upload_dir_is_one_step(self):
+        step = utils.upload_dir('build/tree', 'trees/vara', name='upload tree')
+        self.assertIsInstance(step, utils.steps.DirectoryUpload)
+        self.assertEqual(step.name, 'upload tree')
+
+    def test_upload_dir_steps(self):
+        names = [step.name for step in utils.upload_dir_steps('build/tree', 'trees/vara')]
+        self.assertEqual(names, ['pack directory', 'upload directory', 'unpack directory',
+                                 'remove directory archive'])
+
+
+class CapacityTest(unittest.TestCase):
+
+    def render(self, renderer, running=1, **properties):
+        props = Properties(**properties)
+        props.build = Build(running)
+        return self.successResultOf(props.render(renderer))
+
+    def test_alone_on_the_worker(self):
+        props = dict(worker_cores=16, worker_memory_gb=64)
+        self.assertEqual(self.render(utils.parallel_jobs, **props), '16')
+        self.assertEqual(self.render(utils.load_limit, **props), '16')
+        self.assertEqual(self.render(utils.link_jobs, **props), '8')
+        self.assertEqual(self.render(utils.LLVM_PARALLEL_LINK_JOBS, **props),
+                         '-DLLVM_PARALLEL_LINK_JOBS=8')
+
+    def test_shared_worker(self):
+        props = dict(worker_cores=16, worker_memory_gb=64)
+        self.assertEqual(self.render(utils.parallel_jobs, running=2, **props), '8')
+        self.assertEqual(self.render(utils.load_limit, running=2, **props), '8')
+        self.assertEqual(self.render(utils.link_jobs, running=2, **props), '4')
+        self.assertEqual(self.render(utils.parallel_jobs, running=32, **props), '1')
+
+    def test_memory_bounds_the_jobs(self):
+        props = dict(worker_cores=32, worker_memory_gb=16)
+        self.assertEqual(self.render(utils.parallel_jobs, **props), '8')
+        self.assertEqual(self.render(utils.link_jobs, running=4, **props), '1')
+
+    def test_without_capacity_properties(self):
+        cores = utils.DEFAULT_WORKER_CORES
+        self.assertEqual(self.render(utils.parallel_jobs), str(cores))
+        self.assertEqual(self.render(utils.load_limit), str(cores))
+        self.assertEqual(self.render(utils.link_jobs), str(cores // 4))
+
+    def test_cache_sizes(self):
+        props = Properties(worker_scratch_gb=500)
+        self.assertEqual(utils.cache_size(props, 'ccache_max_size', 0.1), '50G')
+        props.setProperty('ccache_max_size', '20G', 'test')
+        self.assertEqual(utils.cache_size(props, 'ccache_max_size', 0.1), '20G')
+        self.assertIsNone(utils.cache_size(Properties(), 'ccache_max_size', 0.1))
+        self.assertEqual(self.render(utils.artifact_cache_args, worker_scratch_gb=500,
+                                     artifact_cache_dir='/cache'),
+                         ['--cache', '/cache', '--cache-size', '100G'])
+
+
+class ArtifactStoreConfigTest(unittest.TestCase):
+
+    def test_artifact_steps_need_the_store(self):
+        self.patch(slaves, 'ARTIFACT_STORE_URL', '')
+        with self.assertRaises(config.ConfigErrors) as e:
+            utils.hash_upload_to_master('tree', 'tree.tar', 'shards/tree.tar')
+        self.assertIn('slaves.ARTIFACT_STORE_URL', e.exception.errors[0])
+        with self.assertRaises(config.ConfigErrors):
+            utils.hash_download_from_master('shards/tree.tar', 'tree.tar', 'tree')
+
+    def test_artifact_steps_with_store(self):
+        self.patch(slaves, 'ARTIFACT_STORE_URL', 'http://master:8012')
+        self.assertEqual(len(utils.hash_upload_to_master('tree', 'tree.tar', 'shards/tree.tar')), 2)
+        step, = utils.hash_download_from_master('shards/tree.tar', 'tree.tar', 'tree')
+        self.assertEqual(step.name, 'download tree')
+
+
+class BranchChange(object):
+
+    def __init__(self, branch, codebase, repository):
+        self.branch = branch
+        self.codebase = codebase
+        self.project = ''
+        self.repository = repository
+
+
+class Classifications(object):
+
+    def __init__(self):
+        self.queries = []
+
+    def getChangeClassifications(self, sched_id, **kwargs):
+        self.queries.append(kwargs)
+        return {}
+
+
+class Parent(object):
+
+    def __init__(self):
+        self.master = self
+        self.db = self
+        self.schedulers = Classifications()
+
+
+def make_scheduler(factory, **kwargs):
+    scheduler = factory('sched', {'vara': {}, 'vara-llvm': {}}, ['builder'], **kwargs)
+    scheduler.reconfigService(*scheduler._config_args, **scheduler._config_kwargs)
+    return scheduler
+
+
+class CoalescingBranchSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = make_scheduler(utils.s_coalesce)
+        self.scheduler.parent = Parent()
+
+    def timer(self, branch, codebase):
+        return self.scheduler.getTimerNameForChange(
+            BranchChange(branch, codebase, 'https://github.com/se-passau/' + codebase))
+
+    def test_feature_branches_are_coalesced(self):
+        self.assertEqual(self.timer('f-Foo', 'vara'), self.timer('f-Foo', 'vara-llvm'))
+        self.scheduler.getChangeClassificationsForTimer(1, self.timer('f-Foo', 'vara'))
+        self.assertEqual(self.scheduler.master.schedulers.queries, [{'branch': 'f-Foo'}])
+
+    def test_pull_requests_are_built_per_codebase(self):
+        branch = 'refs/pull/7/merge'
+        self.assertNotEqual(self.timer(branch, 'vara'), self.timer(branch, 'vara-llvm'))
+        self.scheduler.getChangeClassificationsForTimer(1, self.timer(branch, 'vara'))
+        self.assertEqual(self.scheduler.master.schedulers.queries, [{
+            'branch': branch, 'codebase': 'vara', 'project': '',
+            'repository': 'https://github.com/se-passau/vara'}])
+
+    def test_coalesced_branches(self):
+        self.scheduler = make_scheduler(utils.s_coalesce, coalesceBranches='^(?:vara-dev)$')
+        self.assertEqual(self.timer('vara-dev', 'vara'), self.timer('vara-dev', 'vara-llvm'))
+        self.assertNotEqual(self.timer('f-Foo', 'vara'), self.timer('f-Foo', 'vara-llvm'))
+
+
+class AdaptiveBranchSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = make_scheduler(utils.s_adaptive, minDelay=10, maxDelay=100)
+
+    def test_lone_change_waits_min_delay(self):
+        self.assertEqual(self.scheduler.stableDelay('b', 1000), 10)
+
+    def test_burst_extends_the_delay(self):
+        self.scheduler.stableDelay('b', 1000)
+        self.scheduler.stableDelay('b', 1020)
+        self.assertEqual(self.scheduler.stableDelay('b', 1030), 40)
+
+    def test_delay_ends_max_delay_after_first_change(self):
+        self.scheduler.stableDelay('b', 1000)
+        self.scheduler.stableDelay('b', 1040)
+        self.assertEqual(self.scheduler.stableDelay('b', 1080), 20)
+        self.assertEqual(self.scheduler.stableDelay('b', 1100), 0)
+
+    def test_old_changes_do_not_count(self):
+        self.scheduler.stableDelay('b', 1000)
+        self.scheduler.stableDelay('b', 1040)
+        self.scheduler._first_change_times.pop('b')
+        self.assertEqual(self.scheduler.stableDelay('b', 1200), 10)
+        self.assertEqual(self.scheduler._change_times['b'], [1200])
+
+    def test_forgotten_changes_do_not_shorten_the_delay(self):
+        self.scheduler.stableDelay('b', 1000)
+        self.scheduler.forgetChanges()
+        self.assertEqual(self.scheduler.stableDelay('b', 1500), 10)
+
+    def test_branches_are_independent(self):
+        self.scheduler.stableDelay('a', 1000)
+        self.scheduler.stableDelay('a', 1030)
+        self.assertEqual(self.scheduler.stableDelay('b', 1030), 10)
+
+    def test_reconfig_keeps_running_timers(self):
+        self.scheduler.stableDelay('a', 1000)
+        self.scheduler.stableDelay('b', 1000)
+        self.scheduler._stable_timers['a'] = object()
+        self.scheduler.reconfigService(*self.scheduler._config_args,
+                                       **self.scheduler._config_kwargs)
+        self.assertEqual(list(self.scheduler._first_change_times), ['a'])
+        self.assertEqual(list(self.scheduler._change_times), ['a'])
+
+
+class SchedulerDatabase(object):
+
+    def __init__(self):
+        self.classified = {}
+
+    def classifyChanges(self, sched_id, classifications):
+        self.classified.update(classifications)
+        return defer.succeed(None)
+
+    def getChangeClassifications(self, sched_id, **kwargs):
+        return defer.succeed(dict(self.classified))
+
+    def flushChangeClassifications(self, sched_id, less_than):
+        self.classified = dict((changeid, important)
+                               for changeid, important in self.classified.items()
+                               if changeid >= less_than)
+        return defer.succeed(None)
+
+
+class AnyBranchSchedulerInternalsTest(unittest.TestCase):
+    """
+    AdaptiveBranchScheduler replaces gotChange and stableTimerFired of
+    AnyBranchScheduler and shares its timers, which are not a public API of
+    Buildbot. These tests fail if an upgrade changes them.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = make_scheduler(utils.s_adaptive, minDelay=10, maxDelay=100)
+        self.scheduler.parent = Parent()
+        self.scheduler.master.reactor = self.clock
+        self.scheduler.master.schedulers = SchedulerDatabase()
+        self.scheduler.serviceid = 1
+        self.buildsets = []
+
+        def addBuildsetForChanges(**kwargs):
+            self.buildsets.append(kwargs)
+            return defer.succeed(None)
+        self.scheduler.addBuildsetForChanges = addBuildsetForChanges
+
+    def change(self, number):
+        change = BranchChange('vara-dev', 'vara', 'https://github.com/se-passau/vara')
+        change.number = number
+        return change
+
+    def test_timer_state(self):
+        self.assertIsNone(self.scheduler._stable_timers['b'])
+        self.assertIsInstance(self.scheduler._stable_timers_lock, defer.DeferredLock)
+
+    def test_replaced_methods(self):
+        for name, args in (('gotChange', ['self', 'change', 'important']),
+                           ('stableTimerFired', ['self', 'timer_name']),
+                           ('getTimerNameForChange', ['self', 'change']),
+                           ('getChangeClassificationsForTimer',
+                            ['self', 'sched_id', 'timer_name'])):
+            method = getattr(basic.AnyBranchScheduler, name)
+            self.assertEqual(list(inspect.signature(method).parameters), args, name)
+        self.assertIn('_stable_timers', inspect.getsource(basic.BaseBasicScheduler.deactivate))
+
+    @defer.inlineCallbacks
+    def test_changes_are_built_when_the_timer_fires(self):
+        yield self.scheduler.gotChange(self.change(1), True)
+        self.clock.advance(5)
+        yield self.scheduler.gotChange(self.change(2), False)
+        self.clock.advance(9)
+        self.assertEqual(self.buildsets, [])
+
+        self.clock.advance(1)
+        buildset, = self.buildsets
+        self.assertEqual(buildset['changeids'], [1, 2])
+        self.assertEqual(buildset['properties'].getProperty('tree_stable_delay'), 10)
+        self.assertEqual(buildset['properties'].getProperty('tree_stable_wait'), 15)
+        self.assertEqual(self.scheduler.master.schedulers.classified, {})
+        self.assertIsNone(self.scheduler._stable_timers.get(
+            self.scheduler.getTimerNameForChange(self.change(1))))
+
+    @defer.inlineCallbacks
+    def test_unimportant_change_does_not_start_the_timer(self):
+        yield self.scheduler.gotChange(self.change(1), False)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class Config(object):
+    buildbotURL = 'http://buildbot/'
+
+
+class Data(object):
+    """Stand-in for the data API of the master with logs of numbered lines."""
+
+    def __init__(self, logs=None, steps=None):
+        self.logs = logs or {}
+        self.steps = steps or []
+        self.requests = []
+        self.held = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def answer(self, path, offset, limit):
+        if path[0] == 'logs':
+            lines = self.logs[path[1]][offset:offset + limit]
+            return {'content': ''.join('o' + line + '\n' for line in lines)}
+        if path[0] == 'steps':
+            if path[1] == 'broken':
+                raise RuntimeError('database gone')
+            return [{'logid': path[1], 'num_lines': len(self.logs[path[1]])}]
+        return self.steps
+
+    def get(self, path, offset=None, limit=None):
+        self.requests.append((path, offset, limit))
+        if self.held is None:
+            return defer.maybeDeferred(self.answer, path, offset, limit)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        d = defer.Deferred()
+        self.held.append((d, path, offset, limit))
+        return d
+
+    def release(self):
+        while self.held:
+            d, path, offset, limit = self.held.pop(0)
+            self.in_flight -= 1
+            d.callback(self.answer(path, offset, limit))
+
+
+class Master(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.config = Config()
+
+
+def numbered_lines(count, width=10):
+    return ['line {0}'.format(i).ljust(width, '.') for i in range(count)]
+
+
+class LogExcerptTest(unittest.TestCase):
+
+    def excerpt(self, lines, **kwargs):
+        master = Master(Data({7: lines}))
+        d = utils.get_log_excerpt(master, {'logid': 7, 'num_lines': len(lines)}, **kwargs)
+        return master.data, self.successResultOf(d)
+
+    def test_short_log_is_complete(self):
+        data, excerpt = self.excerpt(numbered_lines(5), head=2, tail=3)
+        self.assertEqual(excerpt, numbered_lines(5))
+        self.assertEqual(data.requests, [(('logs', 7, 'contents'), 0, 5)])
+
+    def test_long_log_keeps_head_and_tail(self):
+        lines = numbered_lines(1000)
+        data, excerpt = self.excerpt(lines, head=2, tail=3)
+        self.assertEqual(excerpt, lines[:2] + [
+            '... truncated 995 lines, full log at http://buildbot/api/v2/logs/7/raw ...'
+        ] + lines[-3:])
+        self.assertEqual(data.requests, [(('logs', 7, 'contents'), 0, 2),
+                                         (('logs', 7, 'contents'), 997, 3)])
+
+    def test_excerpt_fits_max_chars(self):
+        lines = numbered_lines(1000, width=100)
+        _, excerpt = self.excerpt(lines, head=20, tail=200, max_chars=2000)
+        self.assertLessEqual(len('\n'.join(excerpt)), 2000)
+        self.assertIn('... truncated 983 lines', excerpt[0])
+        self.assertEqual(excerpt[1:], lines[-17:])
+
+    def test_head_gives_way_to_the_tail(self):
+        lines = numbered_lines(1000, width=100)
+        _, excerpt = self.excerpt(lines, head=5, tail=10, max_chars=1400)
+        self.assertEqual(excerpt[:1], lines[:1])
+        self.assertIn('... truncated 989 lines', excerpt[1])
+        self.assertEqual(excerpt[2:], lines[-10:])
+
+
+class BuildResultsTest(unittest.TestCase):
+
+    report_steps = {r'^build$': {'full_report': True},
+                    r'^test \d+$': {'full_report': True},
+                    r'^format$': {'full_report': False}}
+
+    def render(self, data):
+        props = Properties(buildername='vara', buildnumber=1)
+        props.master = Master(data)
+        return utils.get_build_results(props, 'Results', self.report_steps)
+
+    def test_steps_are_reported(self):
+        data = Data({'b': ['compiling', 'error: oops'], 'f': ['ok']}, [
+            {'stepid': 'b', 'name': 'build', 'results': FAILURE},
+            {'stepid': 'f', 'name': 'format', 'results': SUCCESS},
+            {'stepid': 'x', 'name': 'upload', 'results': FAILURE},
+        ])
+        comment = self.successResultOf(self.render(data))
+        self.assertEqual(comment.splitlines(), [
+            'Results',
+            ':boom: Step : build Result : failure',
+            '<details><summary>Click to show details</summary>', '',
+            '```', 'compiling', 'error: oops', '```', '',
+            '</details>', '',
+            ':heavy_check_mark: Step : format Result : success',
+        ])
+
+    def test_many_failed_steps_fit_one_comment(self):
+        logs = {}
+        steps = []
+        for i in range(40):
+            logs[i] = numbered_lines(5000, width=200)
+            steps.append({'stepid': i, 'name': 'test {0}'.format(i), 'results': FAILURE})
+        comment = self.successResultOf(self.render(Data(logs, steps)))
+        self.assertLessEqual(len(comment), utils.GITHUB_COMMENT_MAX_CHARS)
+        self.assertEqual(comment.count('... truncated'), 40)
+
+    def test_concurrent_requests_are_limited(self):
+        logs = {}
+        steps = []
+        for i in range(20):
+            logs[i] = numbered_lines(10)
+            steps.append({'stepid': i, 'name': 'test {0}'.format(i), 'results': FAILURE})
+        data = Data(logs, steps)
+        data.held = []
+        d = self.render(data)
+        while data.held:
+            data.release()
+        comment = self.successResultOf(d)
+        self.assertEqual(comment.count(':boom:'), 20)
+        self.assertEqual(data.max_in_flight, utils.PR_COMMENT_MAX_CONCURRENT_FETCHES)
+
+    def test_failed_request_fails_the_rendering(self):
+        data = Data({'b': ['ok']}, [
+            {'stepid': 'b', 'name': 'build', 'results': FAILURE},
+            {'stepid': 'broken', 'name': 'test 1', 'results': FAILURE},
+        ])
+        failure = self.failureResultOf(self.render(data), RuntimeError)
+        self.assertEqual(str(failure.value), 'database gone')
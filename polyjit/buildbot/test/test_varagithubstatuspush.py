@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.trial import unittest
+
+from polyjit.buildbot import varagithubstatuspush as push
+
+
+class Response(object):
+
+    def __init__(self, code, headers=None, body=b''):
+        self.code = code
+        self.headers = headers or {}
+        self.body = body
+
+    def content(self):
+        return defer.succeed(self.body)
+
+
+SECONDARY_LIMIT = (b'{"message": "You have exceeded a secondary rate limit. '
+                   b'Please wait a few minutes before you try again."}')
+
+
+class PushQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.responses = []
+        self.sent = []
+        self.queue = push.PushQueue(os.path.join(self.tmp, 'queue.json'), self.deliver,
+                                    self.clock)
+
+    def deliver(self, entry):
+        self.sent.append(entry['summary'])
+        return defer.succeed(self.responses.pop(0))
+
+    def entry(self):
+        return {'key': ['status'], 'state': 'success', 'summary': 'update', 'args': {},
+                'attempts': 0}
+
+    def test_success(self):
+        self.assertEqual(self.queue.evaluate(self.entry(), Response(201), None),
+                         (True, push.QUEUE_MIN_INTERVAL))
+
+    def test_exhausted_rate_limit_waits_for_reset(self):
+        res = Response(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1100'})
+        self.assertEqual(self.queue.evaluate(self.entry(), res, None), (False, 101))
+
+    def test_retry_after(self):
+        res = Response(403, {'Retry-After': '30'})
+        self.assertEqual(self.queue.evaluate(self.entry(), res, None), (False, 30))
+
+    def test_secondary_rate_limit_without_headers(self):
+        res = Response(403, body=SECONDARY_LIMIT)
+        self.assertEqual(self.queue.evaluate(self.entry(), res, None, SECONDARY_LIMIT),
+                         (False, push.QUEUE_RATE_LIMIT_WAIT))
+
+    def test_forbidden_is_dropped(self):
+        body = b'{"message": "Resource not accessible by integration"}'
+        res = Response(403, body=body)
+        self.assertEqual(self.queue.evaluate(self.entry(), res, None, body),
+                         (True, push.QUEUE_MIN_INTERVAL))
+
+    def test_server_errors_back_off(self):
+        entry = self.entry()
+        self.assertEqual(self.queue.evaluate(entry, Response(502), None),
+                         (False, push.QUEUE_BACKOFF))
+        self.assertEqual(self.queue.evaluate(entry, None, Exception('refused')),
+                         (False, push.QUEUE_BACKOFF * 2))
+        entry['attempts'] = push.QUEUE_MAX_ATTEMPTS - 1
+        self.assertTrue(self.queue.evaluate(entry, Response(502), None)[0])
+
+    def test_secondary_rate_limit_is_retried(self):
+        self.responses = [Response(403, body=SECONDARY_LIMIT), Response(201)]
+        self.queue.put(('status', 'se-passau', 'VaRA', 'abc', 'ctx', '7'), 'success', 'update',
+                       {})
+        self.queue.start()
+        self.clock.advance(0)
+        self.assertEqual(self.sent, ['update'])
+        with open(self.queue.path) as f:
+            self.assertEqual(len(json.load(f)['entries']), 1)
+
+        self.clock.advance(push.QUEUE_RATE_LIMIT_WAIT)
+        self.assertEqual(self.sent, ['update', 'update'])
+        self.assertEqual(self.queue.entries, [])
@@ -0,0 +1,44 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hmac
+
+from buildbot.process.properties import Interpolate
+from buildbot.util import unicode2bytes
+
+# The HTTP services of the master (ccacheserver, artifacts) only answer
+# requests that carry their token, either as the password of HTTP basic
+# authentication (the user name is ignored) or as a bearer token. Tokens are
+# buildbot secrets, so they do not show up in logs or build properties, and
+# must not contain characters that need escaping in URLs.
+
+
+def supplied_token(request):
+    """The token a request carries, or None."""
+    authorization = request.getHeader(b'authorization') or b''
+    if authorization[:7].lower() == b'bearer ':
+        return authorization[7:].strip()
+    return request.getPassword() or None
+
+
+def authorized(request, token):
+    supplied = supplied_token(request)
+    return supplied is not None and hmac.compare_digest(supplied, unicode2bytes(token))
+
+
+def deny(request, realm):
+    request.setResponseCode(401)
+    request.setHeader(b'www-authenticate', unicode2bytes('Basic realm="{0}"'.format(realm)))
+    return b''
+
+
+def url_with_token(url, user, secret):
+    """
+    Interpolate `url` with the buildbot secret `secret` as basic auth password.
+
+    Returns a renderable, e.g. 'http://host:8011' becomes
+    'http://<user>:<secret value>@host:8011'.
+    """
+    scheme, _, rest = url.partition('://')
+    return Interpolate('{0}://{1}:%(secret:{2})s@{3}'.format(
+        scheme, user, secret, rest.replace('%', '%%')))
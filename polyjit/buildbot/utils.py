@@ -1,11 +1,35 @@
 from buildbot.plugins import *
 from buildbot.steps.trigger import Trigger
 from buildbot.steps import master
-
+from buildbot.process import buildstep, logobserver, metrics
+from buildbot.process.properties import Properties
+from buildbot.process.results import FAILURE, SKIPPED, SUCCESS, WARNINGS
+from buildbot import config
+from buildbot.util import deferredLocked
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import log as twlog
+
+import fnmatch
+import json
 import os
+import re
+import shutil
+import time
+
+from polyjit.buildbot import artifacts, ccacheserver, slaves, tokenauth
 
 P = util.Property
 
+# Limits for log excerpts that are posted as GitHub PR comments.
+PR_COMMENT_LOG_HEAD_LINES = 20
+PR_COMMENT_LOG_TAIL_LINES = 200
+GITHUB_COMMENT_MAX_CHARS = 65536
+# Characters of a PR comment around the log excerpt of a step, without the
+# step name.
+PR_COMMENT_STEP_OVERHEAD = 120
+# Upper bound for concurrent data API requests of a single result renderer.
+PR_COMMENT_MAX_CONCURRENT_FETCHES = 8
+
 
 def builder(name, builddir, slaves, **kwargs):
     if builddir:
@@ -39,16 +63,304 @@ def ip(text):
 def git(name, branch, cb, **kwargs):
     repo = cb[name]['repository']
     mode = kwargs.pop("mode", "incremental")
-
-    return steps.Git(repourl=repo,
-                     branch=branch,
-                     name="checkout: {0}".format(repo),
-                     description="checkout: {0}@{1}".format(repo, branch),
-                     mode=mode,
-                     timeout=1200,
-                     codebase=name,
-                     progress=True,
-                     **kwargs)
+    reference = kwargs.pop("reference", git_mirror(name))
+
+    return TimedGit(repourl=repo,
+                    branch=branch,
+                    name="checkout: {0}".format(repo),
+                    description="checkout: {0}@{1}".format(repo, branch),
+                    mode=mode,
+                    timeout=1200,
+                    codebase=name,
+                    progress=True,
+                    reference=reference,
+                    **kwargs)
+
+
+class TimedGit(steps.Git):
+    """
+    Git step that records how long the checkout took and how much it fetched.
+
+    Sets the properties 'checkout_seconds_<codebase>' and
+    'checkout_bytes_<codebase>'. The transferred bytes are summed up from
+    git's progress output, so they are only known with `progress` enabled.
+    git only reports them for fetches it keeps as a pack, which
+    fetch.unpackLimit=1 makes it do for every fetch.
+    """
+
+    # git repeats the 100% progress line once more with ', done.' appended,
+    # so only that final line of every fetch is counted.
+    TRANSFER_RE = re.compile(r'Receiving objects:\s+100% \(\d+/\d+\), '
+                             r'([\d.]+) (bytes|KiB|MiB|GiB)[^,\r\n]*, done\.')
+    UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+    def __init__(self, **kwargs):
+        config = dict(kwargs.pop('config', None) or {})
+        config.setdefault('fetch.unpackLimit', '1')
+        steps.Git.__init__(self, config=config, **kwargs)
+        self.transferred = 0
+        self.addLogObserver('stdio', logobserver.LineConsumerLogObserver(self.transferConsumer))
+
+    def transferConsumer(self):
+        while True:
+            _, line = yield
+            for value, unit in self.TRANSFER_RE.findall(line):
+                self.transferred += int(float(value) * self.UNITS[unit])
+
+    @defer.inlineCallbacks
+    def run(self):
+        start = time.time()
+        res = yield steps.Git.run(self)
+        elapsed = time.time() - start
+
+        self.setProperty('checkout_seconds_' + self.codebase, round(elapsed, 1), 'TimedGit')
+        self.setProperty('checkout_bytes_' + self.codebase, self.transferred, 'TimedGit')
+        self.descriptionDone = ['checkout: {0} in {1:.0f}s, {2:.1f} MiB'.format(
+            self.codebase, elapsed, self.transferred / 1024.0 ** 2)]
+        defer.returnValue(res)
+
+
+# Checks out all repositories given as groups of 8 arguments
+# (codebase, directory, url, branch, revision, reference, filter, depth)
+# concurrently. The output of every checkout is prefixed with its codebase,
+# and every successful checkout prints '@@ <revision> <seconds>'. Fetches
+# keep what they receive as a pack, so git reports the transferred bytes in
+# its progress output (see TimedGit). The branch is either a branch name or
+# a full ref like refs/pull/<n>/merge, which is fetched as it is and checked
+# out as the local branch pull/<n>/merge. Instead of cloning, the
+# repositories are initialized in place, so nested checkouts (e.g. clang
+# inside llvm) do not depend on each other.
+MULTI_GIT_CHECKOUT = r"""
+clobber=$1
+shift
+
+checkout() {
+  dir=$2 url=$3 branch=$4 rev=$5 ref=$6 filter=$7 depth=$8
+  start=$(date +%s)
+  mkdir -p "$dir" && cd "$dir" || return 1
+  if [ ! -d .git ]; then
+    git init --quiet . && git remote add origin "$url" || return 1
+    if [ -n "$ref" ] && [ -d "$ref/objects" ]; then
+      echo "$ref/objects" > .git/objects/info/alternates
+    fi
+    if [ -n "$filter" ]; then
+      git config remote.origin.promisor true
+      git config remote.origin.partialclonefilter "$filter"
+    fi
+  else
+    git remote set-url origin "$url"
+    depth=
+  fi
+  case "$branch" in
+    refs/heads/*) fetch_ref=$branch local_branch=${branch#refs/heads/} ;;
+    refs/*) fetch_ref=$branch local_branch=${branch#refs/} ;;
+    *) fetch_ref=refs/heads/$branch local_branch=$branch ;;
+  esac
+  git -c fetch.unpackLimit=1 fetch --progress --force ${depth:+--depth "$depth"} origin \
+    "+$fetch_ref:refs/remotes/origin/$local_branch" || return 1
+  if [ -n "$rev" ]; then
+    git cat-file -e "$rev^{commit}" 2>/dev/null || git -c fetch.unpackLimit=1 fetch --progress origin "$rev" || return 1
+  fi
+  git checkout --quiet -f -B "$local_branch" "${rev:-refs/remotes/origin/$local_branch}" || return 1
+  git submodule update --init --recursive || return 1
+  echo "@@ $(git rev-parse HEAD) $(($(date +%s) - start))"
+}
+
+remove_all() {
+  while [ $# -ge 8 ]; do
+    rm -rf "$2"
+    shift 8
+  done
+}
+
+if [ "$clobber" = clobber ]; then
+  remove_all "$@"
+fi
+
+status=$(mktemp -d)
+while [ $# -ge 8 ]; do
+  name=$1
+  ( (checkout "$@"; echo $? > "$status/$name") 2>&1 | sed -u "s|^|[$name] |" ) &
+  shift 8
+done
+wait
+
+failed=0
+for rc in "$status"/*; do
+  if [ "$(cat "$rc")" != 0 ]; then
+    echo "checkout of $(basename "$rc") failed"
+    failed=1
+  fi
+done
+rm -rf "$status"
+exit $failed
+"""
+
+
+class MultiGit(buildstep.ShellMixin, steps.BuildStep):
+    """
+    Check out several codebases concurrently with one command on the worker.
+
+    `repos` is a list of dicts with the keys 'codebase', 'repourl', 'branch'
+    (used if the build has no branch for the codebase), 'workdir' and
+    optionally 'reference', 'shallow' and 'filters', like the arguments of
+    steps.Git. 'shallow' and 'filters' only apply to new clones. With
+    `clobber`, all checkouts are removed first.
+
+    Sets 'got_revision' for every codebase, and 'checkout_seconds_<codebase>'
+    and 'checkout_bytes_<codebase>' like TimedGit, from the progress output
+    of the fetches of each codebase.
+    """
+
+    RESULT_RE = re.compile(r'^\[(?P<codebase>[^\]]+)\] @@ (?P<revision>\w+) (?P<seconds>\d+)$')
+    PREFIX_RE = re.compile(r'^\[(?P<codebase>[^\]]+)\] ')
+
+    def __init__(self, repos, clobber=False, **kwargs):
+        self.repos = repos
+        self.clobber = clobber
+        kwargs.setdefault('workdir', ip('%(prop:builddir)s'))
+        kwargs.setdefault('timeout', 1200)
+        kwargs.setdefault('logEnviron', False)
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+        self.observer = logobserver.BufferLogObserver()
+        self.addLogObserver('stdio', self.observer)
+
+    @defer.inlineCallbacks
+    def checkout_args(self, repo):
+        branch = repo['branch']
+        revision = ''
+        sourcestamp = self.build.getSourceStamp(repo['codebase'])
+        if sourcestamp:
+            branch = sourcestamp.branch or branch
+            revision = sourcestamp.revision or ''
+
+        rendered = yield self.build.render([repo['workdir'], repo.get('reference')])
+        workdir, reference = rendered
+        filters = repo.get('filters') or []
+        defer.returnValue([repo['codebase'], workdir, repo['repourl'], branch, revision,
+                           reference or '', ','.join(filters),
+                           str(repo.get('shallow') or '')])
+
+    @defer.inlineCallbacks
+    def run(self):
+        command = ['sh', '-c', MULTI_GIT_CHECKOUT, 'multi-git',
+                   'clobber' if self.clobber else 'keep']
+        for repo in self.repos:
+            args = yield self.checkout_args(repo)
+            command.extend(args)
+
+        cmd = yield self.makeRemoteShellCommand(command=command)
+        yield self.runCommand(cmd)
+
+        revisions = {}
+        seconds = {}
+        transferred = {}
+        for line in self.observer.getStdout().splitlines():
+            match = self.RESULT_RE.match(line.strip())
+            if match:
+                revisions[match.group('codebase')] = match.group('revision')
+                seconds[match.group('codebase')] = int(match.group('seconds'))
+                continue
+            match = self.PREFIX_RE.match(line)
+            if match:
+                for value, unit in TimedGit.TRANSFER_RE.findall(line):
+                    transferred[match.group('codebase')] = (
+                        transferred.get(match.group('codebase'), 0) +
+                        int(float(value) * TimedGit.UNITS[unit]))
+
+        got_revision = self.getProperty('got_revision', {})
+        if not isinstance(got_revision, dict):
+            got_revision = {}
+        got_revision.update(revisions)
+        self.setProperty('got_revision', got_revision, 'MultiGit')
+
+        summary = []
+        for repo in self.repos:
+            codebase = repo['codebase']
+            if codebase not in seconds:
+                continue
+            self.setProperty('checkout_seconds_' + codebase, seconds[codebase], 'MultiGit')
+            fetched = transferred.get(codebase, 0)
+            self.setProperty('checkout_bytes_' + codebase, fetched, 'MultiGit')
+            summary.append('{0} {1}s {2:.1f} MiB'.format(
+                codebase, seconds[codebase], fetched / 1024.0 ** 2))
+
+        stdio = yield self.getLog('stdio')
+        yield stdio.addHeader('checkout times: {0}\n'.format(', '.join(summary)))
+        self.descriptionDone = ['checkout'] + summary
+
+        defer.returnValue(cmd.results())
+
+
+# Shared git mirrors
+#
+# Workers with the 'git_mirror_dir' property keep one bare mirror per
+# codebase in that directory (see slaves.py), shared by all builders of the
+# worker. New clones borrow their objects from the mirror via --reference,
+# so they only fetch what the mirror is missing and do not store a copy of
+# the history. uchroot containers mount the mirrors at the same path, so git
+# finds the borrowed objects inside the container as well. The mirrors are
+# refreshed by the git-mirrors builders.
+# Automatic gc is disabled in the mirrors, because pruning objects that
+# clones borrow would corrupt these clones.
+
+GIT_MIRROR_UPDATE = r"""
+set -e
+mirror_dir=$1
+fetch=$2
+shift 2
+mkdir -p "$mirror_dir"
+while [ $# -ge 2 ]; do
+  mirror="$mirror_dir/$1.git"
+  url=$2
+  shift 2
+  (
+    flock 9
+    if [ ! -d "$mirror" ]; then
+      rm -rf "$mirror.tmp"
+      git clone --mirror --quiet "$url" "$mirror.tmp"
+      git --git-dir="$mirror.tmp" config gc.auto 0
+      mv "$mirror.tmp" "$mirror"
+      echo "created $mirror"
+    elif [ "$fetch" = fetch ]; then
+      git --git-dir="$mirror" remote update --prune
+      echo "updated $mirror"
+    fi
+  ) 9>"$mirror.lock"
+done
+"""
+
+
+def git_mirror(name):
+    """Path of the mirror of codebase `name` on the worker, if it has mirrors."""
+    @util.renderer
+    def git_mirror_path(props):
+        mirror_dir = props.getProperty('git_mirror_dir')
+        if not mirror_dir:
+            return None
+        return os.path.join(mirror_dir, name + '.git')
+    return git_mirror_path
+
+
+def update_git_mirrors(repos, fetch=True, **kwargs):
+    """
+    Create the missing mirrors of `repos` (codebase name -> clone url).
+
+    With `fetch`, existing mirrors are updated from their remotes as well.
+    Does nothing on workers without the 'git_mirror_dir' property.
+    """
+    args = []
+    for name in sorted(repos):
+        args.extend([name, repos[name]])
+
+    return cmd("sh", "-c", GIT_MIRROR_UPDATE, "git-mirrors", P("git_mirror_dir"),
+               "fetch" if fetch else "no-fetch", *args,
+               name=kwargs.pop('name', 'update git mirrors' if fetch else 'create git mirrors'),
+               doStepIf=property_is_true('git_mirror_dir'),
+               hideStepIf=kwargs.pop('hideStepIf', lambda results, s: results == SKIPPED),
+               timeout=kwargs.pop('timeout', 3600),
+               **kwargs)
 
 
 def compile(*args, **kwargs):
@@ -63,6 +375,32 @@ def download_file(src, tgt, **kwargs):
     return steps.FileDownload(mastersrc=src, workerdest=tgt, **kwargs)
 
 
+# Helper scripts from polyjit/buildbot/scripts are copied into this directory
+# of the build directory, which is /mnt/<WORKER_SCRIPT_DIR> inside uchroot.
+WORKER_SCRIPT_DIR = 'bb-scripts'
+SCRIPT_SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts')
+
+
+def download_script(name, **kwargs):
+    """Copy one of the helper scripts of this package to the worker."""
+    return download_file(os.path.join(SCRIPT_SOURCE_DIR, name),
+                         script_path(name),
+                         mode=0o755,
+                         name=kwargs.pop('name', 'download {0}'.format(name)),
+                         hideStepIf=kwargs.pop('hideStepIf', True),
+                         **kwargs)
+
+
+def script_path(name):
+    """Path of a script copied by download_script on the worker."""
+    return ip("%(prop:builddir)s/{0}/{1}".format(WORKER_SCRIPT_DIR, name))
+
+
+def uscript(name):
+    """Path of a script copied by download_script inside uchroot."""
+    return os.path.join("/mnt", WORKER_SCRIPT_DIR, name)
+
+
 def rmdir(target, **kwargs):
     return steps.RemoveDirectory(dir=target, **kwargs)
 
@@ -91,29 +429,230 @@ def cmd(*args, **kwargs):
                               haltOnFailure=haltOnFailure, **kwargs)
 
 
+# Mount point of the worker's compiler cache (worker property 'ccache_dir')
+# inside the container.
+UCHROOT_CCACHE_DIR = '/ccache'
+
+
+def __ccache_env(env):
+    """
+    Render `env` plus the compiler cache settings of the worker.
+
+    Nothing is added on workers without a 'ccache_dir' property.
+    """
+    @util.renderer
+    def ccache_env(props):
+        new_env = dict(env)
+        if props.getProperty('ccache_dir'):
+            new_env["CCACHE_DIR"] = UCHROOT_CCACHE_DIR
+            max_size = cache_size(props, 'ccache_max_size', CCACHE_SCRATCH_SHARE)
+            if max_size:
+                new_env["CCACHE_MAXSIZE"] = max_size
+            if props.getProperty('ccache_remote_storage'):
+                # Shared cache on the master, see polyjit.buildbot.ccacheserver.
+                # ccache < 4.8 calls the remote storage 'secondary storage'.
+                remote_storage = tokenauth.url_with_token(
+                    "{0}/{1}".format(props.getProperty('ccache_remote_storage').rstrip('/'),
+                                     props.getProperty('buildername')),
+                    'ccache', ccacheserver.TOKEN_SECRET)
+                new_env["CCACHE_REMOTE_STORAGE"] = remote_storage
+                new_env["CCACHE_SECONDARY_STORAGE"] = remote_storage
+        return props.render(new_env)
+    return ccache_env
+
+
+def __ccache_mountargs(props):
+    if not props.getProperty('ccache_dir'):
+        return []
+    return ["-M", ip("%(prop:ccache_dir)s:" + UCHROOT_CCACHE_DIR)]
+
+
+def __git_mirror_mountargs(props):
+    """
+    Mount the git mirrors of the worker at the same path in the container.
+
+    Clones made with --reference to a mirror name it by its worker path in
+    .git/objects/info/alternates, and git inside the container needs the
+    mirror there to find the borrowed objects.
+    """
+    if not props.getProperty('git_mirror_dir'):
+        return []
+    return ["-M", ip("%(prop:git_mirror_dir)s:%(prop:git_mirror_dir)s")]
+
+
+CCACHE_LAUNCHER_VARIABLES = ['CMAKE_C_COMPILER_LAUNCHER', 'CMAKE_CXX_COMPILER_LAUNCHER']
+
+
+@util.renderer
+def __ccache_launcher_defines(props):
+    if props.getProperty('ccache_dir'):
+        return ['-D{0}=ccache'.format(var) for var in CCACHE_LAUNCHER_VARIABLES]
+    return ['-U{0}'.format(var) for var in CCACHE_LAUNCHER_VARIABLES]
+
+
+def ccache_launcher(builddir, **kwargs):
+    """
+    Set ccache as the compiler launcher in the CMake cache of `builddir`.
+
+    The CMAKE_<LANG>_COMPILER_LAUNCHER environment variables only take
+    effect when CMake configures a build directory for the first time, so
+    existing build directories are reconfigured with the cache entries
+    instead. On workers without a 'ccache_dir', the entries are removed.
+    """
+    env = kwargs.pop('env', {'PATH': '/opt/cmake/bin:/usr/local/bin:/usr/bin:/bin'})
+    return ucompile('cmake', __ccache_launcher_defines, '.',
+                    env=env,
+                    workdir=builddir,
+                    name=kwargs.pop('name', 'set compiler launcher'),
+                    hideStepIf=kwargs.pop('hideStepIf', True),
+                    haltOnFailure=kwargs.pop('haltOnFailure', True),
+                    ccache=True,
+                    **kwargs)
+
+
+def __uchroot_command(args, uid, gid, workdir, mounts, env, ccache=False, use_pty=False):
+    """
+    Render the command line of a step that runs `args` inside uchroot.
+
+    If the build runs a uchroot session (see usession_start) with the same
+    uid and gid and the step needs no extra mounts, the command is handed
+    to that session instead of starting a new container. With `ccache`, the
+    compiler cache of the worker is mounted as well, so such steps only use
+    a session that was started with `ccache`.
+    """
+    mount_args = __get_mountargs(mounts)
+    container_workdir = os.path.join("/mnt", workdir)
+
+    @util.renderer
+    @defer.inlineCallbacks
+    def uchroot_command(props):
+        session = props.getProperty(UCHROOT_SESSION_PROPERTY)
+        if (session and not mount_args and
+                [session['uid'], session['gid']] == [uid, gid] and
+                (session['ccache'] or not ccache)):
+            rendered_env = yield props.render(env)
+            env_args = ["{0}={1}".format(k, v) for k, v in sorted(rendered_env.items())]
+            command = ['sh', '-c', UCHROOT_SESSION_CLIENT, 'usession',
+                       ip("%(prop:builddir)s/" + UCHROOT_SESSION_DIR),
+                       container_workdir, 'pty' if use_pty else 'nopty',
+                       'env'] + env_args + list(args)
+        else:
+            extra_mount_args = list(mount_args) + __git_mirror_mountargs(props)
+            if ccache:
+                extra_mount_args.extend(__ccache_mountargs(props))
+            command = [P("uchroot_binary"), "-C", "-E", "-A",
+                       "-u", uid, "-g", gid,
+                       '-r', P("uchroot_image_path"),
+                       '-w', container_workdir,
+                       '-M', ip("%(prop:builddir)s:/mnt")] + extra_mount_args + list(args)
+        rendered = yield props.render(command)
+        defer.returnValue(rendered)
+    return uchroot_command
+
+
 def ucmd(*args, **kwargs):
     uid = kwargs.pop('uid', 0)
     gid = kwargs.pop('gid', 0)
     use_pty = kwargs.pop('usePTY', True)
     workdir = kwargs.pop('workdir', "build")
     mounts = kwargs.pop('mounts', [])
-    mount_args = __get_mountargs(mounts)
+    ccache = kwargs.pop('ccache', False)
     logEnviron = kwargs.pop('logEnviron', False)
+    haltOnFailure = kwargs.pop('haltOnFailure', True)
 
+    env = kwargs.pop('env', {})
+    env.update({"LC_ALL": "C"})
+    if ccache:
+        env = __ccache_env(env)
+
+    return steps.ShellCommand(
+        command=__uchroot_command(args, uid, gid, workdir, mounts, env, ccache, use_pty),
+        logEnviron=logEnviron,
+        haltOnFailure=haltOnFailure,
+        usePTY=use_pty,
+        env=env,
+        **kwargs)
+
+
+def ucmddef(*args, **kwargs):
+    """Set properties from the output of a command that runs inside uchroot."""
+    uid = kwargs.pop('uid', 0)
+    gid = kwargs.pop('gid', 0)
+    workdir = kwargs.pop('workdir', "build")
+    mounts = kwargs.pop('mounts', [])
 
     env = kwargs.pop('env', {})
     env.update({"LC_ALL": "C"})
 
-    new_args = tuple(mount_args) + args
-    return cmd(P("uchroot_binary"), "-C", "-E", "-A",
-               "-u", uid, "-g", gid,
-               '-r', P("uchroot_image_path"),
-               '-w', os.path.join("/mnt", workdir),
-               '-M', ip("%(prop:builddir)s:/mnt"),
-               logEnviron=logEnviron,
-               usePTY=use_pty,
-               env=env,
-               *new_args, **kwargs)
+    return cmddef(command=__uchroot_command(args, uid, gid, workdir, mounts, env),
+                  env=env,
+                  **kwargs)
+
+
+class UchrootCompile(steps.Compile):
+    """
+    Compile step for commands that run inside uchroot.
+
+    uchroot sporadically fails to set up /proc in the container right after
+    the previous uchroot invocation exited. Instead of running a throwaway
+    uchroot command and sleeping before every step, this step recognizes
+    that failure in its own output and re-runs the command in place, with
+    an exponential backoff starting at `procRetryDelay` seconds.
+
+    uchroot reports the failure with a message prefixed with its program
+    name before it starts the command, so only the messages of uchroot
+    itself that precede the first line of the command's output count.
+    """
+
+    UCHROOT_MESSAGE_RE = re.compile(r'^(?:\S*/)?uchroot: ')
+    PROC_FAILURE_RE = re.compile(r'^(?:\S*/)?uchroot: .*\bmount\b.*/proc\b')
+
+    def __init__(self, procRetries=3, procRetryDelay=0.1, **kwargs):
+        self.procRetries = procRetries
+        self.procRetryDelay = procRetryDelay
+        self.procFailure = False
+        self.commandStarted = False
+        steps.Compile.__init__(self, **kwargs)
+        self.addLogObserver('stdio',
+                            logobserver.LineConsumerLogObserver(self.procFailureConsumer))
+
+    def procFailureConsumer(self):
+        while True:
+            stream, line = yield
+            if stream == 'h' or self.commandStarted:
+                continue
+            if not self.UCHROOT_MESSAGE_RE.match(line):
+                self.commandStarted = True
+            elif self.PROC_FAILURE_RE.match(line):
+                self.procFailure = True
+
+    @defer.inlineCallbacks
+    def run(self):
+        yield self.setup_suppression()
+
+        attempt = 0
+        while True:
+            self.procFailure = False
+            self.commandStarted = False
+            cmd = yield self.makeRemoteShellCommand()
+            yield self.runCommand(cmd)
+            if not (cmd.didFail() and self.procFailure) or attempt >= self.procRetries:
+                break
+
+            delay = self.procRetryDelay * 2 ** attempt
+            attempt += 1
+            stdio = yield self.getLog('stdio')
+            yield stdio.addHeader(
+                "uchroot failed to set up /proc, retrying in {0:.1f}s "
+                "(attempt {1} of {2})\n".format(delay, attempt, self.procRetries))
+            yield task.deferLater(reactor, delay, lambda: None)
+
+        if attempt:
+            self.setProperty('uchroot_proc_retries', attempt, 'UchrootCompile')
+
+        yield self.finish_logs()
+        yield self.createSummary()
+        defer.returnValue(self.evaluateCommand(cmd))
 
 
 def ucompile(*args, **kwargs):
@@ -122,21 +661,468 @@ def ucompile(*args, **kwargs):
     use_pty = kwargs.pop('usePTY', True)
     workdir = kwargs.pop('workdir', "build")
     mounts = kwargs.pop('mounts', [])
-    mount_args = __get_mountargs(mounts)
+    ccache = kwargs.pop('ccache', False)
 
     env = kwargs.pop('env', {})
     env.update({"LC_ALL": "C"})
-    new_args = tuple(mount_args) + args
-
-    return compile(
-        P("uchroot_binary"),
-        "-C", "-E", "-A", "-u", uid, "-g", gid,
-        '-r', P("uchroot_image_path"), '-w',
-        os.path.join("/mnt", workdir),
-        '-M', ip("%(prop:builddir)s:/mnt"),
+    if ccache:
+        env = __ccache_env(env)
+
+    return UchrootCompile(
+        command=__uchroot_command(args, uid, gid, workdir, mounts, env, ccache, use_pty),
+        logEnviron=False,
         usePTY=use_pty,
         env=env,
-        *new_args, **kwargs)
+        **kwargs)
+
+
+# Persistent uchroot sessions
+#
+# With the 'uchroot_session' worker property set, a build enters the container
+# once (usession_start) and all following ucmd/ucompile steps with the same
+# uid and gid and without extra mounts send their command to a small request
+# loop running inside that container. Requests are exchanged through a FIFO
+# in the session directory, which is part of the build directory and
+# therefore visible on both sides of the chroot. Each step still streams the
+# output of its command into its own log and takes its result from the
+# command's exit code.
+#
+# The client keeps touching a heartbeat file while it waits for its command.
+# When the step is interrupted or times out, the client is killed and the
+# heartbeat stops (or the client leaves a cancel file, if it was only sent a
+# signal it can trap), and the request loop kills the process group of the
+# command.
+
+UCHROOT_SESSION_DIR = '.uchroot-session'
+# Build property of a running session, see UchrootSession.
+UCHROOT_SESSION_PROPERTY = 'uchroot_session_started'
+# Seconds without heartbeat after which the command of a request is killed.
+UCHROOT_SESSION_HEARTBEAT_TIMEOUT = 10
+
+# Runs inside the container: $1 is the session directory, $2 the heartbeat
+# timeout.
+UCHROOT_SESSION_SERVER = r"""
+dir="$1"; timeout="$2"
+setsid=
+command -v setsid >/dev/null 2>&1 && setsid=setsid
+touch "$dir/ready"
+while :; do
+    read -r req < "$dir/requests" || continue
+    [ "$req" = exit ] && break
+    r="$dir/$req"
+    if [ -f "$r.pty" ] && command -v script >/dev/null 2>&1; then
+        set -- script -qec "sh '$r.sh'" /dev/null
+    else
+        set -- sh "$r.sh"
+    fi
+    (
+        # The command runs in a process group of its own, so it can be
+        # killed with all of its children.
+        cd "$(cat "$r.cwd")" && $setsid sh -c 'echo $$ > "$1.pid"; shift; exec "$@"' sh "$r" "$@"
+        echo $? > "$r.status"
+    ) > "$r.out" 2>&1 < /dev/null &
+    abandoned=0
+    while [ ! -f "$r.status" ]; do
+        beat=$(stat -c %Y "$r.alive" 2>/dev/null || echo 0)
+        if [ -f "$r.cancel" ] || [ $(($(date +%s) - beat)) -gt "$timeout" ]; then
+            abandoned=1
+            pgid=$(cat "$r.pid" 2>/dev/null)
+            if [ -n "$pgid" ]; then
+                kill -TERM "-$pgid" 2>/dev/null || kill -TERM "$pgid" 2>/dev/null
+                sleep 2
+                kill -KILL "-$pgid" 2>/dev/null || kill -KILL "$pgid" 2>/dev/null
+            fi
+            break
+        fi
+        sleep 0.5
+    done
+    wait $!
+    mv "$r.status" "$r.rc"
+    if [ "$abandoned" = 1 ]; then
+        rm -f "$r".*
+    fi
+done
+"""
+
+# Runs on the worker: $1 is the session directory, $2 the working directory
+# inside the container, $3 'pty' if the command wants a terminal, the
+# remaining arguments are the command.
+UCHROOT_SESSION_CLIENT = r"""
+dir="$1"; cwd="$2"; pty="$3"; shift 3
+pid=$(cat "$dir/session.pid" 2>/dev/null)
+if [ -z "$pid" ] || ! kill -0 "$pid" 2>/dev/null; then
+    echo "no running uchroot session in $dir" >&2
+    exit 255
+fi
+req="req-$$"
+r="$dir/$req"
+printf '%s\n' "$cwd" > "$r.cwd"
+if [ "$pty" = pty ]; then
+    : > "$r.pty"
+fi
+for arg in "$@"; do
+    printf "'%s' " "$(printf '%s' "$arg" | sed "s/'/'\\\\''/g")"
+done > "$r.sh"
+: > "$r.out"
+touch "$r.alive"
+trap 'touch "$r.cancel"; exit 143' HUP INT TERM
+echo "$req" > "$dir/requests"
+off=0
+while :; do
+    touch "$r.alive"
+    finished=0
+    [ -f "$r.rc" ] && finished=1
+    size=$(wc -c < "$r.out")
+    if [ "$size" -gt "$off" ]; then
+        tail -c +"$((off + 1))" "$r.out" | head -c "$((size - off))"
+        off=$size
+    fi
+    [ "$finished" = 1 ] && break
+    if ! kill -0 "$pid" 2>/dev/null || [ ! -f "$r.alive" ]; then
+        echo "uchroot session exited while running the command" >&2
+        exit 255
+    fi
+    sleep 0.2
+done
+rc=$(cat "$r.rc")
+rm -f "$r".*
+exit "$rc"
+"""
+
+# Runs on the worker: $1 is the session directory, $2 the server script, $3
+# the heartbeat timeout, the remaining arguments are the uchroot invocation.
+UCHROOT_SESSION_START = r"""
+dir="$1"; server="$2"; timeout="$3"; shift 3
+rm -rf "$dir"
+mkdir -p "$dir"
+mkfifo "$dir/requests"
+setsid nohup "$@" sh -c "$server" usession "/mnt/$(basename "$dir")" "$timeout" \
+    > "$dir/session.log" 2>&1 < /dev/null &
+echo $! > "$dir/session.pid"
+i=0
+while [ ! -f "$dir/ready" ]; do
+    if ! kill -0 "$(cat "$dir/session.pid")" 2>/dev/null || [ "$i" -ge 600 ]; then
+        echo "uchroot session failed to start" >&2
+        cat "$dir/session.log" >&2
+        exit 1
+    fi
+    i=$((i + 1))
+    sleep 0.1
+done
+"""
+
+# Runs on the worker: $1 is the session directory. Commands that still run,
+# e.g. of an interrupted step, are killed first, so the request loop can
+# read the exit request.
+UCHROOT_SESSION_STOP = r"""
+dir="$1"
+for f in "$dir"/req-*.pid; do
+    [ -f "$f" ] && kill -KILL "-$(cat "$f")" 2>/dev/null
+done
+pid=$(cat "$dir/session.pid" 2>/dev/null)
+if [ -n "$pid" ] && kill -0 "$pid" 2>/dev/null; then
+    echo exit > "$dir/requests" &
+    writer=$!
+    i=0
+    while kill -0 "$pid" 2>/dev/null && [ "$i" -lt 100 ]; do
+        i=$((i + 1))
+        sleep 0.1
+    done
+    kill "$writer" 2>/dev/null
+    kill -TERM "-$pid" 2>/dev/null || kill "$pid" 2>/dev/null
+fi
+rm -rf "$dir"
+"""
+
+
+class UchrootSession(steps.ShellCommand):
+    """
+    Start or stop the uchroot session of a build.
+
+    Records the running session in the build property
+    UCHROOT_SESSION_PROPERTY as a dict with its 'uid', 'gid' and whether it
+    mounts the compiler cache ('ccache'); ucmd/ucompile steps only use a
+    session that matches their own settings. `session` is that dict for the
+    step that starts the session and None for the step that stops it.
+    """
+
+    def __init__(self, session=None, **kwargs):
+        self.session = session
+        steps.ShellCommand.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        if self.session is None:
+            self.setProperty(UCHROOT_SESSION_PROPERTY, None, 'UchrootSession')
+        res = yield steps.ShellCommand.run(self)
+        if self.session is not None and res == SUCCESS:
+            self.setProperty(UCHROOT_SESSION_PROPERTY, self.session, 'UchrootSession')
+        defer.returnValue(res)
+
+
+def usession_start(**kwargs):
+    """
+    Enter the container of a build once, if 'uchroot_session' is set.
+
+    Following ucmd/ucompile steps with the same `uid` and `gid` run in the
+    session. With `ccache`, the compiler cache of the worker is mounted into
+    the session, so ucmd/ucompile steps with `ccache` can run in it as well.
+    """
+    uid = kwargs.pop('uid', 0)
+    gid = kwargs.pop('gid', 0)
+    mounts = kwargs.pop('mounts', [])
+    mount_args = __get_mountargs(mounts)
+    ccache = kwargs.pop('ccache', False)
+
+    env = kwargs.pop('env', {})
+    env.update({"LC_ALL": "C"})
+
+    @util.renderer
+    def session_command(props):
+        extra_mount_args = list(mount_args) + __git_mirror_mountargs(props)
+        if ccache:
+            extra_mount_args.extend(__ccache_mountargs(props))
+        return props.render(
+            ['sh', '-c', UCHROOT_SESSION_START, 'usession',
+             ip("%(prop:builddir)s/" + UCHROOT_SESSION_DIR),
+             UCHROOT_SESSION_SERVER, str(UCHROOT_SESSION_HEARTBEAT_TIMEOUT),
+             P("uchroot_binary"), "-C", "-E", "-A",
+             "-u", uid, "-g", gid,
+             '-r', P("uchroot_image_path"),
+             '-w', "/mnt",
+             '-M', ip("%(prop:builddir)s:/mnt")] + extra_mount_args)
+
+    return UchrootSession(
+        session={'uid': uid, 'gid': gid, 'ccache': ccache},
+        command=session_command,
+        name=kwargs.pop('name', 'start uchroot session'),
+        doStepIf=property_is_true('uchroot_session'),
+        hideStepIf=lambda results, s: results == SKIPPED,
+        haltOnFailure=True,
+        logEnviron=False,
+        usePTY=False,
+        env=env,
+        **kwargs)
+
+
+def usession_stop(**kwargs):
+    """Leave the uchroot session started by usession_start."""
+    return UchrootSession(
+        command=['sh', '-c', UCHROOT_SESSION_STOP, 'usession',
+                 ip("%(prop:builddir)s/" + UCHROOT_SESSION_DIR)],
+        name=kwargs.pop('name', 'stop uchroot session'),
+        doStepIf=property_is_true('uchroot_session'),
+        hideStepIf=True,
+        alwaysRun=True,
+        haltOnFailure=False,
+        flunkOnFailure=False,
+        logEnviron=False,
+        usePTY=False,
+        **kwargs)
+
+
+class CcacheStats(buildstep.ShellMixin, steps.BuildStep):
+    """
+    Record compiler cache statistics of the worker as build properties.
+
+    Expects the output of 'ccache --print-stats'. The first run in a build
+    only stores a snapshot of the counters. Every later run sets
+    'ccache_hit_rate' (in percent) for the compilations since that snapshot
+    and 'ccache_size' (in bytes) for the whole cache.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+        self.observer = logobserver.BufferLogObserver()
+        self.addLogObserver('stdio', self.observer)
+
+    @staticmethod
+    def parse_stats(stdout):
+        stats = {}
+        for line in stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1].isdigit():
+                stats[fields[0]] = int(fields[1])
+        return stats
+
+    @defer.inlineCallbacks
+    def run(self):
+        command = yield self.makeRemoteShellCommand()
+        yield self.runCommand(command)
+
+        result = command.results()
+        if result == SUCCESS:
+            stats = self.parse_stats(self.observer.getStdout())
+            hits = stats.get('direct_cache_hit', 0) + stats.get('preprocessed_cache_hit', 0)
+            misses = stats.get('cache_miss', 0)
+
+            snapshot = self.getProperty('ccache_stats')
+            if snapshot is None:
+                self.setProperty('ccache_stats', {'hits': hits, 'misses': misses},
+                                 'CcacheStats')
+            else:
+                hits -= snapshot['hits']
+                misses -= snapshot['misses']
+                hit_rate = 0.0
+                if hits + misses > 0:
+                    hit_rate = round(100.0 * hits / (hits + misses), 2)
+                self.setProperty('ccache_hit_rate', hit_rate, 'CcacheStats')
+                self.setProperty('ccache_size',
+                                 stats.get('cache_size_kibibyte', 0) * 1024, 'CcacheStats')
+
+        defer.returnValue(result)
+
+
+def ccache_stats(**kwargs):
+    """Collect compiler cache statistics, if the worker has a 'ccache_dir'."""
+    env = __ccache_env({"LC_ALL": "C"})
+    return CcacheStats(
+        command=__uchroot_command(('ccache', '--print-stats'), 0, 0, "build", [], env,
+                                  ccache=True),
+        env=env,
+        logEnviron=False,
+        doStepIf=property_is_true('ccache_dir'),
+        hideStepIf=kwargs.pop('hideStepIf', lambda results, s: results == SKIPPED),
+        haltOnFailure=False,
+        flunkOnFailure=False,
+        warnOnFailure=True,
+        **kwargs)
+
+
+# Worker capacity
+#
+# Workers describe their capacity with the properties 'worker_cores',
+# 'worker_memory_gb' and 'worker_scratch_gb' (see slaves.py). The renderers
+# below split the cores and the memory evenly between the builds currently
+# running on the worker, so a build that is alone on a worker uses the whole
+# machine. The scratch disk bounds the caches of the worker.
+
+DEFAULT_WORKER_CORES = 8
+# Rough peak memory of a single compile job and of a single LLVM link job.
+COMPILE_JOB_MEMORY_GB = 2
+LINK_JOB_MEMORY_GB = 8
+
+
+def running_builds(props):
+    """Number of builds running on the worker of the current build."""
+    build = props.getBuild()
+    try:
+        worker = build.workerforbuilder.worker
+        busy = [wfb for wfb in worker.workerforbuilders.values() if wfb.isBusy()]
+    except AttributeError:
+        return 1
+    return max(1, len(busy))
+
+
+def __capacity_share(props):
+    builds = running_builds(props)
+    cores = props.getProperty('worker_cores') or DEFAULT_WORKER_CORES
+    memory = props.getProperty('worker_memory_gb')
+    cores = max(1, cores // builds)
+    if memory:
+        memory = max(1, memory // builds)
+    return cores, memory
+
+
+@util.renderer
+def parallel_jobs(props):
+    """Number of parallel compile/test jobs for the current build."""
+    cores, memory = __capacity_share(props)
+    if memory:
+        cores = min(cores, max(1, memory // COMPILE_JOB_MEMORY_GB))
+    return str(cores)
+
+
+@util.renderer
+def load_limit(props):
+    """Load average above which ninja starts no new jobs for the current build."""
+    cores, _ = __capacity_share(props)
+    return str(cores)
+
+
+@util.renderer
+def link_jobs(props):
+    """Number of parallel LLVM link jobs (LLVM_PARALLEL_LINK_JOBS)."""
+    cores, memory = __capacity_share(props)
+    if memory:
+        return str(max(1, min(cores, memory // LINK_JOB_MEMORY_GB)))
+    return str(max(1, cores // 4))
+
+
+# LLVM CMake option that limits the parallel link jobs, see link_jobs.
+LLVM_PARALLEL_LINK_JOBS = util.Interpolate('-DLLVM_PARALLEL_LINK_JOBS=%(kw:link_jobs)s',
+                                           link_jobs=link_jobs)
+
+# Shares of the scratch disk the caches of a worker use, unless it sets
+# 'ccache_max_size' or 'artifact_cache_max_size'.
+CCACHE_SCRATCH_SHARE = 0.1
+ARTIFACT_CACHE_SCRATCH_SHARE = 0.2
+
+
+def cache_size(props, prop, share):
+    """Size limit of a cache of the worker, like '50G', or None if unknown."""
+    size = props.getProperty(prop)
+    if size:
+        return size
+    scratch = props.getProperty('worker_scratch_gb')
+    if scratch:
+        return '{0}G'.format(max(1, int(scratch * share)))
+    return None
+
+
+@util.renderer
+def lit_opts(props):
+    """LIT_OPTS for lit test suites run through ninja."""
+    return props.render(util.Interpolate("-j %(kw:jobs)s", jobs=parallel_jobs))
+
+
+class SourceFileWarningFilter(object):
+    """
+    Match compiler warnings that belong to a known set of source files.
+
+    Can be passed as ``warningPattern`` to a compile step instead of a
+    regex built from one alternative per source file. The file path is
+    parsed out of each ``warning:`` line once and looked up in a set of
+    normalized paths, so the cost per output line no longer depends on
+    the number of source files.
+    """
+
+    WARNING_RE = re.compile(r'^(?P<path>[^:\s][^:]*):\d+(?::\d+)?:\s*warning[: ]')
+    ANSI_ESCAPE_RE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+    def __init__(self, source_files):
+        self.source_files = set()
+        for path in source_files:
+            path = path.strip()
+            if path:
+                self.source_files.add(self.__strip_updirs(path))
+
+    @staticmethod
+    def __strip_updirs(path):
+        parts = os.path.normpath(path).split(os.sep)
+        while parts and parts[0] in ('', '.', '..'):
+            parts.pop(0)
+        return '/'.join(parts)
+
+    def is_source_file(self, path):
+        parts = self.__strip_updirs(path).split('/')
+        # Compare the longest suffix first, so absolute paths still match
+        # the entries of a file list that is relative to the build dir.
+        for i in range(len(parts)):
+            if '/'.join(parts[i:]) in self.source_files:
+                return True
+        return False
+
+    def match(self, line):
+        if 'warning' not in line:
+            return None
+        if '\x1b' in line:
+            line = self.ANSI_ESCAPE_RE.sub('', line)
+        match = self.WARNING_RE.match(line)
+        if match and self.is_source_file(match.group('path')):
+            return match
+        return None
 
 
 def test(*args, **kwargs):
@@ -151,13 +1137,127 @@ def pylint(*args, **kwargs):
     return steps.PyLint(command=args, **kwargs)
 
 
+# Archives
+#
+# Directories are packed on the worker by scripts/archive.py with
+# multi-threaded zstd, or with pigz (parallel gzip) for consumers that cannot
+# read zstd. The level is the compressor's level: 1-19 for zstd (higher
+# levels need a lot of CPU time), 1-9 for pigz.
+
+ARCHIVE_COMPRESSION = 'zstd'
+ARCHIVE_LEVEL = 3
+ARCHIVE_SUFFIXES = {'zstd': '.tar.zst', 'pigz': '.tar.gz'}
+ARCHIVE_DECOMPRESSORS = {'zstd': 'zstd -d', 'pigz': 'pigz -d'}
+
+
+def record_transfer(step, nbytes, seconds, size=None, compressed=None):
+    """
+    Set the 'throughput' (MiB/s) and 'compression_ratio' statistics of `step`.
+
+    Returns a summary of both for the description of the step.
+    """
+    summary = []
+    if size and compressed:
+        ratio = float(size) / compressed
+        step.setStatistic('compression_ratio', ratio)
+        summary.append('ratio {0:.1f}'.format(ratio))
+    if nbytes and seconds:
+        throughput = nbytes / 1024.0 ** 2 / seconds
+        step.setStatistic('throughput', throughput)
+        summary.append('{0:.0f} MiB/s'.format(throughput))
+    return ', '.join(summary)
+
+
+class ArchivePack(buildstep.ShellMixin, steps.BuildStep):
+    """
+    Pack `paths` (relative to the workdir) into the compressed tar `archive`.
+
+    Runs scripts/archive.py, sent on stdin, on the worker. Records the size
+    of the packed files and of the archive as the step statistics 'bytes_in'
+    and 'bytes_out', along with the compression ratio and the throughput.
+    """
+
+    renderables = ['archive', 'paths', 'excludes']
+
+    def __init__(self, archive, paths, excludes=None, compression=ARCHIVE_COMPRESSION,
+                 level=ARCHIVE_LEVEL, **kwargs):
+        self.archive = archive
+        self.paths = paths
+        self.excludes = excludes or []
+        self.compression = compression
+        self.level = level
+        kwargs.setdefault('name', 'pack archive')
+        kwargs.setdefault('haltOnFailure', True)
+        kwargs.setdefault('logEnviron', False)
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        with open(os.path.join(SCRIPT_SOURCE_DIR, 'archive.py')) as f:
+            script = f.read()
+
+        command = ['python3', '-', '--compression', self.compression,
+                   '--level', str(self.level)]
+        for pattern in self.excludes:
+            command.extend(['--exclude', pattern])
+        command.append(self.archive)
+        command.extend(self.paths)
+
+        cmd = yield self.makeRemoteShellCommand(command=command, initialStdin=script,
+                                                collectStdout=True)
+        yield self.runCommand(cmd)
+        if cmd.didFail():
+            defer.returnValue(cmd.results())
+
+        result = json.loads(cmd.stdout.strip().splitlines()[-1])
+        self.setStatistic('bytes_in', result['size'])
+        self.setStatistic('bytes_out', result['compressed'])
+        summary = record_transfer(self, result['size'], result['seconds'],
+                                  size=result['size'], compressed=result['compressed'])
+        self.descriptionDone = ['packed {0:.1f} MiB ({1})'.format(
+            result['compressed'] / 1024.0 ** 2, summary)]
+        defer.returnValue(cmd.results())
+
+
 def upload_dir(srcdir, tgtdir, **kwargs):
-    return steps.DirectoryUpload(slavesrc=srcdir,
+    """
+    Copy `srcdir` on the worker to `tgtdir` on the master in a single step.
+
+    The tree is sent as a bz2 tar; upload_dir_steps is faster for large
+    trees.
+    """
+    return steps.DirectoryUpload(workersrc=srcdir,
                                  masterdest=tgtdir,
                                  compress="bz2",
                                  **kwargs)
 
 
+def upload_dir_steps(srcdir, tgtdir, compression=ARCHIVE_COMPRESSION, level=ARCHIVE_LEVEL,
+                     **kwargs):
+    """
+    Steps that copy the contents of `srcdir` on the worker to `tgtdir` on the master.
+
+    The directory is sent as one compressed archive (see ArchivePack), which
+    the master extracts into a clean `tgtdir`.
+    """
+    suffix = ARCHIVE_SUFFIXES[compression]
+    archive = ip("%(prop:builddir)s/upload-dir" + suffix)
+    masterdst = util.Interpolate("%(kw:dir)s" + suffix, dir=tgtdir)
+    return [
+        ArchivePack(archive, ['.'], compression=compression, level=level,
+                    workdir=srcdir, name="pack directory", **kwargs),
+        upload_file(src=archive, tgt=masterdst, name="upload directory", **kwargs),
+        master_cmd(["sh", "-c",
+                    'rm -rf "$2" && mkdir -p "$2" && tar -x -I "$3" -f "$1" -C "$2" '
+                    '&& rm -f "$1"',
+                    "unpack-dir", masterdst, tgtdir, ARCHIVE_DECOMPRESSORS[compression]],
+                   name="unpack directory", **kwargs),
+        cmd("rm", "-f", archive, name="remove directory archive",
+            hideStepIf=True, haltOnFailure=False, alwaysRun=True),
+    ]
+
+
 def master_cmd(command, **kwargs):
     if "haltOnFailure" not in kwargs:
         kwargs["haltOnFailure"] = True
@@ -194,6 +1294,171 @@ def s_abranch(name, cb, builders, **kwargs):
                                          **kwargs)
 
 
+class AdaptiveBranchScheduler(schedulers.AnyBranchScheduler):
+    """
+    AnyBranchScheduler whose tree-stable timer adapts to each branch.
+
+    Instead of a fixed treeStableTimer, the scheduler waits twice the median
+    gap between the recent changes of a branch, but at least `minDelay`
+    seconds: a lone push is built after `minDelay` seconds, while a burst of
+    pushes keeps extending the wait. Changes older than `maxDelay` seconds
+    do not count, and a build starts at most `maxDelay` seconds after the
+    first change it waited for.
+
+    Builds get the properties 'tree_stable_delay', the last delay the
+    scheduler chose, and 'tree_stable_wait', the seconds from the first
+    change to the start of the build.
+    """
+
+    compare_attrs = ('minDelay', 'maxDelay')
+
+    def __init__(self, name, **kwargs):
+        schedulers.AnyBranchScheduler.__init__(self, name, **kwargs)
+        self._change_times = {}
+        self._first_change_times = {}
+        self._delays = {}
+
+    def checkConfig(self, minDelay=10, maxDelay=5 * 60, **kwargs):
+        if not 0 < minDelay <= maxDelay:
+            config.error("minDelay must be positive and not larger than maxDelay")
+        schedulers.AnyBranchScheduler.checkConfig(self, treeStableTimer=maxDelay, **kwargs)
+
+    def reconfigService(self, minDelay=10, maxDelay=5 * 60, **kwargs):
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        # The history of branches without a running timer was recorded with
+        # the old delays.
+        self.forgetChanges(keep=[name for name, timer in self._stable_timers.items() if timer])
+        return schedulers.AnyBranchScheduler.reconfigService(self, treeStableTimer=maxDelay,
+                                                             **kwargs)
+
+    @defer.inlineCallbacks
+    def deactivate(self):
+        yield schedulers.AnyBranchScheduler.deactivate(self)
+        # The timers are cancelled, activate starts new ones for the pending
+        # changes.
+        self.forgetChanges()
+
+    def forgetChanges(self, keep=()):
+        """Drop the change history of all timers but those in `keep`."""
+        for state in (self._change_times, self._first_change_times, self._delays):
+            for timer_name in list(state):
+                if timer_name not in keep:
+                    del state[timer_name]
+
+    def stableDelay(self, timer_name, now):
+        """Seconds to wait for more changes after a change for `timer_name`."""
+        times = [t for t in self._change_times.get(timer_name, [])
+                 if now - t <= self.maxDelay] + [now]
+        self._change_times[timer_name] = times
+
+        gaps = sorted(b - a for a, b in zip(times, times[1:]))
+        delay = self.minDelay
+        if gaps:
+            delay = max(delay, 2 * gaps[len(gaps) // 2])
+        self._delays[timer_name] = delay
+
+        first = self._first_change_times.setdefault(timer_name, now)
+        return max(0, min(delay, first + self.maxDelay - now))
+
+    @deferredLocked('_stable_timers_lock')
+    def gotChange(self, change, important):
+        timer_name = self.getTimerNameForChange(change)
+
+        # Like AnyBranchScheduler, an important change starts the timer and
+        # an unimportant one only restarts a running timer.
+        if important or self._stable_timers[timer_name]:
+            if self._stable_timers[timer_name]:
+                self._stable_timers[timer_name].cancel()
+
+            def fire_timer():
+                d = self.stableTimerFired(timer_name)
+                d.addErrback(twlog.err, "while firing stable timer")
+
+            delay = self.stableDelay(timer_name, self.master.reactor.seconds())
+            self._stable_timers[timer_name] = self.master.reactor.callLater(delay, fire_timer)
+
+        return self.master.db.schedulers.classifyChanges(self.serviceid,
+                                                         {change.number: important})
+
+    @deferredLocked('_stable_timers_lock')
+    @defer.inlineCallbacks
+    def stableTimerFired(self, timer_name):
+        now = self.master.reactor.seconds()
+        first = self._first_change_times.pop(timer_name, None)
+        if not self._stable_timers.pop(timer_name, None):
+            return
+
+        classifications = yield self.getChangeClassificationsForTimer(self.serviceid,
+                                                                      timer_name)
+        if not classifications:
+            return
+
+        properties = Properties()
+        properties.setProperty('tree_stable_delay', self._delays.pop(timer_name, None),
+                               'Scheduler')
+        if first is not None:
+            properties.setProperty('tree_stable_wait', now - first, 'Scheduler')
+
+        changeids = sorted(classifications.keys())
+        yield self.addBuildsetForChanges(reason=self.reason, changeids=changeids,
+                                         properties=properties, priority=self.priority)
+        yield self.master.db.schedulers.flushChangeClassifications(
+            self.serviceid, less_than=changeids[-1] + 1)
+
+
+# Feature branches, which are pushed to several repositories under one name.
+FEATURE_BRANCH_REGEX = r"^f-"
+
+
+class CoalescingBranchScheduler(AdaptiveBranchScheduler):
+    """
+    Build the changes to a feature branch of all codebases in one buildset.
+
+    A feature pushes branches of the same name to several repositories
+    within seconds. AnyBranchScheduler waits for each codebase separately
+    and builds each push in a buildset of its own; this scheduler collects
+    the changes of all codebases to a branch matching `coalesceBranches`
+    with the adaptive timer of AdaptiveBranchScheduler and builds them
+    together. Other branches, e.g. pull request refs, whose names repeat
+    across repositories, keep a timer per codebase.
+    """
+
+    compare_attrs = ('coalesceBranches',)
+
+    def checkConfig(self, coalesceBranches=FEATURE_BRANCH_REGEX, **kwargs):
+        AdaptiveBranchScheduler.checkConfig(self, **kwargs)
+
+    def reconfigService(self, coalesceBranches=FEATURE_BRANCH_REGEX, **kwargs):
+        self.coalesceBranches = re.compile(coalesceBranches)
+        return AdaptiveBranchScheduler.reconfigService(self, **kwargs)
+
+    def getTimerNameForChange(self, change):
+        if change.branch and self.coalesceBranches.match(change.branch):
+            return change.branch
+        return AdaptiveBranchScheduler.getTimerNameForChange(self, change)
+
+    def getChangeClassificationsForTimer(self, sched_id, timer_name):
+        if isinstance(timer_name, tuple):
+            return AdaptiveBranchScheduler.getChangeClassificationsForTimer(
+                self, sched_id, timer_name)
+        return self.master.db.schedulers.getChangeClassifications(sched_id, branch=timer_name)
+
+
+def s_adaptive(name, cb, builders, **kwargs):
+    return AdaptiveBranchScheduler(name=name,
+                                   codebases=cb,
+                                   builderNames=builders,
+                                   **kwargs)
+
+
+def s_coalesce(name, cb, builders, **kwargs):
+    return CoalescingBranchScheduler(name=name,
+                                     codebases=cb,
+                                     builderNames=builders,
+                                     **kwargs)
+
+
 def s_trigger(name, cb, builders, **kwargs):
     return schedulers.Triggerable(name=name,
                                   codebases=cb,
@@ -201,6 +1466,49 @@ def s_trigger(name, cb, builders, **kwargs):
                                   **kwargs)
 
 
+# Files of the repositories that no builder builds, as fnmatch patterns of
+# paths relative to the repository ('*' also matches '/').
+DOCUMENTATION_FILES = ['docs/*', '*.md', '*.rst', 'README*', 'LICENSE*', 'CODE_OWNERS*',
+                       'CREDITS*', '.github/*', '.gitignore', '.mailmap']
+
+
+def important_files(include=None, exclude=None):
+    """
+    fileIsImportant function of a scheduler with path rules.
+
+    A change is important if one of its files matches a pattern of `include`
+    (all files, if it is None) and no pattern of `exclude`. Changes without
+    a file list are always important, because their files are not known.
+    """
+    def is_important(change):
+        if not change.files:
+            return True
+        for path in change.files:
+            if include is not None and not any(fnmatch.fnmatch(path, p) for p in include):
+                continue
+            if exclude and any(fnmatch.fnmatch(path, p) for p in exclude):
+                continue
+            return True
+        return False
+    return is_important
+
+
+# Pull request branches, which get a new head commit with every push.
+PR_BRANCH_REGEX = r"^refs/pull/\d+/merge$"
+
+
+def cancel_superseded(name, builders, branch_re=PR_BRANCH_REGEX):
+    """
+    Cancel the queued and running builds of `builders` for a branch as soon
+    as a build for a newer change of the same branch is requested.
+
+    The returned service belongs into c['services']. Triggered builds of a
+    cancelled build are cancelled with it.
+    """
+    return util.OldBuildCanceller(
+        name, filters=[(builders, util.SourceStampFilter(branch_re=branch_re))])
+
+
 def trigger(**kwargs):
     waitForFinish = kwargs.pop("waitForFinish", True)
     return Trigger(waitForFinish=waitForFinish, **kwargs)
@@ -214,6 +1522,281 @@ def extract_rc(propertyname):
     return extract_rc_wrapper
 
 
+def extract_json(propertyname):
+    name = propertyname
+
+    def extract_json_wrapper(rc, stdout, stderr):
+        if rc != 0:
+            return {}
+        return {name: json.loads(stdout)}
+    return extract_json_wrapper
+
+
+# The regression test selection (scripts/select_lit_tests.py) only trusts
+# binaries that the build did not relink if they passed the tests before.
+# After a test run passed, LIT_CANDIDATE, which holds the tested commits, is
+# kept as LIT_VERIFIED, and the next build turns it into LIT_STAMP.
+LIT_STAMP = '.bb-build-start'
+LIT_CANDIDATE = '.bb-lit-candidate'
+LIT_VERIFIED = '.bb-lit-verified'
+
+
+def lit_stamp(build_dir, **kwargs):
+    """Write the stamp for the test selection right before the build."""
+    return cmd('sh', '-c', 'mv -f {1} {0} 2>/dev/null || : > {0}; touch {0}'.format(
+        LIT_STAMP, LIT_VERIFIED),
+               workdir=build_dir, hideStepIf=kwargs.pop('hideStepIf', True), **kwargs)
+
+
+def lit_tests_passed(name):
+    """doStepIf that checks the result of the test step `name`."""
+    def passed(step):
+        for executed in step.build.executedSteps:
+            if executed.name == name:
+                return executed.results in (SUCCESS, WARNINGS, SKIPPED)
+        return False
+    return passed
+
+
+def keep_lit_stamp(build_dir, test_step_name, **kwargs):
+    """Keep the tested commits for the next build, if the tests passed."""
+    return cmd('mv', '-f', LIT_CANDIDATE, LIT_VERIFIED,
+               workdir=build_dir, doStepIf=lit_tests_passed(test_step_name),
+               haltOnFailure=False, flunkOnFailure=False,
+               hideStepIf=kwargs.pop('hideStepIf', True), **kwargs)
+
+
+def extract_lit_selection(rc, stdout, stderr):
+    """Turn the output of scripts/select_lit_tests.py into properties."""
+    if rc != 0:
+        return {}
+    selection = json.loads(stdout)
+    return {
+        'lit_full_suite': selection['full'],
+        'lit_full_suite_reason': selection['reason'],
+        'lit_filter': selection['filter'],
+        'lit_tests_selected': selection['selected'],
+        'lit_tests_skipped': selection['skipped'],
+        'lit_tests_total': selection['total'],
+        'lit_unittests_selected': selection['unittests'],
+    }
+
+
+def has_selected_tests(step):
+    """Skip the test step if the test selection found no affected tests."""
+    if not step.hasProperty('lit_tests_selected'):
+        return True
+    if step.getProperty('lit_full_suite'):
+        return True
+    return bool(step.getProperty('lit_tests_selected') or
+                step.getProperty('lit_unittests_selected'))
+
+
+# Sharded lit test runs
+#
+# The build publishes the parts of its tree that the lit tests need to the
+# master (publish_lit_tree) and records the lit command of its check target
+# (lit_command). One Triggerable scheduler per shard starts a build of a
+# test builder, which unpacks the tree (unpack_lit_tree), runs that command
+# with the shard options in LIT_OPTS (lit_shard_opts), so every shard picks
+# from the same tests as the check target, and uploads the lit results to
+# the same directory on the master. LitShardResults merges the results of
+# all shards into one report in the triggering build, and LitShardCleanup
+# removes the directory afterwards.
+
+LIT_SHARD_MASTER_DIR = 'lit-shards'
+LIT_SHARD_TREE = 'lit-tree' + ARCHIVE_SUFFIXES[ARCHIVE_COMPRESSION]
+LIT_SHARD_RESULTS = 'lit-results.json'
+
+
+@util.renderer
+def lit_shard_dir(props):
+    """Directory on the master for the test tree and shard results of a build."""
+    return os.path.join(LIT_SHARD_MASTER_DIR, props.getProperty('buildername'),
+                        str(props.getProperty('buildnumber')))
+
+
+def lit_shard_scheduler_names(name, shards):
+    return ['{0}-shard-{1}'.format(name, shard) for shard in range(1, shards + 1)]
+
+
+def lit_shard_schedulers(name, cb, builders, shards):
+    """One Triggerable scheduler per shard, which sets the shard properties."""
+    return [s_trigger(sched_name, cb, builders,
+                      properties={'lit_shard': shard, 'lit_shards': shards})
+            for shard, sched_name in enumerate(lit_shard_scheduler_names(name, shards), 1)]
+
+
+def extract_lit_command(rc, stdout, stderr):
+    """The last command of 'ninja -t commands <check target>' runs lit."""
+    lines = [line for line in stdout.splitlines() if line.strip()]
+    if rc != 0 or not lines:
+        return {}
+    return {'lit_command': lines[-1]}
+
+
+def lit_command(target, **kwargs):
+    """Record the command that runs the lit tests of `target` as 'lit_command'."""
+    return ucmddef('ninja', '-t', 'commands', target,
+                   extract_fn=extract_lit_command,
+                   name=kwargs.pop('name', 'find lit command of {0}'.format(target)),
+                   hideStepIf=kwargs.pop('hideStepIf', True), **kwargs)
+
+
+@util.renderer
+def lit_shard_opts(props):
+    """LIT_OPTS that run the shard of a test builder and write its results."""
+    return props.render(util.Interpolate(
+        "-j %(kw:jobs)s --num-shards %(prop:lit_shards)s --run-shard %(prop:lit_shard)s"
+        " -o /mnt/" + LIT_SHARD_RESULTS, jobs=parallel_jobs))
+
+
+def publish_lit_tree(srcdir, paths, **kwargs):
+    """Pack `paths` (relative to `srcdir`) into the artifact store for the shards."""
+    tree = "%(prop:builddir)s/" + LIT_SHARD_TREE
+    return [
+        ArchivePack(ip(tree), paths, excludes=["CMakeFiles", "*.o", "*.a"],
+                    workdir=srcdir, name="pack test tree", hideStepIf=True, **kwargs),
+    ] + hash_upload_to_master(
+        "lit_tree", ip(tree),
+        util.Interpolate("%(kw:dir)s/" + LIT_SHARD_TREE, dir=lit_shard_dir),
+        hideStepIf=True, **kwargs
+    ) + [
+        cmd("rm", "-f", ip(tree), name="remove test tree archive",
+            hideStepIf=True, haltOnFailure=False, alwaysRun=True, **kwargs),
+    ]
+
+
+def unpack_lit_tree(tgtdir, **kwargs):
+    """Replace `tgtdir` with the test tree published by the triggering build."""
+    return [
+        cmd("rm", "-f", LIT_SHARD_RESULTS,
+            workdir=ip("%(prop:builddir)s"), name="remove old test results",
+            hideStepIf=True, **kwargs),
+        ArtifactDownload(util.Interpolate("%(prop:lit_shard_dir)s/" + LIT_SHARD_TREE),
+                         None, "lit_tree", unpack=tgtdir, name="download test tree",
+                         hideStepIf=True, **kwargs),
+    ]
+
+
+def clean_lit_tree(tgtdir, **kwargs):
+    """Remove the test tree and the results of a shard, whatever happened."""
+    return [
+        rmdir(tgtdir, name="remove test tree", hideStepIf=True, alwaysRun=True,
+              haltOnFailure=False, flunkOnFailure=False, **kwargs),
+        cmd("rm", "-f", LIT_SHARD_RESULTS,
+            workdir=ip("%(prop:builddir)s"), name="remove test results",
+            hideStepIf=True, alwaysRun=True, haltOnFailure=False, flunkOnFailure=False,
+            **kwargs),
+    ]
+
+
+def upload_lit_results(src, **kwargs):
+    """Upload the lit results (lit -o) of a shard to the triggering build."""
+    return upload_file(src=src,
+                       tgt=util.Interpolate("%(prop:lit_shard_dir)s/shard-%(prop:lit_shard)s.json"),
+                       name="upload test results", hideStepIf=True, alwaysRun=True,
+                       haltOnFailure=False, flunkOnFailure=False, warnOnFailure=True,
+                       **kwargs)
+
+
+class LitShardResults(steps.BuildStep):
+    """
+    Merge the lit results of all test shards into one report.
+
+    Runs on the master after the shards were triggered. Prints the failing
+    tests with their output and a lit-style summary, sets the properties
+    'lit_tests_passed' and 'lit_tests_failed' and fails if a test failed or
+    the results of a shard are missing.
+    """
+
+    FAILURE_CODES = ('FAIL', 'XPASS', 'UNRESOLVED', 'TIMEOUT')
+    PASS_CODES = ('PASS', 'FLAKYPASS', 'XFAIL')
+
+    def __init__(self, shards, **kwargs):
+        self.shards = shards
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def read_shard(self, resultdir, shard):
+        path = os.path.join(resultdir, 'shard-{0}.json'.format(shard))
+        try:
+            with open(path) as f:
+                return json.load(f).get('tests', [])
+        except (IOError, OSError, ValueError):
+            return None
+
+    @defer.inlineCallbacks
+    def run(self):
+        resultdir = yield self.build.render(lit_shard_dir)
+        resultdir = os.path.join(self.master.basedir, resultdir)
+
+        counts = {}
+        failures = []
+        missing = []
+        for shard in range(1, self.shards + 1):
+            tests = self.read_shard(resultdir, shard)
+            if tests is None:
+                missing.append(shard)
+                continue
+            for test in tests:
+                counts[test['code']] = counts.get(test['code'], 0) + 1
+                if test['code'] in self.FAILURE_CODES:
+                    failures.append(test)
+
+        lines = []
+        for test in sorted(failures, key=lambda t: t['name']):
+            lines.append('{0}: {1}'.format(test['code'], test['name']))
+            lines.extend(test.get('output', '').splitlines())
+            lines.append('')
+        for shard in missing:
+            lines.append('ERROR: no test results from shard {0} of {1}'.format(
+                shard, self.shards))
+        lines.append('Test results of {0} shards:'.format(self.shards))
+        for code in sorted(counts):
+            lines.append('  {0:<20}: {1}'.format(code, counts[code]))
+
+        stdio = yield self.addLog('stdio')
+        yield stdio.addStdout('\n'.join(lines) + '\n')
+        yield stdio.finish()
+
+        passed = sum(counts.get(code, 0) for code in self.PASS_CODES)
+        self.setProperty('lit_tests_passed', passed, 'LitShardResults')
+        self.setProperty('lit_tests_failed', len(failures), 'LitShardResults')
+        self.descriptionDone = ['{0} passed, {1} failed'.format(passed, len(failures))]
+
+        if failures or missing:
+            defer.returnValue(FAILURE)
+        defer.returnValue(SUCCESS)
+
+
+class LitShardCleanup(steps.BuildStep):
+    """
+    Remove the shard directory of a build on the master.
+
+    Runs even if the build failed or was interrupted before the shards
+    finished, so neither the results nor the reference to the test tree in
+    the artifact store outlive the build.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('name', 'remove test shards')
+        kwargs.setdefault('alwaysRun', True)
+        kwargs.setdefault('hideStepIf', True)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        treedir = yield self.build.render(lit_shard_dir)
+        # Both write to disk, which must not block the master.
+        yield threads.deferToThread(shutil.rmtree, os.path.join(self.master.basedir, treedir),
+                                    ignore_errors=True)
+        storage = artifact_storage(self.master)
+        if storage is not None:
+            yield threads.deferToThread(storage.remove_ref,
+                                        os.path.join(treedir, LIT_SHARD_TREE))
+        defer.returnValue(SUCCESS)
+
+
 def property_is_true(propname):
     prop = propname
 
@@ -230,54 +1813,347 @@ def property_is_false(propname):
     return property_is_false_wrapper
 
 
-def hash_download_from_master(mastersrc, slavedst, tag):
-    from buildbot.process.results import SUCCESS, WARNINGS
-    steps = [
-        cmddef(command="stat {0}".format(slavedst),
-               extract_fn=extract_rc('have_{0}'.format(tag)),
-               decodeRC={0: SUCCESS, 1: SUCCESS}),
-        download_file(src="{0}.md5".format(mastersrc),
-                      tgt="{0}.md5".format(slavedst),
-                      doStepIf=property_is_true("have_{0}".format(tag))),
-        cmddef(command="md5sum -c {0}.md5".format(slavedst),
-               extract_fn=extract_rc('have_newest_{0}'.format(tag)),
-               doStepIf=property_is_true("have_{0}".format(tag)),
-               decodeRC={0: SUCCESS, 1: WARNINGS}),
-        download_file(src=mastersrc, tgt=slavedst,
-                      doStepIf=property_is_false(
-                          "have_newest_{0}".format(tag))),
-    ]
-    return steps
-
-
-def hash_upload_to_master(filename, slavesrc, masterdst, url):
-    steps = [
-        cmd("md5sum {0} > {0}.md5".format(filename), workdir=P("builddir")),
-        upload_file(src=slavesrc,
-                    tgt=masterdst,
-                    url="{0}/{1}".format(url, filename),
-                    description="Uploading {0}".format(filename),
-                    descriptionDone="Uploaded {0}".format(filename)),
-        upload_file(src="{0}.md5".format(slavesrc),
-                    tgt="{0}.md5".format(masterdst),
-                    url="{0}/{1}.md5".format(url, filename),
-                    description="Uploading {0}.md5".format(filename),
-                    descriptionDone="Uploaded {0}.md5".format(filename))
+# Artifacts
+#
+# Artifacts are kept in the content-addressed store of the master (see
+# polyjit.buildbot.artifacts), which workers reach at their
+# 'artifact_store_url' property. An artifact is stored once per sha256
+# digest and found by a reference name, usually the path on the master it
+# was uploaded to. Transfers are skipped if the receiver already has the
+# digest. Workers authenticate with the secret artifacts.TOKEN_SECRET, which
+# scripts/artifact.py gets in ARTIFACT_STORE_TOKEN.
+
+@util.renderer
+def artifact_cache_args(props):
+    """Options of artifact.py for the worker's cache of extracted archives."""
+    cache_dir = props.getProperty('artifact_cache_dir')
+    if not cache_dir:
+        return []
+    max_size = cache_size(props, 'artifact_cache_max_size', ARTIFACT_CACHE_SCRATCH_SHARE)
+    return ['--cache', cache_dir, '--cache-size', max_size or '50G']
+
+
+@util.renderer
+def artifact_store_token(props):
+    """The token for the artifact store, on workers that use one."""
+    if not props.getProperty('artifact_store_url'):
+        return ''
+    return props.render(util.Interpolate('%(secret:{0})s'.format(artifacts.TOKEN_SECRET)))
+
+
+def require_artifact_store(what):
+    """Report a config error if `what` is used without an artifact store."""
+    if not slaves.ARTIFACT_STORE_URL:
+        config.error("{0} needs the artifact store, set slaves.ARTIFACT_STORE_URL".format(what))
+
+
+def artifact_storage(master):
+    """The ArtifactStorage of the master, or None if it does not run one."""
+    store = master.namedServices.get('artifact-store')
+    return getattr(store, 'storage', None)
+
+
+def extract_artifact(tag):
+    """Set the 'have_<tag>'/'have_newest_<tag>' properties from artifact.py."""
+    name = tag
+
+    def extract_artifact_wrapper(rc, stdout, stderr):
+        if rc != 0:
+            return {}
+        result = json.loads(stdout)
+        return {
+            'have_{0}'.format(name): True,
+            'have_newest_{0}'.format(name): result['transferred'] == 0,
+            '{0}_digest'.format(name): result['digest'],
+        }
+    return extract_artifact_wrapper
+
+
+class ArtifactDownload(buildstep.ShellMixin, steps.BuildStep):
+    """
+    Download an artifact in a single round trip to the worker.
+
+    The digest of the artifact named `ref` is looked up in the artifact
+    store on the master and sent to the worker together with
+    scripts/artifact.py (on stdin), which compares it with the digest of
+    `dest`, downloads the artifact only if they differ and, with `unpack`,
+    extracts it into a clean `unpack` directory if that is not up to date.
+    If `dest` is None, the archive is streamed into `unpack` without being
+    stored on the worker. Archives are extracted once per worker into the
+    cache at the worker property 'artifact_cache_dir' and copied from there,
+    with reflinks where the file system supports them. If `dest` holds an
+    older version of the artifact and `delta` is set, only the difference to
+    the new version is transferred.
+
+    Sets 'have_<tag>', 'have_newest_<tag>' and '<tag>_digest', and records
+    the transferred and saved bytes as the step statistics
+    'bytes_transferred' and 'bytes_saved', along with the throughput and, for
+    unpacked archives, the compression ratio.
+    """
+
+    renderables = ['ref', 'dest', 'unpack']
+
+    def __init__(self, ref, dest, tag, unpack=None, delta=True, **kwargs):
+        self.ref = ref
+        self.dest = dest
+        self.tag = tag
+        self.unpack = unpack
+        self.delta = delta
+        require_artifact_store("downloading {0}".format(tag))
+        kwargs.setdefault('name', 'download {0}'.format(tag))
+        kwargs.setdefault('haltOnFailure', True)
+        kwargs.setdefault('logEnviron', False)
+        kwargs.setdefault('env', {'ARTIFACT_STORE_TOKEN': artifact_store_token})
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def lookup(self):
+        storage = artifact_storage(self.master)
+        if storage is None:
+            return None
+        return storage.lookup(self.ref.lstrip('/'))
+
+    @defer.inlineCallbacks
+    def run(self):
+        with open(os.path.join(SCRIPT_SOURCE_DIR, 'artifact.py')) as f:
+            script = f.read()
+
+        command = ['python3', '-', '--store', self.getProperty('artifact_store_url'),
+                   'download' if self.dest else 'unpack']
+        digest = self.lookup()
+        if digest:
+            command.extend(['--digest', digest])
+        else:
+            command.extend(['--ref', self.ref])
+        if self.unpack:
+            command.extend((yield self.build.render(artifact_cache_args)))
+        if self.dest is None:
+            command.append(self.unpack)
+        else:
+            if not self.delta:
+                command.append('--no-delta')
+            if self.unpack:
+                command.extend(['--unpack', self.unpack])
+            command.append(self.dest)
+
+        cmd = yield self.makeRemoteShellCommand(command=command, initialStdin=script,
+                                                collectStdout=True)
+        yield self.runCommand(cmd)
+        if cmd.didFail():
+            defer.returnValue(cmd.results())
+
+        result = json.loads(cmd.stdout.strip().splitlines()[-1])
+        self.setProperty('have_{0}'.format(self.tag), True, 'ArtifactDownload')
+        self.setProperty('have_newest_{0}'.format(self.tag), result['transferred'] == 0,
+                         'ArtifactDownload')
+        self.setProperty('{0}_digest'.format(self.tag), result['digest'], 'ArtifactDownload')
+        self.setStatistic('bytes_transferred', result['transferred'])
+        self.setStatistic('bytes_saved', result['saved'])
+        summary = record_transfer(self, result['transferred'], result['seconds'],
+                                  size=result.get('unpacked_size'), compressed=result['size'])
+        if result.get('delta'):
+            self.descriptionDone = ['downloaded {0} delta, saved {1:.1f} MiB ({2})'.format(
+                self.tag, result['saved'] / 1024.0 ** 2, summary)]
+        elif result['transferred']:
+            self.descriptionDone = ['downloaded {0} ({1})'.format(self.tag, summary)]
+        elif result.get('cache_hit'):
+            self.descriptionDone = ['{0} from worker cache'.format(self.tag)]
+        else:
+            self.descriptionDone = ['{0} is up to date'.format(self.tag)]
+        defer.returnValue(cmd.results())
+
+
+def hash_download_from_master(mastersrc, slavedst, tag, unpack=None):
+    """
+    Download the artifact uploaded to `mastersrc` unless `slavedst` is up to date.
+
+    With `unpack`, the artifact is also extracted into that directory (see
+    ArtifactDownload), which replaces a following clean_unpack.
+    """
+    return [ArtifactDownload(mastersrc, slavedst, tag, unpack=unpack)]
+
+
+def hash_upload_to_master(filename, slavesrc, masterdst, **kwargs):
+    """Store `slavesrc` in the artifact store under the name `masterdst`."""
+    require_artifact_store("uploading {0}".format(filename))
+    return [
+        download_script('artifact.py', **kwargs),
+        cmddef(command=["python3", script_path('artifact.py'),
+                        "--store", P("artifact_store_url"),
+                        "upload", "--ref", masterdst,
+                        "--builder", P("buildername"),
+                        "--revision", ip("%(prop:revision:-)s"),
+                        slavesrc],
+               extract_fn=extract_json("{0}_upload".format(filename)),
+               env={'ARTIFACT_STORE_TOKEN': artifact_store_token},
+               description="Uploading {0}".format(filename),
+               descriptionDone="Uploaded {0}".format(filename),
+               haltOnFailure=True, **kwargs),
     ]
-    return steps
 
 
 def clean_unpack(filename, tag):
+    """
+    Extract `filename` into a clean 'build/<tag>' if a newer version was downloaded.
+
+    The archive is extracted through the worker's cache of extracted
+    archives (see scripts/artifact.py). Prefer
+    hash_download_from_master(..., unpack=tag), which does the same in the
+    download step.
+    """
+    newer = property_is_false("have_newest_{0}".format(tag))
     return [
-        rmdir("build/{0}".format(tag),
-              doStepIf=property_is_false("have_newest_{0}".format(tag))),
-        mkdir("build/{0}".format(tag)),
-        cmd("tar", "xzf", filename, "-C", tag,
-            doStepIf=property_is_false("have_newest_{0}".format(tag)),
+        download_script('artifact.py', doStepIf=newer),
+        cmd("python3", script_path('artifact.py'), "extract", artifact_cache_args,
+            filename, tag,
+            doStepIf=newer,
             description="Unpacking {0}".format(tag))
     ]
 
 
+def get_log_url(master, logid):
+    return "{0}api/v2/logs/{1}/raw".format(master.config.buildbotURL, logid)
+
+
+@defer.inlineCallbacks
+def get_log_excerpt(master, log, strip_stream_prefix=True,
+                    head=PR_COMMENT_LOG_HEAD_LINES,
+                    tail=PR_COMMENT_LOG_TAIL_LINES,
+                    max_chars=GITHUB_COMMENT_MAX_CHARS):
+    """
+    Fetch the first `head` and the last `tail` lines of a log.
+
+    Only these line ranges are requested from the data API, so memory use
+    does not depend on the size of the log. If lines are left out, either
+    because of the line window or because the excerpt would exceed
+    `max_chars`, a marker with the number of omitted lines and the URL of
+    the full log is put in their place.
+    """
+    num_lines = log['num_lines']
+    if num_lines <= head + tail:
+        ranges = [(0, num_lines)]
+    else:
+        ranges = [(0, head), (num_lines - tail, tail)]
+
+    chunks = []
+    for offset, limit in ranges:
+        lines = []
+        if limit > 0:
+            content = yield master.data.get(("logs", log['logid'], 'contents'),
+                                            offset=offset, limit=limit)
+            if content is not None:
+                lines = content['content'].splitlines()
+        if strip_stream_prefix:
+            lines = [line[1:] for line in lines]
+        chunks.append(lines)
+
+    head_lines = chunks[0]
+    tail_lines = chunks[1] if len(chunks) > 1 else []
+    truncated = num_lines - len(head_lines) - len(tail_lines)
+
+    # Reserve room for the truncation marker, then drop lines from the end
+    # of the head and from the start of the tail until the rest fits. The
+    # end of the log, where the errors are, goes last.
+    budget = max_chars - 200
+    size = sum(len(line) + 1 for line in head_lines + tail_lines)
+    keep_head = len(head_lines)
+    while size > budget and keep_head > 0:
+        keep_head -= 1
+        size -= len(head_lines[keep_head]) + 1
+    drop_tail = 0
+    while size > budget and drop_tail < len(tail_lines):
+        size -= len(tail_lines[drop_tail]) + 1
+        drop_tail += 1
+    truncated += drop_tail + len(head_lines) - keep_head
+    head_lines = head_lines[:keep_head]
+    tail_lines = tail_lines[drop_tail:]
+
+    if truncated > 0:
+        marker = "... truncated {0} lines, full log at {1} ...".format(
+            truncated, get_log_url(master, log['logid']))
+        defer.returnValue(head_lines + [marker] + tail_lines)
+    defer.returnValue(head_lines + tail_lines)
+
+
+@defer.inlineCallbacks
+def get_build_results(props, title, report_steps, strip_warnings_prefix=True,
+                      max_concurrent=PR_COMMENT_MAX_CONCURRENT_FETCHES):
+    """
+    Render the results of the steps in `report_steps` as a PR comment.
+
+    `report_steps` maps step name regexes to options. The logs of all
+    reported steps are fetched concurrently, at most `max_concurrent` data
+    API requests at a time. Set `strip_warnings_prefix` to False to keep
+    the first character of the log lines of steps that ended with warnings.
+    The log excerpts are cut so the comment stays within
+    GITHUB_COMMENT_MAX_CHARS, however many steps fail. The render latency of every build is logged and recorded as the
+    'render-build-results' metric.
+    """
+    master = props.master
+    start = time.time()
+    semaphore = defer.DeferredSemaphore(max_concurrent)
+
+    @defer.inlineCallbacks
+    def render_step(step, step_options, max_chars):
+        logs = yield semaphore.run(master.data.get, ("steps", step['stepid'], 'logs'))
+        if not logs:
+            defer.returnValue([])
+
+        log = logs[-1]
+        result = util.Results[step['results']]
+        if result == 'success':
+            defer.returnValue([':heavy_check_mark: Step : {0} Result : {1}'.format(
+                step['name'], result)])
+
+        step_report = [':boom: Step : {0} Result : {1}'.format(step['name'], result)]
+        if step_options['full_report']:
+            strip_stream_prefix = strip_warnings_prefix or result != 'warnings'
+            step_logs = yield semaphore.run(get_log_excerpt, master, log,
+                                            strip_stream_prefix=strip_stream_prefix,
+                                            max_chars=max_chars)
+            step_report.append('<details><summary>Click to show details</summary>\n')
+            step_report.append('```')
+            step_report.extend(step_logs)
+            step_report.append('```\n')
+            step_report.append('</details>\n')
+        defer.returnValue(step_report)
+
+    buildsteps = yield master.data.get(('builders', props.getProperty('buildername'),
+                                        'builds', props.getProperty('buildnumber'), 'steps'))
+    reported = []
+    for step in buildsteps:
+        step_options = next((v for k, v in report_steps.items()
+                             if re.match(k, step['name'])), None)
+        if step_options is not None:
+            reported.append((step, step_options))
+
+    # The log excerpts share what is left of the comment after the title
+    # and the lines around every excerpt.
+    overhead = len(title) + sum(len(step['name']) + PR_COMMENT_STEP_OVERHEAD
+                                for step, _ in reported)
+    excerpts = sum(1 for _, step_options in reported if step_options['full_report'])
+    max_chars = max(0, GITHUB_COMMENT_MAX_CHARS - overhead) // max(1, excerpts)
+    pending = [render_step(step, step_options, max_chars) for step, step_options in reported]
+
+    try:
+        results = yield defer.DeferredList(pending, fireOnOneErrback=True,
+                                           consumeErrors=True)
+    except defer.FirstError as e:
+        e.subFailure.raiseException()
+
+    all_logs = [title]
+    for _, step_report in results:
+        all_logs.extend(step_report)
+
+    elapsed = time.time() - start
+    metrics.MetricTimeEvent.log('render-build-results', elapsed)
+    twlog.msg("Rendered results of {0} build {1} ({2} steps) in {3:.3f}s".format(
+        props.getProperty('buildername'), props.getProperty('buildnumber'),
+        len(pending), elapsed))
+
+    defer.returnValue('\n'.join(all_logs))
+
+
 @util.renderer
 def benchbuild_slurm(props):
     experiment = "empty"
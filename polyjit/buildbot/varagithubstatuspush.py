@@ -3,7 +3,10 @@ from __future__ import print_function
 
 from buildbot.reporters.github import GitHubStatusPush
 
+import json
+import os
 import re
+import tempfile
 
 from twisted.internet import defer
 from twisted.python import log
@@ -18,19 +21,269 @@ from buildbot.process.results import SKIPPED
 from buildbot.process.results import SUCCESS
 from buildbot.process.results import WARNINGS
 from buildbot.reporters import http
+from buildbot.reporters.generators.build import BuildStatusGenerator
+from buildbot.reporters.message import MessageFormatterRenderable
 from buildbot.util import httpclientservice
 from buildbot.util.giturlparse import giturlparse
 
 HOSTED_BASE_URL = 'https://api.github.com'
 
+# Builds that polyjit.buildbot.utils.cancel_superseded stops because a newer
+# commit of their pull request arrived end with this reason in their state.
+SUPERSEDED_REASON = 'obsoleted by a newer commit'
+SUPERSEDED_DESCRIPTION = 'Superseded by a newer commit.'
+
+# The updates of a reporter are queued in this file in the master's basedir.
+QUEUE_FILE = 'github-queue-{0}.json'
+# GitHub asks for at least a second between requests that create content.
+QUEUE_MIN_INTERVAL = 1
+# Failed updates are retried after 5s, 10s, 20s, ... but at most 15 minutes,
+# and dropped after 10 attempts.
+QUEUE_BACKOFF = 5
+QUEUE_MAX_BACKOFF = 15 * 60
+QUEUE_MAX_ATTEMPTS = 10
+# How long to wait after hitting a secondary rate limit without Retry-After.
+QUEUE_RATE_LIMIT_WAIT = 60
+# GitHub answers requests over a secondary rate limit with 403, but not
+# always with Retry-After; only the message tells them from other 403s.
+SECONDARY_RATE_LIMIT_RE = re.compile(r'secondary rate limit|abuse detection', re.IGNORECASE)
+
+
+def is_superseded(build):
+    return (build['results'] == CANCELLED and
+            SUPERSEDED_REASON in (build.get('state_string') or ''))
+
+
+def response_header(res, name):
+    """Get a header of a response of buildbot's HTTP client, or None."""
+    headers = getattr(getattr(res, '_res', res), 'headers', None)
+    if headers is None:
+        return None
+    if hasattr(headers, 'getRawHeaders'):
+        values = headers.getRawHeaders(name)
+        return values[-1] if values else None
+    return headers.get(name)
+
+
+def supersedes(entry, queued):
+    """
+    Whether a new update makes a queued one obsolete.
+
+    GitHub only shows the latest status of a commit and context, so any
+    queued status is replaced. Of the comments only the 'pending' ones are,
+    the result comments of earlier builds are still posted.
+    """
+    return (entry['key'] == queued['key'] and
+            (queued['key'][0] == 'status' or queued['state'] == 'pending'))
+
+
+class PushQueue(object):
+    """
+    Persistent queue of the updates a reporter sends to GitHub.
+
+    The updates are sent one at a time, at most one per QUEUE_MIN_INTERVAL.
+    When the X-RateLimit-* headers say the rate limit is exhausted, or
+    GitHub answers with a secondary rate limit, the queue waits until the
+    limit resets. Updates that fail with a server or connection error are
+    retried with exponential backoff. The queue is written to a JSON file
+    after every change, so pending updates survive a restart of the master.
+    """
+
+    def __init__(self, path, deliver, reactor):
+        self.path = path
+        self.deliver = deliver
+        self.reactor = reactor
+        self.entries = []
+        self.not_before = 0
+        self.running = False
+        self._timer = None
+        self._draining = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f).get('entries', [])
+        except ValueError as e:
+            log.err(e, 'Dropping the unreadable GitHub queue {0}'.format(self.path))
+            self.entries = []
+        if self.entries:
+            log.msg('Resuming {0} queued GitHub updates from {1}'.format(
+                len(self.entries), self.path))
+
+    def save(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.github-queue-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'entries': self.entries}, f)
+        os.rename(tmp_path, self.path)
+
+    def put(self, key, state, summary, args):
+        """Queue an update, replacing the queued updates it supersedes."""
+        entry = {'key': list(key), 'state': state, 'summary': summary, 'args': args,
+                 'attempts': 0}
+        self.entries = [e for e in self.entries if not supersedes(entry, e)]
+        self.entries.append(entry)
+        self.save()
+        self.schedule()
+
+    def start(self):
+        self.running = True
+        self.schedule()
+
+    def stop(self):
+        self.running = False
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if self._draining is not None:
+            return self._draining
+        return defer.succeed(None)
+
+    def schedule(self):
+        if not self.running or not self.entries:
+            return
+        if self._draining is not None or self._timer is not None:
+            return
+        delay = max(0, self.not_before - self.reactor.seconds())
+        self._timer = self.reactor.callLater(delay, self.drain)
+
+    @defer.inlineCallbacks
+    def drain(self):
+        self._timer = None
+        self._draining = defer.Deferred()
+        try:
+            while self.running and self.entries:
+                if self.reactor.seconds() < self.not_before:
+                    break
+                entry = self.entries[0]
+                body = None
+                try:
+                    res = yield self.deliver(entry)
+                    error = None
+                    if res.code == 403:
+                        body = yield res.content()
+                except Exception as e:
+                    res = None
+                    error = e
+                done, wait = self.evaluate(entry, res, error, body)
+                self.not_before = self.reactor.seconds() + wait
+                if done:
+                    self.entries = [e for e in self.entries if e is not entry]
+                self.save()
+        except Exception as e:
+            log.err(e, 'while sending the queued GitHub updates')
+        finally:
+            draining, self._draining = self._draining, None
+            draining.callback(None)
+            self.schedule()
+
+    def evaluate(self, entry, res, error, body=None):
+        """
+        Decide what to do after an attempt to send an update.
+
+        `body` is the content of a 403 response. Returns whether the update
+        is done, i.e. sent or given up, and the seconds to wait before the
+        next request.
+        """
+        wait = QUEUE_MIN_INTERVAL
+        remaining = response_header(res, 'X-RateLimit-Remaining')
+        reset = response_header(res, 'X-RateLimit-Reset')
+        retry_after = response_header(res, 'Retry-After')
+        exhausted = remaining is not None and int(remaining) == 0
+        if exhausted and reset is not None:
+            wait = max(wait, int(reset) - self.reactor.seconds() + 1)
+
+        if res is not None and 200 <= res.code < 300:
+            return True, wait
+
+        secondary = body is not None and SECONDARY_RATE_LIMIT_RE.search(
+            body.decode('utf-8', 'replace') if isinstance(body, bytes) else body)
+        if res is not None and res.code in (403, 429) and (
+                exhausted or retry_after is not None or secondary or res.code == 429):
+            if retry_after is not None:
+                wait = max(wait, int(retry_after))
+            elif not exhausted:
+                wait = max(wait, QUEUE_RATE_LIMIT_WAIT)
+            log.msg('GitHub rate limit hit, sending {0} in {1:.0f}s'.format(
+                entry['summary'], wait))
+            return False, wait
+
+        if res is not None and res.code < 500:
+            log.msg('GitHub rejected {0} with response code {1}, dropping it'.format(
+                entry['summary'], res.code))
+            return True, wait
+
+        entry['attempts'] += 1
+        reason = error if error is not None else 'response code {0}'.format(res.code)
+        if entry['attempts'] >= QUEUE_MAX_ATTEMPTS:
+            log.msg('Failed to send {0} after {1} attempts ({2}), dropping it'.format(
+                entry['summary'], entry['attempts'], reason))
+            return True, wait
+        backoff = min(QUEUE_MAX_BACKOFF, QUEUE_BACKOFF * 2 ** (entry['attempts'] - 1))
+        log.msg('Failed to send {0} ({1}), retrying in {2}s'.format(
+            entry['summary'], reason, backoff))
+        return False, max(wait, backoff)
+
+
 class VaraGitHubStatusPush(GitHubStatusPush):
+    """
+    Report the builds of pull requests to GitHub through a PushQueue.
+
+    Builds that were cancelled because a newer commit of their pull request
+    arrived (see polyjit.buildbot.utils.cancel_superseded) are reported as
+    superseded instead of as an error, or not at all without
+    `reportSuperseded`.
+    """
+
+    # Whether builds that were cancelled for a newer commit are reported.
+    reportSuperseded = True
+    # The kind of the updates in the queue, see supersedes.
+    queueKind = 'status'
+    queue = None
+
+    @defer.inlineCallbacks
+    def reconfigService(self, *args, **kwargs):
+        yield GitHubStatusPush.reconfigService(self, *args, **kwargs)
+        if self.queue is None:
+            name = re.sub(r'[^\w.-]', '_', self.name)
+            path = os.path.join(self.master.basedir, QUEUE_FILE.format(name))
+            self.queue = PushQueue(path, self.deliver, self.master.reactor)
+            self.queue.load()
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield GitHubStatusPush.startService(self)
+        self.queue.start()
 
     @defer.inlineCallbacks
-    def send(self, build):
+    def stopService(self):
+        if self.queue is not None:
+            yield self.queue.stop()
+        yield GitHubStatusPush.stopService(self)
+
+    def deliver(self, entry):
+        # The token is rendered when the update is sent, so the queue file
+        # does not contain it.
+        props = Properties()
+        props.master = self.master
+        return self.createStatus(props=props, **entry['args'])
+
+    @defer.inlineCallbacks
+    def sendMessage(self, reports):
+        report = reports[0]
+        build = report['builds'][0]
+
         props = Properties.fromDict(build['properties'])
         props.master = self.master
 
-        if build['complete']:
+        description = report.get('body', None)
+        if build['complete'] and is_superseded(build):
+            if not self.reportSuperseded:
+                return
+            state = 'error'
+            description = SUPERSEDED_DESCRIPTION
+        elif build['complete']:
             state = {
                 SUCCESS: 'success',
                 WARNINGS: 'success',
@@ -40,12 +293,8 @@ class VaraGitHubStatusPush(GitHubStatusPush):
                 RETRY: 'pending',
                 CANCELLED: 'error'
             }.get(build['results'], 'error')
-            description = yield props.render(self.endDescription)
-        elif self.startDescription:
-            state = 'pending'
-            description = yield props.render(self.startDescription)
         else:
-            return
+            state = 'pending'
 
         context = yield props.render(self.context)
 
@@ -54,7 +303,7 @@ class VaraGitHubStatusPush(GitHubStatusPush):
         if not sourcestamps or not sourcestamps[0]:
             return
 
-        branch = props['branch']
+        branch = props.getProperty('branch') or ''
         m = re.search(r"refs/pull/([0-9]*)/merge", branch)
         if m:
             issue = m.group(1)
@@ -62,6 +311,7 @@ class VaraGitHubStatusPush(GitHubStatusPush):
             # We only want to comment pull requests, so we exit here
             return
 
+        project = None
         for sourcestamp in sourcestamps:
             if branch == sourcestamp['branch']:
                 project = sourcestamp['project']
@@ -85,42 +335,43 @@ class VaraGitHubStatusPush(GitHubStatusPush):
             log.msg("Updating github status: repoOwner={repoOwner}, repoName={repoName}".format(
                 repoOwner=repoOwner, repoName=repoName))
 
-        try:
-            yield self.createStatus(
-                repo_user=repoOwner,
-                repo_name=repoName,
-                sha=sha,
-                state=state,
-                target_url=build['url'],
-                context=context,
-                issue=issue,
-                description=description
-            )
-            if self.verbose:
-                log.msg(
-                    'Updated status with "{state}" for {repoOwner}/{repoName} '
-                    'at {sha}, context "{context}", issue {issue}.'.format(
-                        state=state, repoOwner=repoOwner, repoName=repoName,
-                        sha=sha, issue=issue, context=context))
-        except Exception as e:
-            log.err(
-                e,
-                'Failed to update "{state}" for {repoOwner}/{repoName} '
-                'at {sha}, context "{context}", issue {issue}.'.format(
-                    state=state, repoOwner=repoOwner, repoName=repoName,
-                    sha=sha, issue=issue, context=context))
+        summary = (
+            '"{state}" for {repoOwner}/{repoName} at {sha}, context "{context}", '
+            'issue {issue}'.format(
+                state=state, repoOwner=repoOwner, repoName=repoName,
+                sha=sha, issue=issue, context=context))
+        self.queue.put(
+            (self.queueKind, repoOwner, repoName, sha, context, issue), state, summary,
+            dict(repo_user=repoOwner,
+                 repo_name=repoName,
+                 sha=sha,
+                 state=state,
+                 target_url=build['url'],
+                 context=context,
+                 issue=issue,
+                 description=description))
+        if self.verbose:
+            log.msg('Queued status update {0}.'.format(summary))
 
 
 class VaraGitHubPullRequestCommentPush(VaraGitHubStatusPush):
-    neededDetails = dict(wantProperties=True)
+    """Comment on pull requests when their builds are done."""
 
-    def setDefaults(self, context, startDescription, endDescription):
-        self.context = ''
-        self.startDescription = startDescription
-        self.endDescription = endDescription or 'Build done.'
+    name = "VaraGitHubPullRequestCommentPush"
+    # The build of the newer commit comments on the pull request instead.
+    reportSuperseded = False
+    queueKind = 'comment'
 
+    def setup_context(self, context):
+        return ''
+
+    def _create_default_generators(self):
+        return [BuildStatusGenerator(
+            mode='all', message_formatter=MessageFormatterRenderable('Build done.'))]
+
+    @defer.inlineCallbacks
     def createStatus(self,
-                     repo_user, repo_name, sha, state, target_url=None,
+                     repo_user, repo_name, sha, state, props, target_url=None,
                      context=None, issue=None, description=None):
         """
         :param repo_user: GitHub user or organization
@@ -129,6 +380,7 @@ class VaraGitHubPullRequestCommentPush(VaraGitHubStatusPush):
         :param state: one of the following 'pending', 'success', 'error'
                       or 'failure'.
         :param description: Short description of the status.
+        :param props: Properties to render the token with
         :return: A deferred with the result from GitHub.
 
         This code comes from txgithub by @tomprince.
@@ -137,6 +389,8 @@ class VaraGitHubPullRequestCommentPush(VaraGitHubStatusPush):
         """
         payload = {'body': description}
 
-        return self._http.post(
+        headers = yield self._get_auth_header(props)
+        res = yield self._http.post(
             '/'.join(['/repos', repo_user, repo_name, 'issues', issue, 'comments']),
-            json=payload)
+            json=payload, headers=headers)
+        defer.returnValue(res)
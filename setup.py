@@ -1,10 +1,10 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 from setuptools import setup, find_packages
 setup(name='polyjit.buildbot',
       version='0.1',
       url='https://github.com/PolyJIT/buildbot',
       packages=find_packages(),
-      install_requires=["buildbot>=0.9.7",
+      install_requires=["buildbot>=4.0",
                         "buildbot-console-view",
                         "buildbot-waterfall-view",
                         "buildbot-www",
@@ -17,6 +17,6 @@ setup(name='polyjit.buildbot',
           'Development Status :: 4 - Beta', 'Intended Audience :: Developers',
           'Topic :: Software Development :: Testing',
           'License :: OSI Approved :: MIT License',
-          'Programming Language :: Python :: 2'
+          'Programming Language :: Python :: 3'
       ],
       keywords="polyjit buildbot", )